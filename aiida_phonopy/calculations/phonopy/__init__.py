@@ -117,6 +117,9 @@ class BasePhonopyCalculation(object):
         if data_sets is None and force_constants is None:
             raise InputValidationError("no force_sets nor force_constants are specified for this calculation")
 
+        if bands is not None and bands.get_number_of_points() is None:
+            raise InputValidationError("all bands must have the same number of q-points (BAND_POINTS)")
+
         ##############################
         # END OF INITIAL INPUT CHECK #
         ##############################
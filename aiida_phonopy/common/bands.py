@@ -0,0 +1,67 @@
+# This file contains the q-points of the band structure paths and the storage of the data given for each band
+# (subpath) in BandStructureData. The bands may have a different number of q-points, in this case the data of all
+# bands is stored concatenated together with the number of q-points of each band.
+import numpy as np
+
+
+def get_band_points(band_ranges, reciprocal_cell, band_resolution=30, band_points=None):
+    """
+    Return the q-points of each band (segment) of a band structure path
+
+    :param band_ranges: numpy array [Nbands x 2 x 3] with the initial and final q-points of each band
+    :param reciprocal_cell: reciprocal lattice vectors (in rows) to compute the length of the bands
+    :param band_resolution: number of intervals in each band (used if band_points is None)
+    :param band_points: total number of q-points of the path distributed in proportion to the length of each band
+                        (at least 2 q-points in each band)
+    :return: list of numpy arrays [Nq_points x 3] (one per band)
+    """
+    q_start = band_ranges[:, 0]
+    q_delta = band_ranges[:, 1] - band_ranges[:, 0]
+
+    if band_points is None:
+        fractions = np.arange(band_resolution + 1) / float(band_resolution)
+        return list(q_start[:, None, :] + fractions[None, :, None] * q_delta[:, None, :])
+
+    lengths = np.linalg.norm(np.dot(q_delta, reciprocal_cell), axis=1)
+    counts = np.maximum(2, np.rint(band_points * lengths / np.sum(lengths)).astype(int))
+
+    # Fraction of the band of each q-point of the path
+    band_index = np.repeat(np.arange(len(counts)), counts)
+    offsets = np.cumsum(counts) - counts
+    fractions = (np.arange(np.sum(counts)) - offsets[band_index]) / (counts[band_index] - 1.0)
+
+    points = q_start[band_index] + fractions[:, None] * q_delta[band_index]
+    return np.split(points, np.cumsum(counts)[:-1])
+
+
+def get_band_array(data):
+    """
+    Return the data given for each band as a single numpy array
+
+    :param data: list with the data of each band [Nsubpaths x Nq_points x ...]
+    :return: numpy array [Nsubpaths x Nq_points x ...] and None if all bands have the same number of q-points,
+             otherwise the concatenated data of the bands [Nq_points_total x ...] and the number of q-points
+             of each band
+    """
+    sizes = [len(band) for band in data]
+    if len(set(sizes)) > 1:
+        return np.concatenate([np.array(band) for band in data]), np.array(sizes)
+    return np.array(data), None
+
+
+def split_band_array(array, sizes, band=None):
+    """
+    Return the data stored with get_band_array as given for each band
+
+    :param array: numpy array returned by get_band_array
+    :param sizes: number of q-points of each band returned by get_band_array (None for a regular array)
+    :param band: (integer) if not None, return only the data of the subpath with index band
+    :return: numpy array [Nsubpaths x Nq_points x ...] or a list of numpy arrays if sizes is not None
+    """
+    if sizes is not None:
+        array = np.split(array, np.cumsum(sizes)[:-1])
+
+    if band is not None:
+        array = array[band]
+
+    return array
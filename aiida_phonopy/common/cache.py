@@ -0,0 +1,158 @@
+# This file implements a content-addressed cache of calculations. Each calculation submitted with the cache
+# enabled is tagged with an extra that contains a hash of its inputs (structure, code and electronic structure
+# settings). Before submitting a new calculation, a finished calculation with the same hash is looked up in
+# the database and, if found, it is reused instead of being recomputed.
+
+import hashlib
+import json
+
+import numpy as np
+
+FORCES_HASH_EXTRA = 'phonopy_forces_hash'
+OPTIMIZE_HASH_EXTRA = 'phonopy_optimize_hash'
+
+# Default values of the OptimizeStructure inputs (other than structure, es_settings and pressure) that change its result
+OPTIMIZE_DEFAULTS = {'tolerance_forces': 1e-5,
+                     'tolerance_stress': 1e-2,
+                     'max_iterations': 3,
+                     'standarize_cell': True}
+
+
+def get_hash(data):
+    """
+    Return the SHA-256 hash of a JSON serializable object
+
+    :param data: JSON serializable object (dictionaries are sorted by key)
+    :return: hexadecimal string
+    """
+    return hashlib.sha256(json.dumps(data, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def _round(array, decimals):
+    # Adding 0.0 removes negative zeros, so that they have the same representation as positive zeros
+    return (np.round(np.array(array, dtype=float), decimals) + 0.0).tolist()
+
+
+def get_structure_representation(structure, decimals=6):
+    """
+    Return a canonical representation of a crystal structure. The order of the atoms is kept
+    since the forces of equivalent calculations must correspond atom by atom.
+
+    :param structure: StructureData object
+    :param decimals: number of decimals (in Angstrom) used to compare cell and positions
+    :return: dictionary
+    """
+    from aiida_phonopy.common.structure import get_structure_arrays
+
+    cell, positions, symbols = get_structure_arrays(structure)
+
+    return {'cell': _round(cell, decimals),
+            'positions': _round(positions, decimals),
+            'symbols': symbols}
+
+
+def get_calculation_hash(calculation_input):
+    """
+    Return the hash that identifies a calculation from the inputs generated by generate_inputs().
+    Computational resources and restart folders are not included since they do not change the result.
+
+    :param calculation_input: calculation inputs template
+    :return: hexadecimal string
+    """
+
+    data = {'code': calculation_input.code.uuid,
+            'structure': get_structure_representation(calculation_input.structure)}
+
+    for name in ['parameters', 'settings', 'potential']:
+        node = calculation_input.get(name)
+        if node is not None:
+            data[name] = node.get_dict()
+
+    kpoints = calculation_input.get('kpoints')
+    if kpoints is not None:
+        data['kpoints'] = [np.array(array).tolist() for array in kpoints.get_kpoints_mesh()]
+
+    for name in ['paw', 'pseudo']:
+        pseudos = calculation_input.get(name)
+        if pseudos is not None:
+            data[name] = {kind: pseudo.uuid for kind, pseudo in pseudos.items()}
+
+    return get_hash(data)
+
+
+def get_cached_node(node_class, extra_name, value):
+    """
+    Return a node of a finished calculation (or workchain) tagged with an extra that has a given value
+
+    :param node_class: class of the node to search (JobCalculation, WorkCalculation,...)
+    :param extra_name: name of the extra
+    :param value: value of the extra (hash)
+    :return: the node if found, otherwise None
+    """
+    from aiida.orm.querybuilder import QueryBuilder
+
+    qb = QueryBuilder()
+    qb.append(node_class, filters={'extras.{}'.format(extra_name): value})
+
+    for node, in qb.iterall():
+        if node.has_finished_ok():
+            return node
+
+    return None
+
+
+def get_cached_calculation(calculation_hash):
+    """
+    Return a finished calculation with the same hash (see get_calculation_hash) or None if not found
+    """
+    from aiida.orm.calculation.job import JobCalculation
+
+    return get_cached_node(JobCalculation, FORCES_HASH_EXTRA, calculation_hash)
+
+
+def set_calculation_hash(pk, calculation_hash):
+    """
+    Tag a submitted calculation with its hash to make it available for later reuse
+
+    :param pk: pk of the calculation node
+    :param calculation_hash: hash obtained from get_calculation_hash
+    """
+    from aiida.orm import load_node
+
+    load_node(pk).set_extra(FORCES_HASH_EXTRA, calculation_hash)
+
+
+def get_optimize_hash(structure, es_settings, pressure, tolerance_forces, tolerance_stress, max_iterations,
+                      standarize_cell):
+    """
+    Return the hash that identifies a crystal structure optimization (OptimizeStructure inputs).
+    Computational resources and restart options are not included since they do not change the result.
+
+    :param structure: StructureData object with the initial structure
+    :param es_settings: ParameterData object with the electronic structure settings
+    :param pressure: Float object with the external pressure
+    :param tolerance_forces: Float object with the convergence tolerance of the forces
+    :param tolerance_stress: Float object with the convergence tolerance of the stress
+    :param max_iterations: Int object with the maximum number of optimization cycles
+    :param standarize_cell: Bool object, True if the cell is standardized after each cycle
+    :return: hexadecimal string
+    """
+    settings = {key: value for key, value in es_settings.get_dict().items() if key not in ['machine']}
+
+    return get_hash({'structure': get_structure_representation(structure),
+                     'es_settings': settings,
+                     'pressure': float(pressure),
+                     'tolerance_forces': float(tolerance_forces),
+                     'tolerance_stress': float(tolerance_stress),
+                     'max_iterations': int(max_iterations),
+                     'standarize_cell': bool(standarize_cell)})
+
+
+def get_cached_optimization(optimize_hash):
+    """
+    Return a finished and converged OptimizeStructure workchain with the same hash (see get_optimize_hash)
+    or None if not found
+    """
+    from aiida.orm.calculation.work import WorkCalculation
+
+    return get_cached_node(WorkCalculation, OPTIMIZE_HASH_EXTRA, optimize_hash)
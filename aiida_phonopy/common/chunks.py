@@ -0,0 +1,25 @@
+# This file contains the indexing of the chunks in which the calculations of the supercells with displacements are
+# submitted (see PhononPhono3py). The workchain keeps the number of chunks left to submit in the context and each
+# step submits the last remaining chunk, so the chunks are submitted from the last one to the first one.
+
+
+def get_number_of_chunks(n_items, chunk_size):
+    """
+    Return the number of chunks needed to submit a number of items (the last chunk may be smaller)
+
+    :param n_items: number of items (calculations)
+    :param chunk_size: maximum number of items in each chunk
+    """
+    return (n_items + chunk_size - 1) // chunk_size
+
+
+def get_chunk_indices(chunk, chunk_size, n_items):
+    """
+    Return the indices of the items of a chunk
+
+    :param chunk: index of the chunk
+    :param chunk_size: maximum number of items in each chunk
+    :param n_items: total number of items
+    :return: list of indices
+    """
+    return list(range(chunk * chunk_size, min((chunk + 1) * chunk_size, n_items)))
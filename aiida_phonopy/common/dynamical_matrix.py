@@ -0,0 +1,234 @@
+# This file contains a vectorized implementation of the phonopy dynamical matrix. The force constants are stored in
+# compact form (primitive atoms x supercell atoms) together with the shortest vectors between atoms (with their
+# multiplicities), so the dynamical matrices of many q-points can be built at once with numpy without creating a
+# Phonopy object (no symmetry search). get_model_arrays() extracts these arrays from a Phonopy object and
+# get_dynamical_matrices()/get_frequencies() evaluate them. These are used by PhononModelData (data/phonon_model.py)
+
+import numpy as np
+
+# Method of the non-analytical corrections implemented in get_nac_force_constants()
+NAC_METHOD = 'wang'
+
+
+def get_smallest_vectors(primitive):
+    """
+    Return the shortest vectors (considering periodic images) from each primitive atom to each supercell atom
+    as computed by phonopy (lattice reduced before the search of images). Both phonopy formats are supported:
+    padded ([Nsatoms x Npatoms x 27 x 3] with multiplicity [Nsatoms x Npatoms]) and dense ([Nvectors x 3] with
+    multiplicity [Nsatoms x Npatoms x 2] containing the number of vectors and the index of the first one).
+
+    :param primitive: phonopy Primitive object
+    :return: vectors [Npatoms x Nsatoms x max_multiplicity x 3] in primitive cell scaled coordinates (padded with zeros),
+             multiplicity [Npatoms x Nsatoms]
+    """
+    vectors, multiplicity = primitive.get_smallest_vectors()
+    vectors = np.array(vectors, dtype=float)
+    multiplicity = np.array(multiplicity, dtype=int)
+
+    if multiplicity.ndim == 3:
+        counts = multiplicity[:, :, 0]
+        indices = multiplicity[:, :, 1][:, :, None] + np.arange(np.max(counts))[None, None, :]
+    else:
+        counts = multiplicity
+        indices = None
+
+    mask = np.arange(np.max(counts))[None, None, :] < counts[:, :, None]
+
+    if indices is not None:
+        vectors = vectors[np.where(mask, indices, 0)]
+    else:
+        vectors = vectors[:, :, :np.max(counts)]
+
+    vectors = vectors * mask[:, :, :, None]
+
+    return vectors.transpose(1, 0, 2, 3), counts.T
+
+
+# Arrays of a phonon model stored in PhononModelData (the frequency_factor is stored as an attribute)
+MODEL_ARRAYS = ['force_constants', 'masses', 'smallest_vectors', 'multiplicity', 's2p_map', 'primitive_cell']
+
+
+def get_model_arrays(phonon):
+    """
+    Return the data needed to evaluate the dynamical matrices of a Phonopy object with force constants set
+
+    :param phonon: Phonopy object
+    :return: dictionary of numpy arrays
+    """
+    primitive = phonon.get_primitive()
+    supercell = phonon.get_supercell()
+
+    p2s_map = np.array(primitive.get_primitive_to_supercell_map())
+    p2p_map = primitive.get_primitive_to_primitive_map()
+    s2p_map = np.array([p2p_map[i] for i in primitive.get_supercell_to_primitive_map()])
+
+    vectors, multiplicity = get_smallest_vectors(primitive)
+
+    # Full force constants [Nsatoms x Nsatoms] are reduced to the compact form [Npatoms x Nsatoms]
+    force_constants = np.array(phonon.get_force_constants())
+    if force_constants.shape[0] == force_constants.shape[1]:
+        force_constants = force_constants[p2s_map]
+
+    return {'force_constants': force_constants,
+            'masses': np.array(primitive.get_masses()),
+            'smallest_vectors': vectors,
+            'multiplicity': multiplicity,
+            's2p_map': s2p_map,
+            'primitive_cell': np.array(primitive.get_cell()),
+            'frequency_factor': phonon.get_unit_conversion_factor()}
+
+
+def get_nac_method(phonon):
+    """
+    Return the method of the non-analytical corrections used by the dynamical matrix of a Phonopy object
+
+    :param phonon: Phonopy object with force constants set
+    :return: 'wang', 'gonze' or None if no non-analytical corrections are set
+    """
+    if phonon.get_nac_params() is None:
+        return None
+
+    dynamical_matrix = phonon.get_dynamical_matrix()
+
+    # Older phonopy versions use a single class (DynamicalMatrixNAC) with a method attribute
+    if hasattr(dynamical_matrix, '_method'):
+        return dynamical_matrix._method
+
+    if 'Wang' in type(dynamical_matrix).__name__:
+        return 'wang'
+    return 'gonze'
+
+
+def get_nac_force_constants(qpoints, force_constants, s2p_map, primitive_cell, nac_parameters):
+    """
+    Return the force constants including the non-analytical term (Wang method as in phonopy) for each q-point.
+    The Gonze-Lee method (default of recent phonopy versions) is not implemented
+
+    :param qpoints: q-points [Nq x 3] in reduced coordinates of the primitive reciprocal lattice
+    :param force_constants: compact force constants [Npatoms x Nsatoms x 3 x 3]
+    :param nac_parameters: dictionary with 'born', 'dielectric' and 'factor' (phonopy format)
+    :return: force constants [Nq x Npatoms x Nsatoms x 3 x 3]
+    """
+    born = np.array(nac_parameters['born'], dtype=float)
+    dielectric = np.array(nac_parameters['dielectric'], dtype=float)
+    volume = abs(np.linalg.det(primitive_cell))
+    n_cells = len(s2p_map) // len(born)
+
+    # q-points in cartesian coordinates
+    q_cart = np.dot(qpoints, np.linalg.inv(primitive_cell).T)
+    denominator = np.einsum('qi,ij,qj->q', q_cart, dielectric, q_cart)
+
+    gamma = np.linalg.norm(q_cart, axis=1) < 1e-5
+    constant = np.where(gamma, 0.0, nac_parameters['factor'] * 4.0 * np.pi / volume /
+                        np.where(gamma, 1.0, denominator))
+
+    # A_i = q.Z_i  [Nq x Npatoms x 3]
+    charges = np.einsum('qi,pij->qpj', q_cart, born)
+    nac_term = charges[:, :, None, :, None] * charges[:, None, :, None, :] * constant[:, None, None, None, None]
+
+    return force_constants[None, :, :, :, :] + nac_term[:, :, s2p_map, :, :] / n_cells
+
+
+def get_dynamical_matrices(qpoints, force_constants, masses, smallest_vectors, multiplicity, s2p_map,
+                           primitive_cell=None, nac_parameters=None):
+    """
+    Return the dynamical matrices at a list of q-points
+
+    :param qpoints: q-points [Nq x 3] in reduced coordinates of the primitive reciprocal lattice
+    :return: complex numpy array [Nq x 3Npatoms x 3Npatoms]
+    """
+    qpoints = np.array(qpoints, dtype=float).reshape(-1, 3)
+    n_patoms = len(masses)
+    n_satoms = len(s2p_map)
+
+    # Phase factors averaged over equivalent images [Nq x Npatoms x Nsatoms]
+    mask = np.arange(smallest_vectors.shape[2])[None, None, :] < multiplicity[:, :, None]
+    phases = np.exp(2j * np.pi * np.einsum('qx,psmx->qpsm', qpoints, smallest_vectors))
+    phases = np.sum(phases * mask[None], axis=-1) / multiplicity[None]
+
+    if nac_parameters is not None:
+        force_constants = get_nac_force_constants(qpoints, force_constants, s2p_map, primitive_cell, nac_parameters)
+        terms = force_constants * phases[:, :, :, None, None]
+    else:
+        terms = force_constants[None] * phases[:, :, :, None, None]
+
+    # Sum the supercell atoms that correspond to the same primitive atom [Nq x Npatoms x Npatoms x 3 x 3]
+    sum_matrix = np.zeros((n_satoms, n_patoms))
+    sum_matrix[np.arange(n_satoms), s2p_map] = 1.0
+    matrices = np.einsum('qpsab,st->qptab', terms, sum_matrix)
+
+    matrices /= np.sqrt(np.outer(masses, masses))[None, :, :, None, None]
+    matrices = matrices.transpose(0, 1, 3, 2, 4).reshape(len(qpoints), n_patoms * 3, n_patoms * 3)
+
+    # Make sure the matrices are hermitian
+    return (matrices + matrices.conj().transpose(0, 2, 1)) / 2
+
+
+def get_frequencies(dynamical_matrices, frequency_factor, eigenvectors=False):
+    """
+    Return the frequencies (and eigenvectors) from the dynamical matrices
+
+    :param dynamical_matrices: complex numpy array [Nq x 3Natoms x 3Natoms]
+    :param frequency_factor: conversion factor from sqrt(eigenvalues) to frequencies
+    :param eigenvectors: if True also return the eigenvectors
+    :return: frequencies [Nq x 3Natoms] (and eigenvectors [Nq x 3Natoms x 3Natoms] in columns)
+    """
+    if eigenvectors:
+        eigenvalues, vectors = np.linalg.eigh(dynamical_matrices)
+    else:
+        eigenvalues = np.linalg.eigvalsh(dynamical_matrices)
+
+    frequencies = np.sqrt(np.abs(eigenvalues)) * np.sign(eigenvalues) * frequency_factor
+
+    if eigenvectors:
+        return frequencies, vectors
+    return frequencies
+
+
+def get_model_frequencies(qpoints, model, nac_parameters=None, eigenvectors=False, max_memory=200):
+    """
+    Return the frequencies (and eigenvectors) at a list of q-points from the arrays of a phonon model. The q-points
+    are evaluated in batches to limit the size of the temporary arrays, the arrays of the model are read only once
+
+    :param qpoints: q-points [Nq x 3] in reduced coordinates of the primitive reciprocal lattice
+    :param model: dictionary with the arrays in MODEL_ARRAYS and the frequency_factor (see get_model_arrays)
+    :param nac_parameters: non-analytical corrections in phonopy format (None if not used)
+    :param eigenvectors: if True also return the eigenvectors (in columns, as in phonopy)
+    :param max_memory: approximate size (in MB) of the temporary arrays used in each batch of q-points
+    :return: frequencies [Nq x 3Npatoms] (and eigenvectors [Nq x 3Npatoms x 3Npatoms])
+    """
+    arrays = dict((name, model[name]) for name in MODEL_ARRAYS)
+    frequency_factor = model['frequency_factor']
+
+    qpoints = np.array(qpoints, dtype=float).reshape(-1, 3)
+    n_patoms, n_satoms = arrays['force_constants'].shape[0:2]
+    n_bands = n_patoms * 3
+
+    if len(qpoints) == 0:
+        if eigenvectors:
+            return np.zeros((0, n_bands)), np.zeros((0, n_bands, n_bands), dtype=complex)
+        return np.zeros((0, n_bands))
+
+    batch_size = max(1, int(max_memory * 1e6 / (16 * 9 * n_patoms * n_satoms)))
+
+    frequencies = []
+    vectors = []
+    for start in range(0, len(qpoints), batch_size):
+        dynamical_matrices = get_dynamical_matrices(qpoints[start:start + batch_size],
+                                                    arrays['force_constants'],
+                                                    arrays['masses'],
+                                                    arrays['smallest_vectors'],
+                                                    arrays['multiplicity'],
+                                                    arrays['s2p_map'],
+                                                    primitive_cell=arrays['primitive_cell'],
+                                                    nac_parameters=nac_parameters)
+        results = get_frequencies(dynamical_matrices, frequency_factor, eigenvectors=eigenvectors)
+        if eigenvectors:
+            frequencies.append(results[0])
+            vectors.append(results[1])
+        else:
+            frequencies.append(results)
+
+    if eigenvectors:
+        return np.concatenate(frequencies), np.concatenate(vectors)
+    return np.concatenate(frequencies)
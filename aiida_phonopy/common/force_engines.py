@@ -0,0 +1,196 @@
+# This file contains the in-process force engines. A force engine calculates the atomic forces of a
+# batch of supercells directly inside the workchain process, without submitting any calculation to a code.
+# This is intended for fast screening with model potentials and for testing/benchmarking the workchains.
+# Engines are selected in es_settings:
+#
+#     es_settings = ParameterData(dict={'force_engine': {'name': 'lennard_jones',
+#                                                        'parameters': {'epsilon': 0.0104,
+#                                                                       'sigma': 3.40,
+#                                                                       'cutoff': 8.5}}})
+#
+# Additional engines can be registered by other packages using the 'aiida_phonopy.force_engines'
+# entry point group. get_force_engine() function at the end of the file returns the engine instance.
+
+import numpy as np
+
+
+class ForceEngine(object):
+    """
+    Base class of in-process force engines. Subclasses must implement get_forces()
+    """
+
+    def __init__(self, **parameters):
+        self._parameters = parameters
+
+    def get_forces(self, cells, positions, symbols):
+        """
+        Calculate the atomic forces of a batch of supercells (all with the same atoms)
+
+        :param cells: numpy array [Ncells x 3 x 3] with the lattice vectors (in rows) of each supercell
+        :param positions: numpy array [Ncells x Natoms x 3] with the cartesian positions in Angstrom
+        :param symbols: list of Natoms atomic symbols (common to all supercells)
+        :return: numpy array [Ncells x Natoms x 3] with the atomic forces in eV/Angstrom
+        """
+        raise NotImplementedError
+
+
+class PairPotential(ForceEngine):
+    """
+    Vectorized pair potential with periodic boundary conditions. Subclasses define the pair force.
+
+    Each parameter of the potential can be a number or a dictionary {symbol: value}. In the second case
+    the parameters of each pair of atoms are obtained using the mixing rule defined in _mix_parameters()
+
+    :param cutoff: interaction cutoff radius in Angstrom
+    :param max_memory: approximate size (in MB) of the temporary arrays used in each batch of supercells
+    """
+
+    _parameter_names = []
+
+    def __init__(self, cutoff=8.0, max_memory=200, **parameters):
+        super(PairPotential, self).__init__(**parameters)
+        self._cutoff = float(cutoff)
+        self._max_memory = max_memory
+
+        for name in self._parameter_names:
+            if name not in parameters:
+                raise ValueError('Parameter {} is required by {}'.format(name, type(self).__name__))
+
+    def _mix_parameters(self, name, value_i, value_j):
+        """
+        Return the parameter of a pair of atoms from the parameters of each atom (arithmetic mean by default)
+        """
+        return (value_i + value_j) / 2.0
+
+    def _get_pair_parameters(self, symbols):
+        """
+        Return a dictionary with the parameters of the potential as [Natoms x Natoms] matrices
+        """
+        pair_parameters = {}
+        for name in self._parameter_names:
+            value = self._parameters[name]
+            if isinstance(value, dict):
+                atom_values = np.array([float(value[symbol]) for symbol in symbols])
+                pair_parameters[name] = self._mix_parameters(name, atom_values[:, None], atom_values[None, :])
+            else:
+                pair_parameters[name] = np.full((len(symbols), len(symbols)), float(value))
+        return pair_parameters
+
+    def pair_force(self, r, **pair_parameters):
+        """
+        Return -dV/dr for the interatomic distances r
+
+        :param r: numpy array of interatomic distances
+        :param pair_parameters: parameters of the potential broadcastable to r
+        """
+        raise NotImplementedError
+
+    def _get_lattice_translations(self, cells):
+        # Number of images needed in each direction to include all neighbours within cutoff
+        reciprocal = np.linalg.inv(cells).transpose(0, 2, 1)
+        n_images = np.ceil(self._cutoff * np.max(np.linalg.norm(reciprocal, axis=2), axis=0)).astype(int)
+
+        ranges = [np.arange(-n, n + 1) for n in n_images]
+        return np.array(np.meshgrid(*ranges, indexing='ij')).reshape(3, -1).T
+
+    def get_forces(self, cells, positions, symbols):
+
+        positions = np.array(positions, dtype=float)
+        cells = np.array(cells, dtype=float)
+        if cells.ndim == 2:
+            cells = np.repeat(cells[None, :, :], len(positions), axis=0)
+
+        n_cells, n_atoms = positions.shape[0:2]
+
+        translations = self._get_lattice_translations(cells)
+        pair_parameters = {name: value[None, :, :, None] for name, value in self._get_pair_parameters(symbols).items()}
+
+        # Split the supercells in batches to limit the size of the temporary arrays
+        batch_size = int(self._max_memory * 1e6 / (8 * 4 * n_atoms ** 2 * len(translations)))
+        batch_size = max(1, min(n_cells, batch_size))
+
+        forces = np.zeros_like(positions)
+        for start in range(0, n_cells, batch_size):
+            batch = slice(start, start + batch_size)
+
+            shifts = np.dot(translations, cells[batch]).transpose(1, 0, 2)  # [Nbatch x Nimages x 3]
+
+            # Distance vectors from atom i to all images of atom j: [Nbatch x Natoms x Natoms x Nimages x 3]
+            vectors = (positions[batch, None, :, None, :] - positions[batch, :, None, None, :] +
+                       shifts[:, None, None, :, :])
+            r = np.linalg.norm(vectors, axis=-1)
+
+            mask = (r < self._cutoff) & (r > 1e-8)
+            r_safe = np.where(mask, r, 1.0)
+            magnitude = np.where(mask, self.pair_force(r_safe, **pair_parameters), 0.0)
+
+            # F_i = -sum_j (-dV/dr) * r_ij / |r_ij|
+            forces[batch] = -np.einsum('cijt,cijtx->cix', magnitude / r_safe, vectors)
+
+        return forces
+
+
+class LennardJones(PairPotential):
+    """
+    Lennard-Jones potential: V(r) = 4 epsilon [(sigma/r)^12 - (sigma/r)^6]
+
+    :param epsilon: well depth in eV (Lorentz-Berthelot mixing rule: geometric mean)
+    :param sigma: distance at which the potential is zero in Angstrom (mixing rule: arithmetic mean)
+    """
+
+    _parameter_names = ['epsilon', 'sigma']
+
+    def _mix_parameters(self, name, value_i, value_j):
+        if name == 'epsilon':
+            return np.sqrt(value_i * value_j)
+        return (value_i + value_j) / 2.0
+
+    def pair_force(self, r, epsilon=None, sigma=None):
+        sr6 = (sigma / r) ** 6
+        return 24.0 * epsilon / r * (2.0 * sr6 ** 2 - sr6)
+
+
+class Morse(PairPotential):
+    """
+    Morse potential: V(r) = D [(1 - exp(-a (r - r0)))^2 - 1]
+
+    :param D: well depth in eV (mixing rule: geometric mean)
+    :param a: width parameter in 1/Angstrom (mixing rule: arithmetic mean)
+    :param r0: equilibrium distance in Angstrom (mixing rule: arithmetic mean)
+    """
+
+    _parameter_names = ['D', 'a', 'r0']
+
+    def _mix_parameters(self, name, value_i, value_j):
+        if name == 'D':
+            return np.sqrt(value_i * value_j)
+        return (value_i + value_j) / 2.0
+
+    def pair_force(self, r, D=None, a=None, r0=None):
+        exp_term = np.exp(-a * (r - r0))
+        return -2.0 * D * a * exp_term * (1.0 - exp_term)
+
+
+FORCE_ENGINES = {'lennard_jones': LennardJones,
+                 'morse': Morse}
+
+
+def get_force_engine(engine_settings):
+    """
+    Return the force engine instance defined in the 'force_engine' entry of es_settings
+
+    :param engine_settings: dictionary {'name': engine name, 'parameters': dictionary with engine parameters}
+    :return: ForceEngine object
+    """
+
+    name = engine_settings['name']
+    parameters = engine_settings.get('parameters', {})
+
+    if name in FORCE_ENGINES:
+        return FORCE_ENGINES[name](**parameters)
+
+    from reentry import manager
+    for entry_point in manager.iter_entry_points(group='aiida_phonopy.force_engines', name=name):
+        return entry_point.load()(**parameters)
+
+    raise ValueError('Force engine {} not found'.format(name))
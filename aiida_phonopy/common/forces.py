@@ -0,0 +1,104 @@
+# This file collects the atomic forces of the calculations of the supercells with displacements. The final forces
+# of all calculations are stored in a single ArrayData object, and the forces nodes they come from are kept in a
+# group (named after the aggregated node) instead of linking each of them as an input of a workfunction.
+
+import os
+
+import numpy as np
+
+# Prefix of the name of the group that contains the forces nodes of an aggregated forces node (followed by its uuid)
+FORCES_GROUP_PREFIX = 'phonopy_forces_'
+
+
+def get_trajectory_frame(node, name, index=-1):
+    """
+    Return a single frame of an array stored in a trajectory (or array) node. The array file is memory mapped,
+    so only the requested frame is read from disk instead of the whole trajectory.
+
+    :param node: ArrayData (or TrajectoryData) object
+    :param name: name of the array (e.g. 'forces', 'stress', 'positions', 'cells')
+    :param index: index of the frame (default: -1, the last one)
+    :return: numpy array
+    """
+    path = node.get_abs_path('{}.npy'.format(name))
+    if not os.path.isfile(path):
+        return node.get_array(name)[index]
+
+    frame = np.load(path, mmap_mode='r')[index]
+    if isinstance(frame, np.ndarray):
+        # Copy the data to memory (the mapped file is closed when the memmap object is deleted)
+        return np.array(frame)
+    return frame
+
+
+def get_number_of_frames(node, name):
+    """
+    Return the number of frames of an array stored in a trajectory node without reading the data
+
+    :param node: ArrayData (or TrajectoryData) object
+    :param name: name of the array
+    """
+    return node.get_shape(name)[0]
+
+
+def get_final_forces(forces_node):
+    """
+    Return the atomic forces of the last step stored in a node ([Natoms x 3] numpy array)
+
+    :param forces_node: ArrayData object containing 'forces' array of a single step or of a trajectory
+    """
+    if len(forces_node.get_shape('forces')) == 3:
+        return get_trajectory_frame(forces_node, 'forces', -1)
+    return forces_node.get_array('forces')
+
+
+def get_forces_array(forces_nodes):
+    """
+    Return the final forces of a list of calculations in a single array. The array is allocated once from
+    the shape of the first node and filled in one pass
+
+    :param forces_nodes: list of ArrayData objects (see get_forces_nodes)
+    :return: numpy array [Ncalculations x Natoms x 3]
+    """
+    forces = None
+    for i, forces_node in enumerate(forces_nodes):
+        final_forces = get_final_forces(forces_node)
+        if forces is None:
+            forces = np.empty((len(forces_nodes),) + final_forces.shape)
+        forces[i] = final_forces
+
+    if forces is None:
+        raise Exception('No forces to aggregate')
+
+    return forces
+
+
+def get_forces_group_name(forces):
+    """
+    Return the name of the group that contains the forces nodes of an aggregated forces node
+
+    :param forces: aggregated forces node (see aggregate_forces)
+    """
+    return '{}{}'.format(FORCES_GROUP_PREFIX, forces.uuid)
+
+
+def aggregate_forces(forces_nodes, array_class, group_class):
+    """
+    Store the final forces of a list of calculations in a single node. The forces nodes are added to a group
+    (see get_forces_group_name) and their uuids are kept in the forces_uuids attribute, so the provenance takes
+    one group instead of one link per calculation
+
+    :param forces_nodes: list of stored ArrayData objects (see get_forces_nodes)
+    :param array_class: ArrayData class
+    :param group_class: Group class
+    :return: stored ArrayData object with 'forces' array [Ncalculations x Natoms x 3]
+    """
+    forces = array_class()
+    forces.set_array('forces', get_forces_array(forces_nodes))
+    forces._set_attr('forces_uuids', [forces_node.uuid for forces_node in forces_nodes])
+    forces.store()
+
+    group, _ = group_class.get_or_create(name=get_forces_group_name(forces))
+    group.add_nodes(forces_nodes)
+
+    return forces
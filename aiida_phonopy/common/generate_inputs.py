@@ -6,6 +6,8 @@ from aiida.work.run import run, submit, async
 from aiida.orm import Code, CalculationFactory, DataFactory
 # from aiida.orm.data.upf import UpfData
 
+from aiida_phonopy.common.restart import get_vasp_restart_parameters, get_qe_restart_parameters
+
 
 KpointsData = DataFactory("array.kpoints")
 ParameterData = DataFactory('parameter')
@@ -48,7 +50,8 @@ def get_pseudos_qe(structure, family_name):
     return pseudos
 
 
-def generate_qe_params(structure, settings, pressure=0.0, type=None):
+def generate_qe_params(structure, settings, pressure=0.0, type=None, parent_folder=None, write_restart=False,
+                       restart_wavefunctions=True):
 
     """
     Generate the input parameters needed to run a calculation for PW (Quantum Espresso)
@@ -56,6 +59,9 @@ def generate_qe_params(structure, settings, pressure=0.0, type=None):
     :param structure:  StructureData object containing the crystal structure
     :param machine:  ParametersData object containing a dictionary with the computational resources information
     :param settings:  ParametersData object containing a dictionary with the INCAR parameters
+    :param parent_folder: RemoteData object of a previous calculation. If set, start from its wave functions and charge density
+    :param write_restart: If True, keep the wave functions and charge density to restart other calculations
+    :param restart_wavefunctions: If False, start only from the charge density of parent_folder (different cell)
     :return: Calculation process object, input dictionary
     """
 
@@ -114,6 +120,24 @@ def generate_qe_params(structure, settings, pressure=0.0, type=None):
         #parameters['INPUTPH'] = {'epsil': True,
         #                         'zeu': True}  # Degrees of movement
 
+    if type == 'forces' and settings.get_dict().get('minimal_io', False):
+        # Only the final forces are needed: do not write wave functions nor compute the stress
+        # (the trajectory of a single point calculation contains only one step)
+        parameters['CONTROL'].update({'tstress': False,
+                                      'disk_io': 'none',
+                                      'verbosity': 'low'})
+
+    restart_parameters = get_qe_restart_parameters(type,
+                                                   restart=parent_folder is not None,
+                                                   write_restart=write_restart,
+                                                   restart_wavefunctions=restart_wavefunctions)
+    for namelist, values in restart_parameters.items():
+        parameters[namelist] = dict(parameters.get(namelist, {}))
+        parameters[namelist].update(values)
+
+    if parent_folder is not None:
+        inputs.parent_folder = parent_folder
+
     inputs.parameters = ParameterData(dict=parameters)
 
     # Kpoints
@@ -128,12 +152,16 @@ def generate_qe_params(structure, settings, pressure=0.0, type=None):
     return PwCalculation.process(), inputs
 
 
-def generate_lammps_params(structure, settings, type=None, pressure=0.0):
+def generate_lammps_params(structure, settings, type=None, pressure=0.0, parent_folder=None, write_restart=False,
+                           restart_wavefunctions=True):
     """
     Generate the input paramemeters needed to run a calculation for LAMMPS
 
     :param structure: StructureData object
     :param settings: ParametersData object containing a dictionary with the LAMMPS parameters
+    :param parent_folder: not used (no wave functions in LAMMPS)
+    :param write_restart: not used (no wave functions in LAMMPS)
+    :param restart_wavefunctions: not used (no wave functions in LAMMPS)
     :return: Calculation process object, input dictionary
     """
 
@@ -154,6 +182,8 @@ def generate_lammps_params(structure, settings, type=None, pressure=0.0):
     inputs.structure = structure
     inputs.potential = ParameterData(dict=settings.dict.potential)
 
+    # lammps.force only writes and parses the final forces (nothing to do for minimal_io)
+
     # if code.get_input_plugin_name() == 'lammps.optimize':
     if type == 'optimize':
         print ('optimize inside')
@@ -197,12 +227,16 @@ def get_pseudos_vasp(structure, family_name, folder_path=None):
     return pseudos
 
 
-def generate_vasp_params(structure, settings, type=None, pressure=0.0):
+def generate_vasp_params(structure, settings, type=None, pressure=0.0, parent_folder=None, write_restart=False,
+                         restart_wavefunctions=True):
     """
     Generate the input paramemeters needed to run a calculation for VASP
 
     :param structure:  StructureData object containing the crystal structure
     :param settings:  ParametersData object containing a dictionary with the INCAR parameters
+    :param parent_folder: RemoteData object of a previous calculation. If set, start from its WAVECAR and CHGCAR
+    :param write_restart: If True, write WAVECAR and CHGCAR to restart other calculations
+    :param restart_wavefunctions: If False, start only from the CHGCAR of parent_folder (different cell)
     :return: Calculation process object, input dictionary
     """
     try:
@@ -285,6 +319,32 @@ def generate_vasp_params(structure, settings, type=None, pressure=0.0):
             'ADDGRID': '.TRUE.',
             'LREAL': '.FALSE.'})
 
+    if type == 'forces' and settings.get_dict().get('minimal_io', False):
+        # Only the final forces are needed: write and parse the minimum
+        incar.update({
+            'LVTOT': '.FALSE.',
+            'LVHAR': '.FALSE.',
+            'LELF': '.FALSE.'})
+        # The parser settings are merged into the calculation settings ('settings' entry of es_settings)
+        calculation_settings = dict(settings.get_dict().get('settings', {}))
+        parser_settings = dict(calculation_settings.get('parser_settings', {}))
+        parser_settings.update({'add_forces': True,
+                                'add_trajectory': False,
+                                'add_structure': False,
+                                'add_bands': False,
+                                'add_dos': False,
+                                'add_kpoints': False})
+        calculation_settings['parser_settings'] = parser_settings
+        inputs.settings = ParameterData(dict=calculation_settings)
+
+    incar.update(get_vasp_restart_parameters(type,
+                                             restart=parent_folder is not None,
+                                             write_restart=write_restart,
+                                             restart_wavefunctions=restart_wavefunctions))
+
+    if parent_folder is not None:
+        inputs.restart_folder = parent_folder
+
     inputs.parameters = ParameterData(dict=incar)
 
     # POTCAR (pseudo potentials)
@@ -300,21 +360,26 @@ def generate_vasp_params(structure, settings, type=None, pressure=0.0):
     return VaspCalculation.process(), inputs
 
 
-def generate_inputs(structure, es_settings, type=None, pressure=0.0, machine=None):
+def generate_inputs(structure, es_settings, type=None, pressure=0.0, machine=None, parent_folder=None,
+                    write_restart=False, restart_wavefunctions=True):
 
     try:
         plugin = Code.get_from_string(es_settings.dict.code[type]).get_attr('input_plugin')
     except:
         plugin = Code.get_from_string(es_settings.dict.code).get_attr('input_plugin')
 
+    restart_options = {'parent_folder': parent_folder,
+                       'write_restart': write_restart,
+                       'restart_wavefunctions': restart_wavefunctions}
+
     if plugin in ['vasp.vasp']:
-        return generate_vasp_params(structure, es_settings, type=type, pressure=pressure)
+        return generate_vasp_params(structure, es_settings, type=type, pressure=pressure, **restart_options)
 
     elif plugin in ['quantumespresso.pw']:
-        return generate_qe_params(structure, es_settings, type=type, pressure=pressure)
+        return generate_qe_params(structure, es_settings, type=type, pressure=pressure, **restart_options)
 
     elif plugin in ['lammps.force', 'lammps.optimize', 'lammps.md']:
-        return generate_lammps_params(structure, es_settings, type=type, pressure=pressure)
+        return generate_lammps_params(structure, es_settings, type=type, pressure=pressure, **restart_options)
     else:
         print ('No supported plugin')
         exit()
@@ -0,0 +1,134 @@
+# This file implements a pool of worker processes used to run the numerical parts (phonopy/phono3py) of the local
+# workfunctions outside the daemon process. The workfunctions prepare plain python/numpy data from the nodes, send
+# it to a pure function (that does not access the database) using run_local() (or map_local() to run independent
+# tasks in parallel) and store the results as nodes, so the provenance is recorded as usual. The pool is configured
+# with environment variables:
+#
+#     AIIDA_PHONOPY_WORKERS: number of worker processes (default: 0, run in the calling process)
+#     AIIDA_PHONOPY_WORKER_MEMORY: maximum memory (address space) of each worker process in MB (default: no limit)
+#
+# The workers are started with the 'spawn' method (a new interpreter that imports this module), never forked from the
+# daemon: a forked worker would inherit the database connections, threads and event loop state of the daemon. Python 2
+# only forks, so there the workers are not used (with a warning) and the functions run in the calling process.
+# The memory of each worker is bounded by AIIDA_PHONOPY_WORKER_MEMORY (a task that exceeds it fails with MemoryError
+# without killing the worker) and the memory freed after each task is returned to the system.
+# run_local() waits for the result, so the workchains launch the workfunctions that use it with async() and
+# collect their outputs in a later step (see ToContext), instead of calling them from a step.
+
+import os
+
+WORKERS_ENV = 'AIIDA_PHONOPY_WORKERS'
+WORKER_MEMORY_ENV = 'AIIDA_PHONOPY_WORKER_MEMORY'
+
+_pool = None
+
+
+def get_context():
+    """
+    Return the multiprocessing context used to start the workers ('spawn'), None if it is not available (Python 2)
+    """
+    import multiprocessing
+
+    try:
+        return multiprocessing.get_context('spawn')
+    except AttributeError:
+        return None
+
+
+def get_number_of_workers():
+    workers = int(os.environ.get(WORKERS_ENV, 0))
+
+    if workers > 0 and get_context() is None:
+        import warnings
+        warnings.warn('{} is ignored: worker processes can only be forked from the daemon in this python version, '
+                      'the local calculations run in the calling process'.format(WORKERS_ENV))
+        return 0
+    return workers
+
+
+def get_worker_memory():
+    memory = os.environ.get(WORKER_MEMORY_ENV)
+    if memory is None:
+        return None
+    return int(memory)
+
+
+def _initialize_worker(memory):
+    """
+    Set the memory limit of the worker process
+
+    :param memory: maximum address space in MB (None for no limit)
+    """
+    if memory is not None:
+        import resource
+        limit = memory * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+
+def _release_memory():
+    """
+    Free the unreachable objects and return the free memory of the heap to the system (glibc only)
+    """
+    import gc
+    gc.collect()
+
+    try:
+        import ctypes
+        ctypes.CDLL('libc.so.6').malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+
+
+def _run_task(function, args, kwargs):
+    """
+    Run a task in a worker process and release the memory used by it
+    """
+    try:
+        return function(*args, **kwargs)
+    finally:
+        _release_memory()
+
+
+def get_pool():
+    """
+    Return the pool of worker processes (started with the 'spawn' method the first time it is used)
+    """
+    global _pool
+
+    if _pool is None:
+        _pool = get_context().Pool(processes=get_number_of_workers(),
+                                   initializer=_initialize_worker,
+                                   initargs=(get_worker_memory(),))
+    return _pool
+
+
+def run_local(function, *args, **kwargs):
+    """
+    Run a function in a worker process and return its result (waits until it is finished). If no workers
+    are configured the function is run in the calling process.
+
+    :param function: module level function that only uses plain python/numpy data (arguments and result must be picklable)
+    :return: result of the function
+    """
+    if get_number_of_workers() < 1:
+        return function(*args, **kwargs)
+
+    return get_pool().apply_async(_run_task, (function, args, kwargs)).get()
+
+
+def map_local(function, arguments_list):
+    """
+    Run a function for each set of arguments in the worker processes (in parallel) and return the results
+    in the same order. If no workers are configured the function is run in the calling process.
+    Must be called from the calling process (worker processes cannot create other workers).
+
+    :param function: module level function that only uses plain python/numpy data (arguments and result must be picklable)
+    :param arguments_list: list of tuples with the positional arguments of each call
+    :return: list of results
+    """
+    if get_number_of_workers() < 1:
+        return [function(*arguments) for arguments in arguments_list]
+
+    pool = get_pool()
+    results = [pool.apply_async(_run_task, (function, arguments, {})) for arguments in arguments_list]
+    return [result.get() for result in results]
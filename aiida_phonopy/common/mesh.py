@@ -0,0 +1,279 @@
+# This file implements the evaluation of the phonon frequencies of a q-points mesh split in blocks of q-points that
+# are calculated in parallel in the worker processes (see local_executor.py). The q-points of the mesh are generated
+# as in phonopy (GridPoints), each block is calculated with phonopy (same dynamical matrix and diagonalization as
+# the serial mesh) and the results are collected in a MeshFrequencies object that provides the interface of the
+# phonopy Mesh class used by TotalDos, PartialDos and ThermalProperties. All functions use plain python/numpy data.
+# get_converged_mesh() selects the coarsest mesh at which the thermal properties are converged (mesh_tolerance).
+
+import numpy as np
+
+from aiida_phonopy.common.phonopy_session import get_phonopy_from_data
+from aiida_phonopy.common.local_executor import run_local, map_local
+
+
+class MeshFrequencies(object):
+    """
+    Phonon frequencies (and eigenvectors) of a q-points mesh with the interface of the phonopy Mesh object
+    """
+
+    def __init__(self, dynamical_matrix, mesh, qpoints, weights, grid_address, ir_grid_points,
+                 grid_mapping_table, frequencies, eigenvectors=None):
+        self._dynamical_matrix = dynamical_matrix
+        self._mesh = None if mesh is None else np.array(mesh, dtype='intc')
+        self._qpoints = qpoints
+        self._weights = weights
+        self._grid_address = grid_address
+        self._ir_grid_points = ir_grid_points
+        self._grid_mapping_table = grid_mapping_table
+        self._frequencies = frequencies
+        self._eigenvectors = eigenvectors
+
+    def get_dynamical_matrix(self):
+        return self._dynamical_matrix
+
+    def get_mesh_numbers(self):
+        return self._mesh
+
+    def get_qpoints(self):
+        return self._qpoints
+
+    def get_weights(self):
+        return self._weights
+
+    def get_grid_address(self):
+        return self._grid_address
+
+    def get_ir_grid_points(self):
+        return self._ir_grid_points
+
+    def get_grid_mapping_table(self):
+        return self._grid_mapping_table
+
+    def get_frequencies(self):
+        return self._frequencies
+
+    def get_eigenvectors(self):
+        return self._eigenvectors
+
+    # Attribute interface of the Mesh object in newer phonopy versions
+
+    dynamical_matrix = property(get_dynamical_matrix)
+    mesh_numbers = property(get_mesh_numbers)
+    qpoints = property(get_qpoints)
+    weights = property(get_weights)
+    grid_address = property(get_grid_address)
+    ir_grid_points = property(get_ir_grid_points)
+    grid_mapping_table = property(get_grid_mapping_table)
+    frequencies = property(get_frequencies)
+    eigenvectors = property(get_eigenvectors)
+
+
+def get_mesh_grid(unitcell, settings, mesh, is_mesh_symmetry=True):
+    """
+    Return the q-points of a mesh as generated by phonopy (Phonopy.set_mesh with default shift)
+
+    :param unitcell: dictionary with the unit cell (see phonopy_session.get_unitcell_data)
+    :param settings: dictionary with the phonopy settings (see phonopy_session.get_phonopy_settings)
+    :param mesh: q-points mesh
+    :param is_mesh_symmetry: if True only the irreducible q-points are returned
+    :return: dictionary {'mesh', 'qpoints', 'weights', 'grid_address', 'ir_grid_points', 'grid_mapping_table'}
+    """
+    from phonopy.structure.grid_points import GridPoints
+
+    phonon = get_phonopy_from_data(unitcell, settings)
+
+    grid = GridPoints(np.array(mesh, dtype='intc'),
+                      np.linalg.inv(phonon.get_primitive().get_cell()),
+                      is_gamma_center=False,
+                      is_time_reversal=is_mesh_symmetry,
+                      rotations=phonon.get_primitive_symmetry().get_pointgroup_operations(),
+                      is_mesh_symmetry=is_mesh_symmetry)
+
+    return {'mesh': list(mesh),
+            'qpoints': grid.get_ir_qpoints(),
+            'weights': grid.get_ir_grid_weights(),
+            'grid_address': grid.get_grid_address(),
+            'ir_grid_points': grid.get_ir_grid_points(),
+            'grid_mapping_table': grid.get_grid_mapping_table()}
+
+
+def calculate_qpoints_frequencies(unitcell, settings, force_constants, qpoints, nac_parameters=None,
+                                  is_eigenvectors=False):
+    """
+    Calculate the phonon frequencies (and eigenvectors) of a block of q-points
+    (run in a worker process, see local_executor.py)
+
+    :param unitcell: dictionary with the unit cell (see phonopy_session.get_unitcell_data)
+    :param settings: dictionary with the phonopy settings (see phonopy_session.get_phonopy_settings)
+    :param force_constants: numpy array with the force constants
+    :param qpoints: q-points [Nq x 3] in reduced coordinates
+    :param nac_parameters: dictionary with the non-analytical corrections in phonopy format
+    :param is_eigenvectors: if True the eigenvectors are also calculated
+    :return: frequencies [Nq x Nbands], eigenvectors [Nq x Nbands x Nbands] (None if not calculated)
+    """
+    phonon = get_phonopy_from_data(unitcell, settings)
+    phonon.set_force_constants(force_constants)
+
+    if nac_parameters is not None:
+        phonon.set_nac_params(nac_parameters)
+
+    phonon.set_qpoints_phonon(qpoints, is_eigenvectors=is_eigenvectors)
+    return phonon.get_qpoints_phonon()
+
+
+def get_mesh_frequencies(unitcell, settings, mesh, force_constants, n_blocks, nac_parameters=None,
+                         is_eigenvectors=False, is_mesh_symmetry=True):
+    """
+    Calculate the phonon frequencies of a q-points mesh splitting the q-points in blocks that are
+    calculated in parallel in the worker processes
+
+    :param unitcell: dictionary with the unit cell (see phonopy_session.get_unitcell_data)
+    :param settings: dictionary with the phonopy settings (see phonopy_session.get_phonopy_settings)
+    :param mesh: q-points mesh
+    :param force_constants: numpy array with the force constants
+    :param n_blocks: number of blocks of q-points
+    :param nac_parameters: dictionary with the non-analytical corrections in phonopy format
+    :param is_eigenvectors: if True the eigenvectors are also calculated
+    :param is_mesh_symmetry: if True only the irreducible q-points are calculated
+    :return: dictionary with the q-points mesh data (see get_mesh_grid), frequencies and eigenvectors
+    """
+    grid = run_local(get_mesh_grid, unitcell, settings, mesh, is_mesh_symmetry=is_mesh_symmetry)
+
+    blocks = np.array_split(np.arange(len(grid['qpoints'])), max(1, min(n_blocks, len(grid['qpoints']))))
+    results = map_local(calculate_qpoints_frequencies,
+                        [(unitcell, settings, force_constants, grid['qpoints'][block], nac_parameters, is_eigenvectors)
+                         for block in blocks])
+
+    grid['frequencies'] = np.concatenate([frequencies for frequencies, _ in results])
+    if is_eigenvectors:
+        grid['eigenvectors'] = np.concatenate([eigenvectors for _, eigenvectors in results])
+    else:
+        grid['eigenvectors'] = None
+
+    return grid
+
+
+def get_mesh_sequence(mesh, scale=1.5):
+    """
+    Return a sequence of increasingly dense q-points meshes from a coarse mesh (1/4 of the density
+    in each direction) up to mesh
+
+    :param mesh: densest q-points mesh
+    :param scale: increase of the number of q-points in each direction between consecutive meshes
+    :return: list of meshes
+    """
+    mesh = np.array(mesh, dtype=int)
+    meshes = [np.maximum(1, (mesh + 3) // 4)]
+    while np.any(meshes[-1] < mesh):
+        meshes.append(np.minimum(mesh, np.maximum(meshes[-1] + 1, np.ceil(meshes[-1] * scale).astype(int))))
+
+    return [current_mesh.tolist() for current_mesh in meshes]
+
+
+def get_converged_mesh(thermal_properties, mesh, tolerance):
+    """
+    Return the coarsest q-points mesh (up to mesh) at which the thermal properties (free energy, entropy and
+    heat capacity) change less than tolerance (relative to their maximum value) with respect to the previous mesh.
+    All meshes use the same dynamical matrix (force constants).
+
+    :param thermal_properties: function that returns the phonopy thermal properties (temperature, free energy,
+                               entropy and heat capacity) calculated with a given q-points mesh
+    :param mesh: densest q-points mesh
+    :param tolerance: relative tolerance
+    :return: q-points mesh
+    """
+    previous = None
+    for current_mesh in get_mesh_sequence(mesh):
+        properties = np.array(thermal_properties(current_mesh)[1:])
+
+        if previous is not None:
+            scale = np.max(np.abs(properties), axis=1)
+            scale[scale == 0] = 1.0
+            change = np.max(np.abs(properties - previous), axis=1) / scale
+            if np.all(change < tolerance):
+                return current_mesh
+
+        previous = properties
+
+    return list(mesh)
+
+
+def get_mesh_thermal_properties(mesh_object):
+    """
+    Return the thermal properties from the frequencies of a q-points mesh (as Phonopy.set_thermal_properties)
+
+    :param mesh_object: MeshFrequencies (or phonopy Mesh) object
+    :return: temperatures, free energy, entropy, heat capacity (per primitive cell)
+    """
+    from phonopy.phonon.thermal_properties import ThermalProperties
+
+    # Older phonopy versions take the frequencies and weights, newer versions take the mesh object
+    try:
+        thermal_properties = ThermalProperties(mesh_object.get_frequencies(), weights=mesh_object.get_weights())
+    except TypeError:
+        thermal_properties = ThermalProperties(mesh_object)
+
+    thermal_properties.set_temperature_range(t_step=10, t_max=1000, t_min=0)
+    thermal_properties.run()
+
+    return thermal_properties.get_thermal_properties()
+
+
+def get_thermal_properties_from_frequencies(frequencies, weights, dynamical_matrix=None):
+    """
+    Return the thermal properties from the frequencies at the (irreducible) q-points of a mesh
+
+    :param frequencies: frequencies [Nqpoints x Nbands]
+    :param weights: weights of the q-points
+    :param dynamical_matrix: phonopy DynamicalMatrix object (needed by newer phonopy versions)
+    :return: temperatures, free energy, entropy, heat capacity (per primitive cell)
+    """
+    mesh_object = MeshFrequencies(dynamical_matrix, None, None, np.array(weights), None, None, None,
+                                  np.array(frequencies))
+
+    return get_mesh_thermal_properties(mesh_object)
+
+
+def _get_tetrahedron_dos(dos_class, mesh_object):
+    """
+    Return a TotalDos or PartialDos object that uses the tetrahedron method
+    """
+    # Older phonopy versions take tetrahedron_method, newer versions take use_tetrahedron_method
+    try:
+        return dos_class(mesh_object, tetrahedron_method=True)
+    except TypeError:
+        return dos_class(mesh_object, use_tetrahedron_method=True)
+
+
+def get_total_dos(mesh_object):
+    """
+    Return the total DOS from the frequencies of a q-points mesh using the tetrahedron method
+    (as Phonopy.set_total_DOS)
+
+    :param mesh_object: MeshFrequencies (or phonopy Mesh) object
+    :return: frequencies, total DOS
+    """
+    from phonopy.phonon.dos import TotalDos
+
+    total_dos = _get_tetrahedron_dos(TotalDos, mesh_object)
+    total_dos.set_draw_area(None, None, None)
+    total_dos.run()
+
+    return total_dos.get_dos()
+
+
+def get_partial_dos(mesh_object):
+    """
+    Return the partial DOS from the frequencies and eigenvectors of a (full) q-points mesh using the
+    tetrahedron method (as Phonopy.set_partial_DOS)
+
+    :param mesh_object: MeshFrequencies (or phonopy Mesh) object with eigenvectors
+    :return: frequencies, partial DOS
+    """
+    from phonopy.phonon.dos import PartialDos
+
+    partial_dos = _get_tetrahedron_dos(PartialDos, mesh_object)
+    partial_dos.set_draw_area(None, None, None)
+    partial_dos.run()
+
+    return partial_dos.get_partial_dos()
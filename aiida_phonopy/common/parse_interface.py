@@ -2,9 +2,16 @@ from aiida.orm import load_node, DataFactory
 from aiida.work.workfunction import workfunction
 from aiida.orm.data.base import Str, Float, Bool, Int
 
+from aiida_phonopy.common.structure import get_structure_from_arrays
+from aiida_phonopy.common.forces import get_trajectory_frame, get_number_of_frames, aggregate_forces
+
 StructureData = DataFactory('structure')
 ParameterData = DataFactory('parameter')
 
+# Extras used to store the pks of the parsed outputs of an optimization calculation (see parse_optimize_calculation)
+PARSED_STRUCTURE_EXTRA = 'phonopy_parsed_structure'
+PARSED_DATA_EXTRA = 'phonopy_parsed_data'
+
 @workfunction
 def structure_from_trajectory(output_trajectory, pos):
     """
@@ -17,41 +24,145 @@ def structure_from_trajectory(output_trajectory, pos):
     pos = int(pos)
 
     # Check maximum
-    num_structures = len(output_trajectory.get_array('positions'))
-    pos = max(pos, num_structures)
+    num_structures = get_number_of_frames(output_trajectory, 'positions')
+    pos = min(max(pos, -num_structures), num_structures - 1)
 
-    positions = output_trajectory.get_array('positions')[pos]
+    positions = get_trajectory_frame(output_trajectory, 'positions', pos)
     symbols = output_trajectory.get_array('symbols')
-    cell = output_trajectory.get_array('cells')[pos]
+    cell = get_trajectory_frame(output_trajectory, 'cells', pos)
 
-    structure = StructureData(cell=cell.tolist())
-    for i, scaled_position in enumerate(positions):
-        structure.append_atom(position=scaled_position.tolist(),
-                              symbols=symbols[i])
+    structure = get_structure_from_arrays(cell, positions, symbols)
     return {'structure': structure}
 
 
+# Names of the output links that may contain the forces of a calculation for each plugin (in order of preference)
+FORCES_LINK_NAMES = {'vasp.vasp': ['output_forces', 'output_trajectory'],
+                     'quantumespresso.pw': ['output_trajectory'],
+                     'lammps.force': ['output_array']}
+
+DEFAULT_FORCES_LINK_NAMES = ['output_forces', 'output_trajectory', 'output_array']
+
+
+def get_forces_link_names(calc):
+    """
+    Return the names of the output links that may contain the forces of a calculation according to its plugin
+    """
+    plugin = calc.get_code().get_attr('input_plugin')
+    return FORCES_LINK_NAMES.get(plugin, DEFAULT_FORCES_LINK_NAMES)
+
+
+def get_forces_node(calc):
+    """
+    Return the output node of a forces calculation that contains the 'forces' array
+    (output_forces if minimal_io is used, otherwise output_trajectory or output_array depending on the plugin)
+
+    :param calc: calculation node
+    :return: ArrayData object
+    """
+    outputs = calc.get_outputs_dict()
+    for link_name in get_forces_link_names(calc):
+        if link_name in outputs:
+            return outputs[link_name]
+
+    raise Exception('No forces found in calculation {}'.format(calc.pk))
+
+
+def get_forces_nodes(calcs):
+    """
+    Return the output nodes that contain the 'forces' array of a list of forces calculations using a single
+    database query. All calculations are expected to use the same code (the link names are resolved from the first one)
+
+    :param calcs: list of calculation nodes
+    :return: list of ArrayData objects (in the same order as calcs)
+    """
+    from aiida.orm.querybuilder import QueryBuilder
+    from aiida.orm.calculation.job import JobCalculation
+    from aiida.orm.data.array import ArrayData
+
+    if len(calcs) == 0:
+        return []
+
+    link_names = get_forces_link_names(calcs[0])
+
+    qb = QueryBuilder()
+    qb.append(JobCalculation, filters={'id': {'in': [calc.pk for calc in calcs]}}, project=['id'], tag='calc')
+    qb.append(ArrayData, output_of='calc', edge_filters={'label': {'in': link_names}},
+              edge_project=['label'], edge_tag='link', project=['*'], tag='forces')
+
+    outputs = {}
+    for row in qb.iterdict():
+        outputs.setdefault(row['calc']['id'], {})[row['link']['label']] = row['forces']['*']
+
+    forces_nodes = []
+    for calc in calcs:
+        calc_outputs = outputs.get(calc.pk, {})
+        for link_name in link_names:
+            if link_name in calc_outputs:
+                forces_nodes.append(calc_outputs[link_name])
+                break
+        else:
+            raise Exception('No forces found in calculation {}'.format(calc.pk))
+
+    return forces_nodes
+
+
+def get_aggregated_forces(calcs):
+    """
+    Collect the final atomic forces of a list of forces calculations in a single stored ArrayData object.
+    The forces nodes are found with a single query (see get_forces_nodes) and, instead of being linked one by one,
+    they are kept in a group (see common/forces.py aggregate_forces)
+
+    :param calcs: list of calculation nodes
+    :return: ArrayData object with 'forces' array [Ncalculations x Natoms x 3]
+    """
+    from aiida.orm.group import Group
+
+    return aggregate_forces(get_forces_nodes(calcs), DataFactory('array'), Group)
+
+
 def parse_optimize_calculation(calc):
     """
     Parse ths information from plugins nodes and set common units
     Stress in kB
     Force in eV/Angstrom
+
+    The parsed outputs are stored and their pks are kept as extras of the calculation node, so each
+    calculation is parsed only once and later calls return the same nodes.
     """
 
+    extras = calc.get_extras()
+    if PARSED_STRUCTURE_EXTRA in extras and PARSED_DATA_EXTRA in extras:
+        return {'output_structure': load_node(extras[PARSED_STRUCTURE_EXTRA]),
+                'output_data': load_node(extras[PARSED_DATA_EXTRA])}
+
+    parsed = _parse_optimize_calculation(calc)
+
+    for node in parsed.values():
+        if not node.is_stored:
+            node.store()
+
+    calc.set_extra(PARSED_STRUCTURE_EXTRA, parsed['output_structure'].pk)
+    calc.set_extra(PARSED_DATA_EXTRA, parsed['output_data'].pk)
+
+    return parsed
+
+
+def _parse_optimize_calculation(calc):
+
     import numpy as np
 
     plugin = calc.get_code().get_attr('input_plugin')
 
     if plugin == 'vasp.vasp':
-        forces = calc.out.output_trajectory.get_array('forces')[-1]
-        stress = calc.out.output_trajectory.get_array('stress')[-1]
+        forces = get_trajectory_frame(calc.out.output_trajectory, 'forces')
+        stress = get_trajectory_frame(calc.out.output_trajectory, 'stress')
 
         try:
             structure = calc.out.output_structure
         except:
             structure = structure_from_trajectory(calc.out.output_trajectory, Int(-1))['structure']
 
-        energy_wo_entrop = calc.out.output_trajectory.get_array('e_wo_entrp')[-1]
+        energy_wo_entrop = get_trajectory_frame(calc.out.output_trajectory, 'e_wo_entrp')
         pressure = np.average(np.diag(stress))
         factor = 0.0006241509125883258  # kBar * A^3 -> eV
         energy = energy_wo_entrop - structure.get_cell_volume() * pressure * factor
@@ -63,8 +174,8 @@ def parse_optimize_calculation(calc):
         energy = calc.out.output_parameters.dict.energy
 
     elif plugin == 'quantumespresso.pw':
-        forces = calc.out.output_trajectory.get_array('forces')[-1]
-        stress = calc.out.output_trajectory.get_array('stress')[-1] * 10 # GPa to kBar
+        forces = get_trajectory_frame(calc.out.output_trajectory, 'forces')
+        stress = get_trajectory_frame(calc.out.output_trajectory, 'stress') * 10 # GPa to kBar
         energy = calc.out.output_parameters.dict.energy
 
         try:
@@ -73,7 +184,7 @@ def parse_optimize_calculation(calc):
             structure = structure_from_trajectory(calc.out.output_trajectory, Int(-1))['structure']
 
     else:
-        return Exception('Not supported plugin')
+        raise Exception('Not supported plugin')
 
     output_data = ParameterData(dict={'energy': energy,
                                       'forces': forces.tolist(),
@@ -0,0 +1,63 @@
+# This file builds the Phonopy objects of the workfunctions from plain python data (unit cell and phonopy settings),
+# so the same function can be used in the daemon and in the worker processes (see local_executor.py). A new object
+# is created in each call: phonopy cannot rebuild an object without repeating the symmetry analysis, and an object
+# cached in memory would only be reused within a single process (not across daemon workers, restarts or pool processes).
+
+from aiida_phonopy.common.structure import get_structure_arrays
+
+
+def get_unitcell_data(structure):
+    """
+    Return the unit cell of a StructureData object as plain python data (that can be sent to other processes)
+
+    :param structure: StructureData object
+    :return: dictionary {'cell', 'positions', 'symbols'}
+    """
+    cell, positions, symbols = get_structure_arrays(structure)
+
+    return {'cell': cell.tolist(),
+            'positions': positions.tolist(),
+            'symbols': symbols}
+
+
+def get_phonopy_settings(ph_settings):
+    """
+    Return the settings needed to create a Phonopy object as plain python data
+
+    :param ph_settings: ParameterData object with the phonopy settings
+    :return: dictionary {'supercell', 'primitive', 'symmetry_precision'}
+    """
+    return {'supercell': ph_settings.dict.supercell,
+            'primitive': ph_settings.dict.primitive,
+            'symmetry_precision': ph_settings.dict.symmetry_precision}
+
+
+def get_phonopy_from_data(unitcell, settings):
+    """
+    Return a Phonopy object (without displacements, force constants or other properties set) from plain data.
+    This function does not need the database, so it can be used in worker processes (see local_executor.py)
+
+    :param unitcell: dictionary with the unit cell (see get_unitcell_data)
+    :param settings: dictionary with the phonopy settings (see get_phonopy_settings)
+    :return: Phonopy object
+    """
+    from phonopy import Phonopy
+    from phonopy.structure.atoms import Atoms as PhonopyAtoms
+
+    return Phonopy(PhonopyAtoms(symbols=unitcell['symbols'],
+                                positions=unitcell['positions'],
+                                cell=unitcell['cell']),
+                   supercell_matrix=settings['supercell'],
+                   primitive_matrix=settings['primitive'],
+                   symprec=settings['symmetry_precision'])
+
+
+def get_phonopy(structure, ph_settings):
+    """
+    Return a Phonopy object (without displacements, force constants or other properties set) of a structure
+
+    :param structure: StructureData object with the unit cell
+    :param ph_settings: ParameterData object with the phonopy settings (supercell, primitive, symmetry_precision)
+    :return: Phonopy object
+    """
+    return get_phonopy_from_data(get_unitcell_data(structure), get_phonopy_settings(ph_settings))
@@ -0,0 +1,194 @@
+# This file implements the prediction of the force constants and thermal properties at several volumes from the mode
+# Gruneisen parameters (see GruneisenPhonopy). The phonon frequencies at the commensurate q-points are renormalized to
+# each volume and transformed back to force constants, then the thermal properties of each volume are calculated on
+# the same irreducible q-points mesh. All functions use plain python/numpy data, so they can run in the worker
+# processes (see local_executor.py).
+
+import numpy as np
+
+from aiida_phonopy.common.phonopy_session import get_phonopy_from_data
+from aiida_phonopy.common.local_executor import run_local, map_local, get_number_of_workers
+from aiida_phonopy.common.mesh import get_mesh_grid, get_thermal_properties_from_frequencies
+
+
+def get_phonon(unitcell, settings, force_constants=None, nac_parameters=None):
+
+    phonon = get_phonopy_from_data(unitcell, settings)
+
+    if force_constants is not None:
+        phonon.set_force_constants(force_constants)
+
+    if nac_parameters is not None:
+            phonon.set_nac_params(nac_parameters)
+
+    return phonon
+
+
+def get_commensurate(unitcell, settings):
+    from phonopy.harmonic.dynmat_to_fc import DynmatToForceConstants
+
+    phonon = get_phonopy_from_data(unitcell, settings)
+
+    primitive = phonon.get_primitive()
+    supercell = phonon.get_supercell()
+
+    dynmat2fc = DynmatToForceConstants(primitive, supercell)
+    commensurate = dynmat2fc.get_commensurate_points()
+
+    return dynmat2fc, commensurate
+
+
+def get_renormalized_frequencies(unitcell, settings, force_constants, gruneisen, commensurate, volumes):
+    """
+    Return the phonon frequencies at the commensurate q-points renormalized to each volume using the
+    mode Gruneisen parameters (run in a worker process, see local_executor.py)
+
+    :return: dictionary with the renormalized frequencies [Nvolumes x Nqpoints x Nbands], the eigenvectors and
+             the primitive cell and supercell (phonopy objects) needed to obtain the force constants
+    """
+    phonon = get_phonon(unitcell, settings, force_constants=force_constants)
+
+    phonon.set_qpoints_phonon(commensurate,
+                              is_eigenvectors=True)
+    frequencies, eigenvectors = phonon.get_qpoints_phonon()
+
+    volume_ref = phonon.get_unitcell().get_volume()
+
+    # All volumes at once [Nvolumes x Nqpoints x Nbands]
+    log_ratios = np.log(np.array(volumes, dtype=float) / volume_ref)
+    renormalized_frequencies = (np.array(frequencies)[None, :, :] *
+                                np.exp(-np.array(gruneisen)[None, :, :] * log_ratios[:, None, None]))
+
+    # Fixing Gamma point data
+    renormalized_frequencies[:, 0, 0:3] = 0.0
+
+    return {'frequencies': renormalized_frequencies,
+            'eigenvectors': eigenvectors,
+            'primitive': phonon.get_primitive(),
+            'supercell': phonon.get_supercell()}
+
+
+def set_dynamical_matrices(dynmat2fc, eigenvalues, eigenvectors):
+    """
+    Set the dynamical matrices at the commensurate q-points of a DynmatToForceConstants object from its eigenvalues
+    and eigenvectors
+
+    :param dynmat2fc: phonopy DynmatToForceConstants object
+    """
+    # Newer phonopy versions build the matrices in create_dynamical_matrices (set_dynamical_matrices takes them)
+    if hasattr(dynmat2fc, 'create_dynamical_matrices'):
+        dynmat2fc.create_dynamical_matrices(eigenvalues, eigenvectors)
+    else:
+        dynmat2fc.set_dynamical_matrices(eigenvalues, eigenvectors)
+
+
+def get_force_constants_from_frequencies(primitive, supercell, frequencies, eigenvectors):
+    """
+    Return the force constants that reproduce the frequencies and eigenvectors at the commensurate q-points
+    (run in a worker process, see local_executor.py)
+
+    :param primitive: phonopy primitive cell
+    :param supercell: phonopy supercell
+    :param frequencies: frequencies (THz) at the commensurate q-points [Nqpoints x Nbands]
+    :param eigenvectors: eigenvectors at the commensurate q-points
+    :return: numpy array with the force constants
+    """
+    from phonopy.harmonic.dynmat_to_fc import DynmatToForceConstants
+    from phonopy.units import VaspToTHz
+
+    dynmat2fc = DynmatToForceConstants(primitive, supercell)
+    set_dynamical_matrices(dynmat2fc, frequencies / VaspToTHz, eigenvectors)
+    dynmat2fc.run()
+
+    return np.array(dynmat2fc.get_force_constants())
+
+
+def get_force_constants(unitcell, settings, force_constants, gruneisen, commensurate, volumes):
+    """
+    Return the force constants at each volume obtained renormalizing the phonon frequencies at the commensurate
+    q-points. The force constants of the different volumes are calculated in parallel in the worker processes
+    (this function must be run in the calling process)
+
+    :return: list of numpy arrays with the force constants
+    """
+    renormalized = run_local(get_renormalized_frequencies,
+                             unitcell, settings, force_constants, gruneisen, commensurate, volumes)
+
+    return map_local(get_force_constants_from_frequencies,
+                     [(renormalized['primitive'], renormalized['supercell'], frequencies, renormalized['eigenvectors'])
+                      for frequencies in renormalized['frequencies']])
+
+
+def calculate_thermal_properties_at_volumes(unitcell, settings, qpoints, weights, force_constants_list):
+    """
+    Calculate the thermal properties for several sets of force constants (volumes) of the same structure.
+    The Phonopy object is created once and only the force constants are changed
+    (run in a worker process, see local_executor.py)
+
+    :param qpoints: irreducible q-points of the mesh (see common/mesh.get_mesh_grid)
+    :param weights: weights of the q-points
+    :param force_constants_list: list of numpy arrays with the force constants
+    :return: list of (free energy, entropy, heat capacity) per unit cell at each volume, temperatures
+    """
+    phonon = get_phonopy_from_data(unitcell, settings)
+
+    # Normalization factor primitive to unit cell
+    normalization_factor = phonon.unitcell.get_number_of_atoms()/phonon.primitive.get_number_of_atoms()
+
+    properties = []
+    temperature = None
+    for fc in force_constants_list:
+        phonon.set_force_constants(fc)
+        # Only frequencies are needed for thermal properties (irreducible q-points mesh)
+        phonon.set_qpoints_phonon(qpoints, is_eigenvectors=False)
+        temperature, free_energy, entropy, cv = get_thermal_properties_from_frequencies(phonon.get_qpoints_phonon()[0],
+                                                                                        weights,
+                                                                                        phonon.get_dynamical_matrix())
+        properties.append((np.array(free_energy) * normalization_factor,
+                           np.array(entropy) * normalization_factor,
+                           np.array(cv) * normalization_factor))
+
+    return properties, temperature
+
+
+def get_thermal_properties(unitcell, settings, mesh, force_constants_list, parallel=False):
+    """
+    Calculate the thermal properties at each volume. The q-points mesh is generated once for all volumes
+    (this function must be run in the calling process)
+
+    :param force_constants_list: list of numpy arrays with the force constants (one per volume)
+    :param parallel: if True the volumes are split among the worker processes (see local_executor.py)
+    :return: free energy [Nvolumes x Ntemperatures], entropy and heat capacity [Ntemperatures x Nvolumes], temperatures
+    """
+    grid = run_local(get_mesh_grid, unitcell, settings, mesh, is_mesh_symmetry=True)
+
+    if parallel:
+        n_blocks = max(1, min(get_number_of_workers(), len(force_constants_list)))
+    else:
+        n_blocks = 1
+
+    blocks = np.array_split(np.arange(len(force_constants_list)), n_blocks)
+    results = map_local(calculate_thermal_properties_at_volumes,
+                        [(unitcell, settings, grid['qpoints'], grid['weights'],
+                          [force_constants_list[i] for i in block]) for block in blocks])
+
+    properties = [volume_properties for block_properties, _ in results for volume_properties in block_properties]
+    temperature = results[0][1]
+
+    free_energy_list, entropy_list, cv_list = [np.array(values) for values in zip(*properties)]
+
+    return free_energy_list, entropy_list.T, cv_list.T, temperature
+
+
+def calculate_qha_thermal_properties(unitcell, settings, mesh, force_constants, gruneisen, commensurate, volumes,
+                                     parallel_volumes=False):
+    """
+    Calculate the thermal properties at several volumes renormalizing the phonon frequencies using the
+    mode Gruneisen parameters (the calculations are run in the worker processes, see local_executor.py)
+
+    :param parallel_volumes: if True the thermal properties of the volumes are calculated in parallel
+    :return: free energy, entropy and heat capacity at each volume and temperature, temperatures
+    """
+    force_constants_list = get_force_constants(unitcell, settings, force_constants, gruneisen, commensurate, volumes)
+
+    return get_thermal_properties(unitcell, settings, mesh, force_constants_list, parallel=parallel_volumes)
@@ -2,6 +2,8 @@ from aiida.orm import DataFactory
 
 import numpy as np
 
+from aiida_phonopy.common.structure import get_phonopy_atoms
+
 ParameterData = DataFactory('parameter')
 ArrayData = DataFactory('array')
 
@@ -29,12 +31,9 @@ def parse_FORCE_CONSTANTS(filename):
 def parse_partial_DOS(filename, structure, parameters):
     partial_dos = np.loadtxt(filename)
 
-    from phonopy.structure.atoms import Atoms as PhonopyAtoms
     from phonopy import Phonopy
 
-    bulk = PhonopyAtoms(symbols=[site.kind_name for site in structure.sites],
-                        positions=[site.position for site in structure.sites],
-                        cell=structure.cell)
+    bulk = get_phonopy_atoms(structure)
 
     phonon = Phonopy(bulk,
                      supercell_matrix=parameters.dict.supercell,
@@ -104,7 +103,6 @@ def parse_band_structure(filename, input_bands):
 def get_BORN_txt(nac_data, symprec=1.e-5, parameters=None, structure=None):
     from phonopy.structure.cells import get_primitive, get_supercell
     from phonopy.structure.symmetry import Symmetry
-    from phonopy.structure.atoms import Atoms as PhonopyAtoms
 
     print ('inside born parameters')
 
@@ -112,9 +110,7 @@ def get_BORN_txt(nac_data, symprec=1.e-5, parameters=None, structure=None):
     epsilon = nac_data.get_array('epsilon')
     structure_born = nac_data.get_structure()
 
-    ucell = PhonopyAtoms(symbols=[site.kind_name for site in structure_born.sites],
-                         positions=[site.position for site in structure_born.sites],
-                         cell=structure_born.cell)
+    ucell = get_phonopy_atoms(structure_born)
 
     if structure is not None:
         pmat = parameters.dict.primitive
@@ -0,0 +1,67 @@
+# This file contains the input parameters used to start a calculation from the files (wave functions and charge
+# density) of a previous calculation (see generate_inputs.py). The wave functions can only be read if both
+# calculations use the same k-points: the calculations at fixed cell (forces, born charges) do not use symmetry,
+# since the supercells with displacements have a lower symmetry than the perfect supercell. When the cell changes
+# (e.g. between the cycles of a variable-cell optimization) only the charge density/potential is read.
+
+# Calculation types in which the cell of the structure changes
+OPTIMIZE_TYPES = ['optimize', 'optimize_constant_volume']
+
+
+def get_vasp_restart_parameters(type, restart=False, write_restart=False, restart_wavefunctions=True):
+    """
+    Return the INCAR parameters to write the restart files (WAVECAR, CHGCAR) and to start from them
+
+    :param type: calculation type (see generate_inputs)
+    :param restart: if True, the calculation starts from the files of a previous calculation
+    :param write_restart: if True, the files are written to restart other calculations
+    :param restart_wavefunctions: if False only the charge density is read (the previous calculation has a
+                                  different cell)
+    :return: dictionary with the INCAR parameters
+    """
+    parameters = {}
+
+    if write_restart:
+        parameters.update({'LWAVE': '.TRUE.',
+                           'LCHARG': '.TRUE.'})
+
+    if type not in OPTIMIZE_TYPES and (write_restart or restart):
+        parameters.update({'ISYM': 0})
+
+    if restart:
+        if restart_wavefunctions:
+            parameters.update({'ISTART': 1})
+            if type not in OPTIMIZE_TYPES:
+                parameters.update({'ICHARG': 1})
+        else:
+            parameters.update({'ISTART': 0,
+                               'ICHARG': 1})
+
+    return parameters
+
+
+def get_qe_restart_parameters(type, restart=False, write_restart=False, restart_wavefunctions=True):
+    """
+    Return the pw.x parameters to keep the restart files (wave functions and charge density) and to start from them
+
+    :param type: calculation type (see generate_inputs)
+    :param restart: if True, the calculation starts from the files of a previous calculation (parent_folder)
+    :param write_restart: if True, the files are kept to restart other calculations
+    :param restart_wavefunctions: if False only the potential is read (the previous calculation has a different
+                                  cell)
+    :return: dictionary {namelist: {parameter: value}}
+    """
+    parameters = {}
+
+    if write_restart:
+        parameters.setdefault('CONTROL', {}).update({'disk_io': 'low'})
+
+    if type not in OPTIMIZE_TYPES and (write_restart or restart):
+        parameters.setdefault('SYSTEM', {}).update({'nosym': True})
+
+    if restart:
+        parameters.setdefault('ELECTRONS', {}).update({'startingpot': 'file'})
+        if type not in OPTIMIZE_TYPES and restart_wavefunctions:
+            parameters['ELECTRONS'].update({'startingwfc': 'file'})
+
+    return parameters
@@ -0,0 +1,143 @@
+# This file contains functions to convert crystal structures between StructureData objects, arrays and phonopy
+# Atoms objects. Appending the atoms one by one to a StructureData object copies the list of sites at each step,
+# and each access to StructureData.sites creates a new Site object per atom, which is slow for large supercells.
+# Here the kinds and sites are built as lists and set at once, and read from the raw attributes in one pass.
+# The supercells with displacements are stored as the perfect supercell plus the displaced atoms of each supercell
+# (see DisplacedSupercellsData), get_displacement_arrays() and get_displaced_positions() convert between both forms.
+
+import numpy as np
+
+
+def get_structure_from_arrays(cell, positions, symbols):
+    """
+    Return a new (unstored) StructureData object from arrays. One kind is created for each chemical symbol
+    (named as the symbol) as in StructureData.append_atom
+
+    :param cell: lattice vectors in rows
+    :param positions: cartesian positions of the atoms [Natoms x 3]
+    :param symbols: chemical symbols of the atoms
+    :return: StructureData object
+    """
+    from aiida.orm import DataFactory
+    from aiida.orm.data.structure import Kind
+
+    StructureData = DataFactory('structure')
+
+    structure = StructureData(cell=np.array(cell, dtype=float).tolist())
+
+    symbols = [str(symbol) for symbol in symbols]
+    kind_names = sorted(set(symbols), key=symbols.index)
+
+    structure._set_attr('kinds', [Kind(symbols=name, name=name).get_raw() for name in kind_names])
+    structure._set_attr('sites', [{'position': tuple(position), 'kind_name': symbol}
+                                  for position, symbol in zip(np.array(positions, dtype=float).tolist(), symbols)])
+
+    return structure
+
+
+def get_structure_arrays(structure):
+    """
+    Return the cell, cartesian positions and kind names of the atoms of a StructureData object
+
+    :param structure: StructureData object
+    :return: lattice vectors in rows [3 x 3], positions [Natoms x 3] (numpy arrays), list of kind names
+    """
+    sites = structure.get_attr('sites', [])
+
+    positions = np.array([site['position'] for site in sites], dtype=float).reshape(-1, 3)
+    symbols = [site['kind_name'] for site in sites]
+
+    return np.array(structure.cell, dtype=float), positions, symbols
+
+
+def is_same_cell(structure, reference, tolerance=1e-5):
+    """
+    Return True if two structures have the same lattice vectors and number of atoms, so the wave functions
+    calculated for one of them can be used to start the calculation of the other (see common/restart.py)
+
+    :param structure: StructureData object
+    :param reference: StructureData object
+    :param tolerance: tolerance in Angstrom
+    """
+    if len(structure.get_attr('sites', [])) != len(reference.get_attr('sites', [])):
+        return False
+
+    return np.allclose(structure.cell, reference.cell, atol=tolerance)
+
+
+def get_phonopy_atoms(structure):
+    """
+    Return a phonopy Atoms object from a StructureData object (the kind names are used as chemical symbols)
+
+    :param structure: StructureData object
+    :return: phonopy Atoms object
+    """
+    from phonopy.structure.atoms import Atoms as PhonopyAtoms
+
+    cell, positions, symbols = get_structure_arrays(structure)
+
+    return PhonopyAtoms(symbols=symbols, positions=positions, cell=cell)
+
+
+def get_structure_from_phonopy_atoms(atoms):
+    """
+    Return a new (unstored) StructureData object from a phonopy Atoms object
+
+    :param atoms: phonopy Atoms object
+    :return: StructureData object
+    """
+    return get_structure_from_arrays(atoms.get_cell(), atoms.get_positions(), atoms.get_chemical_symbols())
+
+
+def get_displacement_arrays(displacements):
+    """
+    Return the displacements of a list of supercells as flat arrays (one entry per displaced atom)
+
+    :param displacements: list that contains for each supercell a list of the displaced atoms
+                          as [atom index, displacement vector] pairs (one pair in phonopy, one or two in phono3py)
+    :return: atom indices, supercell indices, displacement vectors [Ndisplacements x 3] (numpy arrays)
+    """
+    atom_indices = []
+    supercell_indices = []
+    displacement_vectors = []
+    for i, supercell_displacements in enumerate(displacements):
+        for atom_index, displacement in supercell_displacements:
+            atom_indices.append(atom_index)
+            supercell_indices.append(i)
+            displacement_vectors.append(displacement)
+
+    return (np.array(atom_indices, dtype=int),
+            np.array(supercell_indices, dtype=int),
+            np.array(displacement_vectors, dtype=float).reshape(-1, 3))
+
+
+def get_displaced_positions(positions, atom_indices, supercell_indices, displacements, n_supercells, indices=None):
+    """
+    Return the cartesian positions of the atoms of the supercells with displacements
+
+    :param positions: positions of the atoms of the perfect supercell [Natoms x 3]
+    :param atom_indices: index of the displaced atom of each displacement (see get_displacement_arrays)
+    :param supercell_indices: index of the supercell of each displacement
+    :param displacements: displacement vectors [Ndisplacements x 3]
+    :param n_supercells: total number of supercells with displacements
+    :param indices: list of (different) supercell indices (default: all supercells)
+    :return: numpy array [Nindices x Natoms x 3]
+    """
+    if indices is None:
+        indices = range(n_supercells)
+    indices = np.array(indices, dtype=int)
+
+    displaced_positions = np.repeat(np.array(positions, dtype=float)[None, :, :], len(indices), axis=0)
+
+    # Position of each supercell in the requested list (-1 if not requested)
+    location = np.full(n_supercells, -1, dtype=int)
+    location[indices] = np.arange(len(indices))
+
+    supercell_location = location[supercell_indices]
+    mask = supercell_location >= 0
+
+    np.add.at(displaced_positions,
+              (supercell_location[mask], atom_indices[mask]),
+              displacements[mask])
+
+    return displaced_positions
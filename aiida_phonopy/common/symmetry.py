@@ -0,0 +1,202 @@
+# This file implements a cache of the symmetry analysis of crystal structures (seekpath band paths and spglib
+# standardized cells). The results are identified by a hash of the structure with the lattice scale factored out
+# (cell divided by the cube root of its volume) and of the symmetry tolerance in the units of this normalized cell
+# (symprec divided by the scale), which is the tolerance the analysis actually uses. The structures of the same
+# crystal share the same entry if they have the same shape and the same effective tolerance. The results are kept
+# in memory (least recently used are discarded) and stored in the database as ParameterData nodes tagged with the
+# hash, so they are also reused by later workchains.
+#
+# The cache nodes are deliberately left out of the provenance graph (they are not inputs nor outputs of any
+# calculation): they only store intermediate results. The results used by the workchains are recorded in the nodes
+# built from them (the output of the standardize_cell workfunction, the band path input of the phonopy calculations).
+
+from collections import OrderedDict
+
+import numpy as np
+
+from aiida_phonopy.common.cache import get_hash, _round
+
+SYMMETRY_HASH_EXTRA = 'phonopy_symmetry_hash'
+
+# Maximum number of symmetry analysis results kept in memory (least recently used are discarded)
+MAX_SYMMETRY_ENTRIES = 64
+
+_symmetry_cache = OrderedDict()
+
+
+def get_normalized_cell(cell):
+    """
+    Return the lattice vectors scaled to unit volume and the scale factor
+
+    :param cell: lattice vectors in rows
+    :return: normalized lattice vectors, scale factor (cube root of the volume)
+    """
+    cell = np.array(cell, dtype=float)
+    scale = abs(np.linalg.det(cell)) ** (1.0 / 3)
+    return cell / scale, scale
+
+
+def get_symmetry_hash(analysis, cell, scaled_positions, numbers, symprec, decimals=6):
+    """
+    Return the hash that identifies the symmetry analysis of a structure independently of its volume
+
+    :param analysis: name of the analysis ('seekpath', 'standardize',...)
+    :param cell: lattice vectors in rows
+    :param scaled_positions: positions of the atoms in crystal coordinates
+    :param numbers: atomic numbers
+    :param symprec: symmetry tolerance (in the units of cell)
+    :return: hexadecimal string
+    """
+    normalized_cell, scale = get_normalized_cell(cell)
+
+    return get_hash({'analysis': analysis,
+                     'cell': _round(normalized_cell, decimals),
+                     'positions': _round(np.mod(_round(scaled_positions, decimals), 1.0), decimals),
+                     'numbers': [int(number) for number in numbers],
+                     'symprec': '{:.8e}'.format(symprec / scale)})
+
+
+def get_cached_symmetry(symmetry_hash):
+    """
+    Return the results of a symmetry analysis with the given hash (from memory or database) or None if not found
+    """
+    if symmetry_hash in _symmetry_cache:
+        results = _symmetry_cache.pop(symmetry_hash)
+        _symmetry_cache[symmetry_hash] = results
+        return results
+
+    from aiida.orm.querybuilder import QueryBuilder
+    from aiida.orm import DataFactory
+
+    qb = QueryBuilder()
+    qb.append(DataFactory('parameter'), filters={'extras.{}'.format(SYMMETRY_HASH_EXTRA): symmetry_hash})
+
+    for node, in qb.iterall():
+        _add_to_memory(symmetry_hash, node.get_dict())
+        return _symmetry_cache[symmetry_hash]
+
+    return None
+
+
+def _add_to_memory(symmetry_hash, results):
+    _symmetry_cache[symmetry_hash] = results
+    while len(_symmetry_cache) > MAX_SYMMETRY_ENTRIES:
+        _symmetry_cache.popitem(last=False)
+
+
+def set_cached_symmetry(symmetry_hash, results):
+    """
+    Store the results of a symmetry analysis in memory and in the database (as a ParameterData node outside
+    the provenance graph)
+
+    :param symmetry_hash: hash obtained from get_symmetry_hash
+    :param results: JSON serializable dictionary
+    """
+    from aiida.orm import DataFactory
+
+    _add_to_memory(symmetry_hash, results)
+
+    node = DataFactory('parameter')(dict=results)
+    node.label = 'phonopy symmetry cache'
+    node.store()
+    node.set_extra(SYMMETRY_HASH_EXTRA, symmetry_hash)
+
+
+def get_seekpath_path(cell, scaled_positions, numbers, symprec=1e-5):
+    """
+    Return the band structure path obtained with seekpath (cached). The coordinates of the high symmetry
+    points are given in reduced coordinates so they do not depend on the volume.
+
+    :param cell: lattice vectors in rows
+    :param scaled_positions: positions of the atoms in crystal coordinates
+    :param numbers: atomic numbers
+    :param symprec: symmetry tolerance
+    :return: dictionary {'point_coords', 'path'} (seekpath format)
+    """
+    symmetry_hash = get_symmetry_hash('seekpath', cell, scaled_positions, numbers, symprec)
+
+    path_data = get_cached_symmetry(symmetry_hash)
+    if path_data is None:
+        import seekpath
+
+        results = seekpath.get_path((cell, scaled_positions, numbers), symprec=symprec)
+        path_data = {'point_coords': {label: np.array(coordinates, dtype=float).tolist()
+                                      for label, coordinates in results['point_coords'].items()},
+                     'path': [list(segment) for segment in results['path']]}
+        set_cached_symmetry(symmetry_hash, path_data)
+
+    return path_data
+
+
+def get_standardized_cell(cell, scaled_positions, numbers, symprec=1e-5):
+    """
+    Return the conventional standardized cell obtained with spglib (cached). The cached lattice
+    is normalized to unit volume and scaled to the volume of the input cell.
+
+    :param cell: lattice vectors in rows
+    :param scaled_positions: positions of the atoms in crystal coordinates
+    :param numbers: atomic numbers
+    :param symprec: symmetry tolerance
+    :return: lattice vectors, scaled positions, atomic numbers (spglib format)
+    """
+    symmetry_hash = get_symmetry_hash('standardize', cell, scaled_positions, numbers, symprec)
+    normalized_cell, scale = get_normalized_cell(cell)
+
+    standardized = get_cached_symmetry(symmetry_hash)
+    if standardized is None:
+        import spglib
+
+        # Standardize the normalized cell so the result can be scaled to any volume
+        lattice, positions, standardized_numbers = spglib.standardize_cell((normalized_cell,
+                                                                            scaled_positions,
+                                                                            numbers),
+                                                                           symprec=symprec / scale,
+                                                                           to_primitive=False,
+                                                                           no_idealize=False)
+        standardized = {'lattice': np.array(lattice).tolist(),
+                        'positions': np.array(positions).tolist(),
+                        'numbers': np.array(standardized_numbers).tolist()}
+        set_cached_symmetry(symmetry_hash, standardized)
+
+    return (np.array(standardized['lattice']) * scale,
+            np.array(standardized['positions']),
+            np.array(standardized['numbers']))
+
+
+def is_standardized_cell(cell, scaled_positions, numbers, symprec=1e-5, tolerance=1e-5):
+    """
+    Return True if a cell is already its standardized cell: same lattice vectors and same atoms. spglib may
+    return a standardized cell with the origin shifted and the atoms in another order (standardizing twice does
+    not always give the same result), so the atoms are compared up to a common translation and a permutation.
+
+    :param cell: lattice vectors in rows
+    :param scaled_positions: positions of the atoms in crystal coordinates
+    :param numbers: atomic numbers
+    :param symprec: symmetry tolerance
+    :param tolerance: tolerance in the units of cell
+    """
+    cell = np.array(cell, dtype=float)
+    scaled_positions = np.array(scaled_positions, dtype=float).reshape(-1, 3)
+    numbers = np.array(numbers)
+
+    lattice, standardized_positions, standardized_numbers = get_standardized_cell(cell, scaled_positions, numbers,
+                                                                                  symprec=symprec)
+
+    if len(standardized_numbers) != len(numbers) or \
+            not np.array_equal(np.sort(standardized_numbers), np.sort(numbers)):
+        return False
+
+    if not np.allclose(lattice, cell, atol=tolerance):
+        return False
+
+    same_number = numbers[:, None] == standardized_numbers[None, :]
+
+    # Try the translations that move the first atom onto a standardized atom of the same element
+    for translation in standardized_positions[standardized_numbers == numbers[0]] - scaled_positions[0]:
+        differences = standardized_positions[None, :, :] - (scaled_positions + translation)[:, None, :]
+        differences -= np.rint(differences)
+        matches = same_number & (np.linalg.norm(np.dot(differences, lattice), axis=-1) < tolerance)
+        if np.all(np.any(matches, axis=1)):
+            return True
+
+    return False
@@ -1,14 +1,53 @@
 from aiida.orm.data.array import ArrayData
+from aiida_phonopy.common.bands import get_band_array, split_band_array
 
 
 class BandStructureData(ArrayData):
     """
-    Store the band structure.
+    Store the band structure. The bands (subpaths) may have a different number of q-points, in this case the
+    data of all bands is stored concatenated together with the number of q-points of each band.
     """
 
     def __init__(self, *args, **kwargs):
         super(BandStructureData, self).__init__(*args, **kwargs)
 
+    def _set_band_array(self, name, data):
+        """
+        Store data given for each band (subpath) [Nsubpaths x Nq_points x ...]
+
+        :param name: name of the array
+        :param data: list with the data of each band
+        """
+        array, sizes = get_band_array(data)
+
+        self.set_array(name, array)
+        if sizes is not None:
+            self.set_array('band_sizes', sizes)
+
+    def _get_band_array(self, name, band=None):
+        """
+        Return data stored with _set_band_array as a numpy array [Nsubpaths x Nq_points x ...] or as a list
+        of numpy arrays if the bands have a different number of q-points
+
+        :param name: name of the array
+        :param band: (integer) if not None, return only the data of the subpath with index band
+        """
+        sizes = None
+        if 'band_sizes' in self.get_arraynames():
+            sizes = self.get_array('band_sizes')
+
+        return split_band_array(self.get_array(name), sizes, band=band)
+
+    def _check_bands(self, q_points, distances):
+
+        import numpy
+
+        bands = self.get_bands()
+        band_distances = self.get_distances()
+        for band in range(len(q_points)):
+            numpy.testing.assert_array_almost_equal(q_points[band], bands[band], decimal=4)
+            numpy.testing.assert_array_almost_equal(distances[band], band_distances[band], decimal=4)
+
     def get_number_of_bands(self):
 
         if 'nbands' in self.get_attrs():
@@ -24,15 +63,18 @@ class BandStructureData(ArrayData):
             return None
 
     def set_bands(self, bands):
+        """
+        Set the q-points of each band (subpath)
 
-        import numpy
-
-        bands = numpy.array(bands)
+        :param bands: list of q-points of each band [Nsubpaths x Nq_points x 3]. The number of q-points
+                      of each band can be different (npoints is only set if all bands have the same number)
+        """
 
-        self.set_array('bands', bands)
+        self._set_band_array('bands', bands)
 
         self._set_attr('nbands', len(bands))
-        self._set_attr('npoints', len(bands[0]))
+        if 'band_sizes' not in self.get_arraynames():
+            self._set_attr('npoints', len(bands[0]))
 
     def set_labels(self, band_labels):
 
@@ -58,52 +100,40 @@ class BandStructureData(ArrayData):
 
     def set_band_structure_phonopy(self, band_structure_phonopy):
 
-        import numpy
-
-        q_points = numpy.array(band_structure_phonopy[0])
-        distances = numpy.array(band_structure_phonopy[1])
+        q_points = band_structure_phonopy[0]
+        distances = band_structure_phonopy[1]
 
         # Check consistency
-        if self.get_bands() is None:
+        if 'bands' not in self.get_arraynames():
             self.set_bands(q_points)
-        else:
-            numpy.testing.assert_array_almost_equal(q_points, self.get_bands(), decimal=4)
 
-        numpy.testing.assert_array_almost_equal(distances, self.get_distances(), decimal=4)
+        self._check_bands(q_points, distances)
 
         # self.set_array('q_points', numpy.array(band_structure_phonopy[0]))
         # self.set_array('distances', numpy.array(band_structure_phonopy[1]))
-        self.set_array('frequencies', numpy.array(band_structure_phonopy[2]))
+        self._set_band_array('frequencies', band_structure_phonopy[2])
 
     def set_band_structure_gruneisen(self, band_structure_gruneisen):
 
-        import numpy
-
-        q_points = numpy.array(band_structure_gruneisen[0])
-        distances = numpy.array(band_structure_gruneisen[1])
+        q_points = band_structure_gruneisen[0]
+        distances = band_structure_gruneisen[1]
 
         # Check consistency
-        if self.get_bands() is None:
+        if 'bands' not in self.get_arraynames():
             self.set_bands(q_points)
-        else:
-            numpy.testing.assert_array_almost_equal(q_points, self.get_bands(), decimal=4)
 
-        numpy.testing.assert_array_almost_equal(distances, self.get_distances(), decimal=4)
+        self._check_bands(q_points, distances)
 
-        self.set_array('gamma', numpy.array(band_structure_gruneisen[4]))
-        self.set_array('eigenvectors', numpy.array(band_structure_gruneisen[3]))
-        self.set_array('frequencies', numpy.array(band_structure_gruneisen[2]))
+        self._set_band_array('gamma', band_structure_gruneisen[4])
+        self._set_band_array('eigenvectors', band_structure_gruneisen[3])
+        self._set_band_array('frequencies', band_structure_gruneisen[2])
 
     def set_frequencies(self, frequencies):
         """
-        Return the frequencies as a numpy array
+        Set the frequencies of each band
         """
 
-        import numpy
-
-        frequencies = numpy.array(frequencies)
-
-        self.set_array('frequencies', frequencies)
+        self._set_band_array('frequencies', frequencies)
 
     def get_unitcell(self):
         """
@@ -120,23 +150,16 @@ class BandStructureData(ArrayData):
 
         inverse_unitcell = np.linalg.inv(self.get_unitcell())
 
-        array = self.get_bands()
-        # nbands = array.shape[0]
-        npoints = array.shape[1]
-
         distances = []
-        for piece in array:
-            if distances == []:
-                band_dist = [0.0]
-            else:
-                band_dist = [distances[-1][-1]]
-            for i in range(npoints-1):
-                #band_dist.append(np.linalg.norm(np.array(band[i+1]) - np.array(band[i]))+band_dist[i])
-                band_dist.append(np.linalg.norm(np.dot(piece[i+1], inverse_unitcell.T) -
-                                                np.dot(piece[i], inverse_unitcell.T)) + band_dist[i])
-
+        start = 0.0
+        for piece in self.get_bands():
+            steps = np.linalg.norm(np.diff(np.dot(piece, inverse_unitcell.T), axis=0), axis=1)
+            band_dist = start + np.concatenate([[0.0], np.cumsum(steps)])
+            start = band_dist[-1]
             distances.append(band_dist)
-        distances = np.array(distances)
+
+        if 'band_sizes' not in self.get_arraynames():
+            distances = np.array(distances)
 
         if band is not None:
             distances = distances[band]
@@ -150,12 +173,7 @@ class BandStructureData(ArrayData):
 
         :param band: (integer) if not None, return only the frequencies of subpath with index band
         """
-        frequencies = self.get_array('frequencies')
-
-        if band is not None:
-            frequencies = frequencies[band]
-
-        return frequencies
+        return self._get_band_array('frequencies', band=band)
 
     def get_gamma(self, band=None):
         """
@@ -164,13 +182,7 @@ class BandStructureData(ArrayData):
         :param band: (integer) if not None, return only the mode gruneisen parameters at the subpath with index band
 
         """
-
-        gamma =  self.get_array('gamma')
-
-        if band is not None:
-            gamma = gamma[band]
-
-        return gamma
+        return self._get_band_array('gamma', band=band)
 
     def get_eigenvectors(self, band=None):
         """
@@ -179,12 +191,7 @@ class BandStructureData(ArrayData):
         :param band: (integer) if not None, return only the eigenvectors at the subpath with index band
 
         """
-        eigenvectors = self.get_array('eigenvectors')
-
-        if band is not None:
-            eigenvectors = eigenvectors[band]
-
-        return eigenvectors
+        return self._get_band_array('eigenvectors', band=band)
 
     def get_bands(self, band=None):
         """
@@ -193,12 +200,7 @@ class BandStructureData(ArrayData):
         :param band: (integer) if not None, return only the q_points at the subpath with index band
 
         """
-        bands = self.get_array('bands')
-
-        if band is not None:
-            bands = bands[band]
-
-        return bands
+        return self._get_band_array('bands', band=band)
 
     def get_band_ranges(self, band=None):
         """
@@ -208,9 +210,7 @@ class BandStructureData(ArrayData):
         """
         import numpy
 
-        array = self.get_bands()
-
-        band_ranges = numpy.array([numpy.array([i[-0], i[-1]]) for i in array])
+        band_ranges = numpy.array([numpy.array([i[0], i[-1]]) for i in self.get_bands()])
 
         if band is not None:
             band_ranges = band_ranges[band]
@@ -0,0 +1,109 @@
+from aiida.orm.data.array import ArrayData
+import numpy
+
+
+class DisplacedSupercellsData(ArrayData):
+    """
+    Store the supercells with displacements in a compact form: the perfect supercell is stored once
+    together with the displacements of each supercell (atom index and displacement vector). The
+    StructureData objects of each supercell are only created when needed (see get_supercells)
+    """
+
+    def set_supercell(self, structure):
+        """
+        Set the perfect supercell (without displacements)
+
+        :param structure: StructureData object that contains the perfect supercell
+        """
+
+        from aiida_phonopy.common.structure import get_structure_arrays
+
+        cell, positions, symbols = get_structure_arrays(structure)
+
+        self._set_attr('cell', cell.tolist())
+        self._set_attr('symbols', symbols)
+        self.set_array('positions', positions)
+
+    def set_displacements(self, displacements):
+        """
+        Set the displacements of each supercell
+
+        :param displacements: list that contains for each supercell a list of the displaced atoms
+                              as [atom index, displacement vector] pairs (one pair in phonopy, one or two in phono3py)
+        """
+
+        from aiida_phonopy.common.structure import get_displacement_arrays
+
+        atom_indices, supercell_indices, displacement_vectors = get_displacement_arrays(displacements)
+
+        self.set_array('atom_indices', atom_indices)
+        self.set_array('supercell_indices', supercell_indices)
+        self.set_array('displacements', displacement_vectors)
+
+        self._set_attr('nsupercells', len(displacements))
+
+    def get_number_of_supercells(self):
+        """
+        Return the number of supercells with displacements
+        """
+
+        return self.get_attr('nsupercells')
+
+    def get_cell(self):
+        """
+        Return the lattice vectors of the supercell (common to all supercells) as a numpy array
+        """
+
+        return numpy.array(self.get_attr('cell'))
+
+    def get_symbols(self):
+        """
+        Return the list of atomic symbols of the supercell
+        """
+
+        return self.get_attr('symbols')
+
+    def get_positions(self, indices=None):
+        """
+        Return the cartesian positions of the atoms of the supercells with displacements
+
+        :param indices: list of (different) supercell indices (default: all supercells)
+        :return: numpy array [Nsupercells x Natoms x 3]
+        """
+
+        from aiida_phonopy.common.structure import get_displaced_positions
+
+        return get_displaced_positions(self.get_array('positions'),
+                                       self.get_array('atom_indices'),
+                                       self.get_array('supercell_indices'),
+                                       self.get_array('displacements'),
+                                       self.get_number_of_supercells(),
+                                       indices=indices)
+
+    def get_supercell(self, index):
+        """
+        Return the supercell with displacements as a new (unstored) StructureData object
+
+        :param index: index of the supercell (in the order of the displacements dataset)
+        :return: StructureData object
+        """
+
+        from aiida_phonopy.common.structure import get_structure_from_arrays
+
+        return get_structure_from_arrays(self.get_cell(), self.get_positions([index])[0], self.get_symbols())
+
+    def get_supercells(self, indices=None):
+        """
+        Return the supercells with displacements as new (unstored) StructureData objects. The arrays are read
+        from the repository once for all the supercells (use it instead of get_supercell in loops)
+
+        :param indices: list of (different) supercell indices (default: all supercells)
+        :return: list of StructureData objects
+        """
+
+        from aiida_phonopy.common.structure import get_structure_from_arrays
+
+        cell = self.get_cell()
+        symbols = self.get_symbols()
+
+        return [get_structure_from_arrays(cell, positions, symbols) for positions in self.get_positions(indices)]
@@ -1,5 +1,4 @@
 from aiida.orm.data.array import ArrayData
-from aiida.orm.data.structure import StructureData
 
 import numpy
 
@@ -21,9 +20,13 @@ class NacData(ArrayData):
         :return:
         """
 
-        self._set_attr('cell', structure.cell)
-        self._set_attr('positions', [site.position for site in structure.sites])
-        self._set_attr('symbols', [site.kind_name for site in structure.sites])
+        from aiida_phonopy.common.structure import get_structure_arrays
+
+        cell, positions, symbols = get_structure_arrays(structure)
+
+        self._set_attr('cell', cell.tolist())
+        self._set_attr('positions', positions.tolist())
+        self._set_attr('symbols', symbols)
 
     def get_epsilon(self):
         """
@@ -69,15 +72,9 @@ class NacData(ArrayData):
         :return: StructureData
         """
 
-        structure = StructureData(cell=self.get_attr('cell'))
-
-        symbols = self.get_attr('symbols')
-        positions = self.get_attr('positions')
-        for symbol, position in zip(symbols, positions):
-            structure.append_atom(position=position,
-                                  symbols=symbol)
+        from aiida_phonopy.common.structure import get_structure_from_arrays
 
-        return structure
+        return get_structure_from_arrays(self.get_attr('cell'), self.get_attr('positions'), self.get_attr('symbols'))
 
     def get_born_parameters_phonopy(self, primitive_cell=None, symprec=1e-5):
         """
@@ -91,16 +88,14 @@ class NacData(ArrayData):
 
         import numpy as np
         from phonopy.structure.cells import get_primitive, get_supercell
-        from phonopy.structure.atoms import Atoms as PhonopyAtoms
         from phonopy.units import Hartree, Bohr
+        from aiida_phonopy.common.structure import get_phonopy_atoms
 
         born_charges = self.get_array('born_charges')
         epsilon = self.get_array('epsilon')
         structure_born = self.get_structure()
 
-        ucell = PhonopyAtoms(symbols=[site.kind_name for site in structure_born.sites],
-                             positions=[site.position for site in structure_born.sites],
-                             cell=structure_born.cell)
+        ucell = get_phonopy_atoms(structure_born)
 
         if primitive_cell is None:
             target_mat = np.identity(3)
@@ -0,0 +1,122 @@
+from aiida.orm.data.array import ArrayData
+import numpy
+
+
+class PhononModelData(ArrayData):
+    """
+    Store a harmonic phonon model: primitive cell, force constants in compact form (primitive atoms x supercell atoms),
+    shortest vectors between atoms and (optionally) non-analytical corrections. The frequencies at any list of
+    q-points are evaluated with numpy without creating a Phonopy object (see common/dynamical_matrix.py).
+    """
+
+    def set_phonon(self, phonon):
+        """
+        Set the phonon model from a Phonopy object with force constants (and non-analytical corrections) set
+
+        :param phonon: Phonopy object
+        """
+        from aiida_phonopy.common.dynamical_matrix import get_model_arrays, get_nac_method, MODEL_ARRAYS
+
+        model = get_model_arrays(phonon)
+
+        for name in MODEL_ARRAYS:
+            self.set_array(name, model[name])
+
+        self._set_attr('frequency_factor', model['frequency_factor'])
+        self._set_attr('symbols', phonon.get_primitive().get_chemical_symbols())
+
+        nac_parameters = phonon.get_nac_params()
+        if nac_parameters is not None:
+            nac_parameters = dict(nac_parameters, method=get_nac_method(phonon))
+            self.set_nac_parameters(nac_parameters)
+
+    def set_nac_parameters(self, nac_parameters):
+        """
+        Set the non-analytical corrections. Only the Wang method is implemented, the method is stored
+        in the nac_method attribute
+
+        :param nac_parameters: dictionary with 'born', 'dielectric', 'factor' and (optionally) 'method' entries
+                               (phonopy format)
+        """
+        from aiida_phonopy.common.dynamical_matrix import NAC_METHOD
+
+        method = nac_parameters.get('method', NAC_METHOD)
+        if method != NAC_METHOD:
+            raise ValueError('Non-analytical corrections method {} is not supported by PhononModelData '
+                             '(use {})'.format(method, NAC_METHOD))
+
+        self.set_array('born', numpy.array(nac_parameters['born']))
+        self.set_array('dielectric', numpy.array(nac_parameters['dielectric']))
+        self._set_attr('nac_factor', nac_parameters['factor'])
+        self._set_attr('nac_method', method)
+
+    def get_nac_parameters(self):
+        """
+        Return the non-analytical corrections in phonopy format (None if not set)
+        """
+        if 'born' not in self.get_arraynames():
+            return None
+
+        return {'born': self.get_array('born'),
+                'dielectric': self.get_array('dielectric'),
+                'factor': self.get_attr('nac_factor'),
+                'method': self.get_attr('nac_method')}
+
+    def get_primitive_cell(self):
+        """
+        Return the lattice vectors of the primitive cell (in rows) as a numpy array
+        """
+        return self.get_array('primitive_cell')
+
+    def get_symbols(self):
+        """
+        Return the atomic symbols of the primitive cell
+        """
+        return self.get_attr('symbols')
+
+    def get_model(self):
+        """
+        Return the arrays of the phonon model (and the frequency_factor) in a dictionary. Each array is read
+        from the repository once, use the returned dictionary to evaluate many q-points
+        """
+        from aiida_phonopy.common.dynamical_matrix import MODEL_ARRAYS
+
+        model = dict((name, self.get_array(name)) for name in MODEL_ARRAYS)
+        model['frequency_factor'] = self.get_attr('frequency_factor')
+        return model
+
+    def get_dynamical_matrices(self, qpoints):
+        """
+        Return the dynamical matrices at a list of q-points
+
+        :param qpoints: q-points [Nq x 3] in reduced coordinates of the primitive reciprocal lattice
+        :return: complex numpy array [Nq x 3Natoms x 3Natoms]
+        """
+        from aiida_phonopy.common.dynamical_matrix import get_dynamical_matrices
+
+        model = self.get_model()
+        return get_dynamical_matrices(qpoints,
+                                      model['force_constants'],
+                                      model['masses'],
+                                      model['smallest_vectors'],
+                                      model['multiplicity'],
+                                      model['s2p_map'],
+                                      primitive_cell=model['primitive_cell'],
+                                      nac_parameters=self.get_nac_parameters())
+
+    def frequencies(self, qpoints, eigenvectors=False, max_memory=200):
+        """
+        Return the phonon frequencies (in THz) at a list of q-points
+
+        :param qpoints: q-points [Nq x 3] in reduced coordinates of the primitive reciprocal lattice
+        :param eigenvectors: if True also return the eigenvectors (in columns, as in phonopy)
+        :param max_memory: approximate size (in MB) of the temporary arrays used in each batch of q-points
+        :return: frequencies [Nq x 3Natoms] (and eigenvectors [Nq x 3Natoms x 3Natoms])
+        """
+        from aiida_phonopy.common.dynamical_matrix import get_model_frequencies
+
+        # The arrays are read once here, not for each batch of q-points
+        return get_model_frequencies(qpoints, self.get_model(),
+                                     nac_parameters=self.get_nac_parameters(),
+                                     eigenvectors=eigenvectors,
+                                     max_memory=max_memory)
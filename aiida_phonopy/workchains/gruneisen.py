@@ -22,115 +22,24 @@ BandStructureData = DataFactory('phonopy.band_structure')
 PhononPhonopy = WorkflowFactory('phonopy.phonon')
 
 import numpy as np
+from aiida_phonopy.common.phonopy_session import get_phonopy, get_unitcell_data, get_phonopy_settings
+from aiida_phonopy.common.local_executor import run_local
+from aiida_phonopy.common.qha import get_phonon, get_commensurate, calculate_qha_thermal_properties
 
 __testing__ = False
 
 
-def get_phonon(structure, force_constants, ph_settings, nac_data=None):
-    from phonopy import Phonopy
-    from aiida_phonopy.workchains.phonon import phonopy_bulk_from_structure
-
-    phonon = Phonopy(phonopy_bulk_from_structure(structure),
-                     ph_settings.dict.supercell,
-                     primitive_matrix=ph_settings.dict.primitive,
-                     symprec=ph_settings.dict.symmetry_precision)
-
-    if force_constants is not None:
-        phonon.set_force_constants(force_constants.get_data())
-
-    if nac_data is not None:
-            primitive = phonon.get_primitive()
-            nac_parameters = nac_data.get_born_parameters_phonopy(primitive_cell=primitive.get_cell())
-            phonon.set_nac_params(nac_parameters)
-
-    return phonon
-
-
-def get_commensurate(structure, ph_settings):
-    from phonopy import Phonopy
-    from phonopy.harmonic.dynmat_to_fc import DynmatToForceConstants
-    from aiida_phonopy.workchains.phonon import phonopy_bulk_from_structure
-
-    phonon = Phonopy(phonopy_bulk_from_structure(structure),
-                     ph_settings.dict.supercell,
-                     primitive_matrix=ph_settings.dict.primitive,
-                     symprec=ph_settings.dict.symmetry_precision)
-
-    primitive = phonon.get_primitive()
-    supercell = phonon.get_supercell()
-
-    dynmat2fc = DynmatToForceConstants(primitive, supercell)
-    commensurate = dynmat2fc.get_commensurate_points()
-
-    return dynmat2fc, commensurate
-
-
-def get_force_constants(phonon_origin, gruneisen, commensurate, volumes):
-    from phonopy.harmonic.dynmat_to_fc import DynmatToForceConstants
-    from phonopy.units import VaspToTHz
-
-    from copy import deepcopy
-    phonon = deepcopy(phonon_origin)
-
-    phonon.set_qpoints_phonon(commensurate,
-                              is_eigenvectors=True)
-    frequencies, eigenvectors = phonon.get_qpoints_phonon()
-
-    primitive = phonon.get_primitive()
-    supercell = phonon.get_supercell()
-
-    dynmat2fc = DynmatToForceConstants(primitive, supercell)
-    volume_ref = phonon.get_unitcell().get_volume()
-
-    force_constants_list = []
-    for volume in volumes:
-        renormalized_frequencies = []
-        for freq, g in zip(frequencies, gruneisen):
-            renormalized_frequencies.append(freq + (freq * (np.exp(-g*np.log(volume/volume_ref))-1)))
-        renormalized_frequencies = np.array(renormalized_frequencies)
-
-        # Fixing Gamma point data
-        renormalized_frequencies[0][0:3] = [0.0, 0.0, 0.0]
-
-        dynmat2fc.set_dynamical_matrices(renormalized_frequencies / VaspToTHz, eigenvectors)
-        dynmat2fc.run()
-        force_constants_list.append(np.array(dynmat2fc.get_force_constants()))
-
-    return force_constants_list
-
-
-def get_thermal_properties(structure, ph_settings, force_constants_list):
-    from phonopy import Phonopy
-    from aiida_phonopy.workchains.phonon import phonopy_bulk_from_structure
-
-    free_energy_list = []
-    entropy_list = []
-    cv_list = []
-    temperature = None
-    for fc in force_constants_list:
-        phonon = Phonopy(phonopy_bulk_from_structure(structure),
-                         ph_settings.dict.supercell,
-                         primitive_matrix=ph_settings.dict.primitive,
-                         symprec=ph_settings.dict.symmetry_precision)
-
-        # Normalization factor primitive to unit cell
-        normalization_factor = phonon.unitcell.get_number_of_atoms()/phonon.primitive.get_number_of_atoms()
-
-        phonon.set_force_constants(fc)
-        phonon.set_mesh(ph_settings.dict.mesh, is_eigenvectors=True, is_mesh_symmetry=False)
-        phonon.set_thermal_properties()
-        temperature, free_energy, entropy, cv = phonon.get_thermal_properties()
-        free_energy_list.append(np.array(free_energy) * normalization_factor)
-        entropy_list.append(np.array(entropy) * normalization_factor)
-        cv_list.append(np.array(cv) * normalization_factor)
-
-    return np.array(free_energy_list), np.array(entropy_list).T, np.array(cv_list).T, temperature
+def get_nac_parameters(structure, ph_settings, nac_data):
+    """
+    Return the non-analytical corrections in phonopy format for the primitive cell of a structure
+    """
+    primitive = get_phonopy(structure, ph_settings).get_primitive()
+    return nac_data.get_born_parameters_phonopy(primitive_cell=primitive.get_cell())
 
 
 def get_gruneisen_at_list(phonon_origin, phonon_plus, phonon_minus, list_qpoints):
 
     from phonopy.gruneisen.core import GruneisenBase
-    from copy import deepcopy
 
     gruneisen = GruneisenBase(phonon_origin.get_dynamical_matrix(),
                               phonon_plus.get_dynamical_matrix(),
@@ -143,11 +52,10 @@ def get_gruneisen_at_list(phonon_origin, phonon_plus, phonon_minus, list_qpoints
     eigenvalues = gruneisen.get_eigenvalues()
     frequencies = np.sqrt(abs(eigenvalues)) * np.sign(eigenvalues) * factor
 
-    phonon = deepcopy(phonon_origin)
-
-    phonon.set_qpoints_phonon(list_qpoints,
-                              is_eigenvectors=True)
-    frequencies_check, eigenvectors = phonon.get_qpoints_phonon()
+    # phonon_origin is created for this calculation (see calculate_gruneisen), so it is used without a copy
+    phonon_origin.set_qpoints_phonon(list_qpoints,
+                                     is_eigenvectors=True)
+    frequencies_check, eigenvectors = phonon_origin.get_qpoints_phonon()
 
     # Make sure that both sets of frequencies are the same (should be!)
     np.testing.assert_almost_equal(frequencies, frequencies_check)
@@ -155,11 +63,47 @@ def get_gruneisen_at_list(phonon_origin, phonon_plus, phonon_minus, list_qpoints
     return gamma, frequencies, eigenvectors
 
 
+def calculate_gruneisen(phonons, settings, mesh, bands):
+    """
+    Calculate the mode Gruneisen parameters at a mesh, at a band structure path and at the commensurate
+    q-points using phonopy (run in a worker process, see local_executor.py)
+
+    :param phonons: dictionary with 'origin', 'plus' and 'minus' phonons data (unitcell, force_constants, nac_parameters)
+    :param settings: dictionary with the phonopy settings (see phonopy_session.get_phonopy_settings)
+    :param mesh: q-points mesh
+    :param bands: list of q-points of each band (band structure path)
+    :return: dictionary with the results
+    """
+    from phonopy import PhonopyGruneisen
+
+    phonon_plus = get_phonon(settings=settings, **phonons['plus'])
+    phonon_minus = get_phonon(settings=settings, **phonons['minus'])
+    phonon_origin = get_phonon(settings=settings, **phonons['origin'])
+
+    gruneisen = PhonopyGruneisen(phonon_origin,  # equilibrium
+                                 phonon_plus,  # plus
+                                 phonon_minus)  # minus
+
+    gruneisen.set_mesh(mesh, is_gamma_center=False, is_mesh_symmetry=True)
+
+    # band structure
+    gruneisen.set_band_structure(bands)
+
+    # commensurate
+    dynmat2fc, commensurate_q_points = get_commensurate(phonons['origin']['unitcell'], settings)
+    commensurate_gruneisen, commensurate_frequencies, eigenvectors = get_gruneisen_at_list(phonon_origin,
+                                                                                           phonon_plus,
+                                                                                           phonon_minus,
+                                                                                           commensurate_q_points)
+
+    return {'band_structure': gruneisen.get_band_structure(),
+            'mesh': gruneisen.get_mesh(),
+            'commensurate': (commensurate_q_points, commensurate_gruneisen, commensurate_frequencies, eigenvectors)}
+
+
 @workfunction
 def phonopy_gruneisen(**kwargs):
 
-    from phonopy import PhonopyGruneisen
-
     phonon_plus_structure = kwargs.pop('phonon_plus_structure')
     phonon_plus_fc = kwargs.pop('phonon_plus_fc')
     phonon_minus_structure = kwargs.pop('phonon_minus_structure')
@@ -179,38 +123,31 @@ def phonopy_gruneisen(**kwargs):
         phonon_minus_nac = None
         phonon_origin_nac = None
 
-    phonon_plus = get_phonon(phonon_plus_structure,
-                             phonon_plus_fc,
-                             ph_settings,
-                             nac_data=phonon_plus_nac)
-
-    phonon_minus = get_phonon(phonon_minus_structure,
-                              phonon_minus_fc,
-                              ph_settings,
-                              nac_data=phonon_minus_nac)
-
-    phonon_origin = get_phonon(phonon_origin_structure,
-                               phonon_origin_fc,
-                               ph_settings,
-                               nac_data=phonon_origin_nac)
-
-    gruneisen = PhonopyGruneisen(phonon_origin,  # equilibrium
-                                 phonon_plus,  # plus
-                                 phonon_minus)  # minus
-
-    gruneisen.set_mesh(ph_settings.dict.mesh, is_gamma_center=False, is_mesh_symmetry=True)
+    phonons = {}
+    for name, structure, force_constants, nac_data in [('plus', phonon_plus_structure, phonon_plus_fc, phonon_plus_nac),
+                                                       ('minus', phonon_minus_structure, phonon_minus_fc, phonon_minus_nac),
+                                                       ('origin', phonon_origin_structure, phonon_origin_fc, phonon_origin_nac)]:
+        phonons[name] = {'unitcell': get_unitcell_data(structure),
+                         'force_constants': force_constants.get_data(),
+                         'nac_parameters': None if nac_data is None else get_nac_parameters(structure,
+                                                                                            ph_settings,
+                                                                                            nac_data)}
+
+    gruneisen_data = run_local(calculate_gruneisen,
+                               phonons,
+                               get_phonopy_settings(ph_settings),
+                               ph_settings.dict.mesh,
+                               bands.get_bands())
 
     # band structure
-    gruneisen.set_band_structure(bands.get_bands())
-
     band_structure = BandStructureData(bands=bands.get_bands(),
                                        labels=bands.get_labels(),
                                        unitcell=bands.get_unitcell())
 
-    band_structure.set_band_structure_gruneisen(gruneisen.get_band_structure())
+    band_structure.set_band_structure_gruneisen(gruneisen_data['band_structure'])
 
     # mesh
-    mesh_data = gruneisen.get_mesh()
+    mesh_data = gruneisen_data['mesh']
 
     mesh_array = ArrayData()
     mesh_array.set_array('frequencies', np.array(mesh_data[2]))
@@ -220,11 +157,8 @@ def phonopy_gruneisen(**kwargs):
     mesh_array.set_array('weights', np.array(mesh_data[1]))
 
     # commensurate
-    dynmat2fc, commensurate_q_points = get_commensurate(phonon_origin_structure, ph_settings)
-    commensurate_gruneisen, commensurate_frequencies, eigenvectors = get_gruneisen_at_list(phonon_origin,
-                                                                                           phonon_plus,
-                                                                                           phonon_minus,
-                                                                                           commensurate_q_points)
+    commensurate_q_points, commensurate_gruneisen, commensurate_frequencies, eigenvectors = gruneisen_data['commensurate']
+
     commensurate_array = ArrayData()
     commensurate_array.set_array('q_points', commensurate_q_points)
     commensurate_array.set_array('gruneisen', commensurate_gruneisen)
@@ -287,18 +221,15 @@ def phonopy_qha_prediction(phonon_structure,
                            ph_settings,
                            commensurate):
 
-    phonon = get_phonon(phonon_structure,
-                        force_constants,
-                        ph_settings)
-
-    force_constants_list = get_force_constants(phonon,
-                                               commensurate.get_array('gruneisen'),
-                                               commensurate.get_array('q_points'),
-                                               eos.get_array('volumes'))
-
-    free_energy_list, entropy_list, cv_list, temperature = get_thermal_properties(phonon_structure,
-                                                                                  ph_settings,
-                                                                                  force_constants_list)
+    free_energy_list, entropy_list, cv_list, temperature = calculate_qha_thermal_properties(
+        get_unitcell_data(phonon_structure),
+        get_phonopy_settings(ph_settings),
+        ph_settings.dict.mesh,
+        force_constants.get_data(),
+        commensurate.get_array('gruneisen'),
+        commensurate.get_array('q_points'),
+        eos.get_array('volumes'),
+        parallel_volumes=ph_settings.get_dict().get('parallel_volumes', False))
 
     # testing
     if __testing__:
@@ -412,8 +343,12 @@ class GruneisenPhonopy(WorkChain):
         spec.input("pressure", valid_type=Float, required=False, default=Float(0.0))  # in kB
         spec.input("stress_displacement", valid_type=Float, required=False, default=Float(2.0))  # in kB
         spec.input("use_nac", valid_type=Bool, required=False, default=Bool(False))
+        spec.input("use_cache", valid_type=Bool, required=False, default=Bool(False))
 
-        spec.outline(cls.create_unit_cell_expansions, cls.calculate_gruneisen)
+        spec.outline(cls.create_unit_cell_expansions,
+                     cls.calculate_gruneisen,
+                     cls.calculate_qha_prediction,
+                     cls.collect_data)
 
     def create_unit_cell_expansions(self):
 
@@ -439,7 +374,8 @@ class GruneisenPhonopy(WorkChain):
                             es_settings=self.inputs.es_settings,
                             pressure=Float(expansions[1]),
                             optimize=Bool(True),
-                            use_nac=self.inputs.use_nac
+                            use_nac=self.inputs.use_nac,
+                            use_cache=self.inputs.use_cache
                             )
 
             calcs[expansions[0]] = future
@@ -468,11 +404,13 @@ class GruneisenPhonopy(WorkChain):
                                     'phonon_minus_nac': self.ctx.minus.out.nac_data,
                                     'phonon_origin_nac': self.ctx.origin.out.nac_data})
 
-        gruneisen_results = phonopy_gruneisen(**input_gruneisen)
+        return ToContext(gruneisen=async(phonopy_gruneisen, **input_gruneisen))
 
-        self.out('band_structure', gruneisen_results['band_structure'])
-        self.out('mesh', gruneisen_results['mesh'])
-        self.out('commensurate', gruneisen_results['commensurate'])
+    def calculate_qha_prediction(self):
+
+        self.out('band_structure', self.ctx.gruneisen.out.band_structure)
+        self.out('mesh', self.ctx.gruneisen.out.mesh)
+        self.out('commensurate', self.ctx.gruneisen.out.commensurate)
 
         eos = get_eos(phonon_plus_structure=self.ctx.plus.out.final_structure,
                       phonon_origin_structure=self.ctx.origin.out.final_structure,
@@ -481,12 +419,15 @@ class GruneisenPhonopy(WorkChain):
                       phonon_origin_data=self.ctx.origin.out.optimized_data,
                       phonon_minus_data=self.ctx.minus.out.optimized_data)
 
-        prediction_results = phonopy_qha_prediction(phonon_structure=self.ctx.origin.out.final_structure,
-                                                    force_constants=self.ctx.origin.out.force_constants,
-                                                    eos=eos['eos'],
-                                                    ph_settings=self.inputs.ph_settings,
-                                                    commensurate=gruneisen_results['commensurate'])
+        future = async(phonopy_qha_prediction,
+                       phonon_structure=self.ctx.origin.out.final_structure,
+                       force_constants=self.ctx.origin.out.force_constants,
+                       eos=eos['eos'],
+                       ph_settings=self.inputs.ph_settings,
+                       commensurate=self.ctx.gruneisen.out.commensurate)
+
+        return ToContext(prediction=future)
 
-        self.out('prediction', prediction_results['qha_prediction'])
+    def collect_data(self):
 
-        print(prediction_results)
\ No newline at end of file
+        self.out('prediction', self.ctx.prediction.out.qha_prediction)
@@ -15,53 +15,91 @@ ForceConstantsData = DataFactory('phonopy.force_constants')
 ParameterData = DataFactory('parameter')
 ArrayData = DataFactory('array')
 StructureData = DataFactory('structure')
+RemoteData = DataFactory('remote')
 
 from aiida_phonopy.common.generate_inputs import generate_inputs
 from aiida_phonopy.common.parse_interface import parse_optimize_calculation
+from aiida_phonopy.common.cache import get_optimize_hash, OPTIMIZE_HASH_EXTRA, OPTIMIZE_DEFAULTS
+from aiida_phonopy.common.symmetry import get_standardized_cell, is_standardized_cell
+from aiida_phonopy.common.structure import get_structure_from_arrays, get_phonopy_atoms, is_same_cell
 
 import numpy as np
 
 
+def get_cell_arrays(structure):
+    """
+    Return the structure in spglib format
+
+    :param structure: StructureData object
+    :return: lattice vectors, scaled positions, atomic numbers
+    """
+    bulk = get_phonopy_atoms(structure)
+
+    return np.array(bulk.get_cell()), bulk.get_scaled_positions(), bulk.get_atomic_numbers()
+
+
+def is_standardized(structure, tolerance=1e-5):
+    """
+    Return True if the structure is already the standardized cell (same lattice vectors and
+    atoms, see common/symmetry.is_standardized_cell), so standardize_cell does not need to be run
+
+    :param structure: StructureData object
+    :param tolerance: tolerance in Angstrom
+    """
+    cell, scaled_positions, numbers = get_cell_arrays(structure)
+    return is_standardized_cell(cell, scaled_positions, numbers, symprec=1e-5, tolerance=tolerance)
+
+
+def get_optimize_inputs(structure, es_settings, pressure):
+    """
+    Return the inputs of an OptimizeStructure workchain with the default convergence parameters given explicitly,
+    so the same values are used to submit it and to look for a cached optimization (see get_optimize_hash)
+
+    :param structure: StructureData object
+    :param es_settings: ParameterData object with the electronic structure settings
+    :param pressure: Float object with the external pressure
+    :return: dictionary of inputs
+    """
+    return {'structure': structure,
+            'es_settings': es_settings,
+            'pressure': pressure,
+            'tolerance_forces': Float(OPTIMIZE_DEFAULTS['tolerance_forces']),
+            'tolerance_stress': Float(OPTIMIZE_DEFAULTS['tolerance_stress']),
+            'max_iterations': Int(OPTIMIZE_DEFAULTS['max_iterations']),
+            'standarize_cell': Bool(OPTIMIZE_DEFAULTS['standarize_cell'])}
+
+
 @workfunction
 def standardize_cell(structure):
-    import spglib
-    from phonopy.structure.atoms import Atoms as PhonopyAtoms
     from phonopy.structure.atoms import atom_data
 
-    bulk = PhonopyAtoms(symbols=[site.kind_name for site in structure.sites],
-                        positions=[site.position for site in structure.sites],
-                        cell=structure.cell)
-
-    structure_data = (structure.cell,
-                      bulk.get_scaled_positions(),
-                      bulk.get_atomic_numbers())
+    structure_data = get_cell_arrays(structure)
 
     #lattice, refined_positions, numbers = spglib.refine_cell(structure_data, symprec=1e-5)
-    lattice, standardized_positions, numbers = spglib.standardize_cell(structure_data,
-                                                                       symprec=1e-5,
-                                                                       to_primitive=False,
-                                                                       no_idealize=False)
+    # spglib.standardize_cell (cached, see common/symmetry.py)
+    lattice, standardized_positions, numbers = get_standardized_cell(*structure_data, symprec=1e-5)
 
     symbols = [atom_data[i][1] for i in numbers]
 
-    # print lattice, standardized_positions, numbers
-    # print [site.kind_name for site in structure.sites]
-    standardized_bulk = PhonopyAtoms(symbols=symbols,
-                                     scaled_positions=standardized_positions,
-                                     cell=lattice)
-
     # create new aiida structure object
-    standarized = StructureData(cell=standardized_bulk.get_cell())
-    for position, symbol in zip(standardized_bulk.get_positions(), standardized_bulk.get_chemical_symbols()):
-        standarized.append_atom(position=position,
-                                      symbols=symbol)
+    standarized = get_structure_from_arrays(lattice, np.dot(standardized_positions, lattice), symbols)
 
     return {'standardized_structure': standarized}
 
 
 class OptimizeStructure(WorkChain):
     """
-    Workchain to do crystal structure optimization and ensure proper convergence
+    Workchain to do crystal structure optimization and ensure proper convergence.
+    Converged optimizations are tagged with a hash of their inputs to allow their reuse (see common/cache.py)
+
+    :param parent_folder: (optional) RemoteData object of a previous calculation (e.g. of a similar structure)
+                          from which the first optimization starts (wave functions/charge density)
+    :param write_restart: (optional) Set true to keep the wave functions and charge density of the last
+                          optimization, that is returned as remote_folder output (default: False)
+    :param warm_start: (optional) Set true to start each optimization cycle after the first one from the
+                       wave functions and charge density of the previous cycle. If the cell has changed between
+                       cycles (variable-cell relaxation or standardization) only the charge density is read
+                       (default: False)
     """
 
     @classmethod
@@ -71,10 +109,16 @@ class OptimizeStructure(WorkChain):
         spec.input("es_settings", valid_type=ParameterData)
         # Optional
         spec.input("pressure", valid_type=Float, required=False, default=Float(0.0))
-        spec.input("tolerance_forces", valid_type=Float, required=False, default=Float(1e-5))
-        spec.input("tolerance_stress", valid_type=Float, required=False, default=Float(1e-2))
-        spec.input("max_iterations", valid_type=Int, required=False, default=Int(3))
-        spec.input("standarize_cell", valid_type=Bool, required=False, default=Bool(True))
+        spec.input("tolerance_forces", valid_type=Float, required=False,
+                   default=Float(OPTIMIZE_DEFAULTS['tolerance_forces']))
+        spec.input("tolerance_stress", valid_type=Float, required=False,
+                   default=Float(OPTIMIZE_DEFAULTS['tolerance_stress']))
+        spec.input("max_iterations", valid_type=Int, required=False, default=Int(OPTIMIZE_DEFAULTS['max_iterations']))
+        spec.input("standarize_cell", valid_type=Bool, required=False,
+                   default=Bool(OPTIMIZE_DEFAULTS['standarize_cell']))
+        spec.input("parent_folder", valid_type=RemoteData, required=False)
+        spec.input("write_restart", valid_type=Bool, required=False, default=Bool(False))
+        spec.input("warm_start", valid_type=Bool, required=False, default=Bool(False))
 
         spec.outline(cls.optimize_cycle, _While(cls.not_converged)(cls.optimize_cycle), cls.get_data)
 
@@ -82,7 +126,10 @@ class OptimizeStructure(WorkChain):
 
         print ('Check convergence')
 
-        parsed_data = parse_optimize_calculation(self.ctx.optimize)['output_data']
+        # Parse the last optimization once, it is used by the next cycle and by get_data
+        self.ctx.parsed = parse_optimize_calculation(self.ctx.optimize)
+
+        parsed_data = self.ctx.parsed['output_data']
         forces = np.array(parsed_data.dict.forces)
         stress = np.array(parsed_data.dict.stress)
 
@@ -96,6 +143,7 @@ class OptimizeStructure(WorkChain):
         if not_converged == 0:
             print ('Converged')
             self.report('converged')
+            self.ctx.converged = True
             return False
 
         self.report('Not converged: F:{} S:{}'.format(not_converged_forces, not_converged_stress))
@@ -119,16 +167,35 @@ class OptimizeStructure(WorkChain):
 
         if not 'optimize' in self.ctx:
             structure = self.inputs.structure
+            if 'parent_folder' in self.inputs:
+                parent_folder = self.inputs.parent_folder
+            else:
+                parent_folder = None
         else:
-            structure = parse_optimize_calculation(self.ctx.optimize)['output_structure']
+            structure = self.ctx.parsed['output_structure']
+            parent_folder = None
 
-        if self.inputs.standarize_cell:
+        # Structures already standardized (e.g. the output of a previous cycle) are used directly
+        if self.inputs.standarize_cell and not is_standardized(structure):
             structure = standardize_cell(structure)['standardized_structure']
 
+        # The wave functions of the previous cycle can only be read if its cell has not changed (during the
+        # relaxation or by the standardization), otherwise the calculation starts from its charge density
+        restart_wavefunctions = True
+        if 'optimize' in self.ctx and self.inputs.warm_start:
+            parent_folder = self.ctx.optimize.out.remote_folder
+            restart_wavefunctions = is_same_cell(structure, self.ctx.optimize.inp.structure)
+            if not restart_wavefunctions:
+                self.report('cell changed between cycles, restart from the charge density')
+
         JobCalculation, calculation_input = generate_inputs(structure,
                                                             self.inputs.es_settings,
                                                             pressure=self.inputs.pressure,
                                                             type='optimize',
+                                                            parent_folder=parent_folder,
+                                                            restart_wavefunctions=restart_wavefunctions,
+                                                            write_restart=(bool(self.inputs.write_restart) or
+                                                                           bool(self.inputs.warm_start))
                                                             )
 
         calculation_input._label = 'optimize'
@@ -140,8 +207,20 @@ class OptimizeStructure(WorkChain):
 
     def get_data(self):
 
-        self.out('optimized_structure', parse_optimize_calculation(self.ctx.optimize)['output_structure'])
-        self.out('optimized_structure_data', parse_optimize_calculation(self.ctx.optimize)['output_data'])
+        self.out('optimized_structure', self.ctx.parsed['output_structure'])
+        self.out('optimized_structure_data', self.ctx.parsed['output_data'])
+
+        if self.inputs.write_restart:
+            self.out('remote_folder', self.ctx.optimize.out.remote_folder)
+
+        if self.ctx.get('converged', False):
+            self.calc.set_extra(OPTIMIZE_HASH_EXTRA, get_optimize_hash(self.inputs.structure,
+                                                                       self.inputs.es_settings,
+                                                                       self.inputs.pressure,
+                                                                       self.inputs.tolerance_forces,
+                                                                       self.inputs.tolerance_stress,
+                                                                       self.inputs.max_iterations,
+                                                                       self.inputs.standarize_cell))
 
 
 
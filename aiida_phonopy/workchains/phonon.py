@@ -15,6 +15,18 @@ from aiida.work.workchain import _If, _While
 
 import numpy as np
 from aiida_phonopy.common.generate_inputs import generate_inputs
+from aiida_phonopy.common.parse_interface import get_aggregated_forces
+from aiida_phonopy.common.phonopy_session import get_phonopy, get_phonopy_from_data, get_unitcell_data, \
+    get_phonopy_settings
+from aiida_phonopy.common.local_executor import run_local
+from aiida_phonopy.common.symmetry import get_seekpath_path
+from aiida_phonopy.common.bands import get_band_points
+from aiida_phonopy.common.structure import get_phonopy_atoms, get_structure_from_phonopy_atoms
+from aiida_phonopy.common.mesh import MeshFrequencies, get_mesh_frequencies, get_mesh_thermal_properties, \
+    get_total_dos, get_partial_dos, get_converged_mesh
+from aiida_phonopy.common.cache import get_calculation_hash, get_cached_calculation, set_calculation_hash, \
+    get_optimize_hash, get_cached_optimization
+from aiida_phonopy.workchains.optimize import get_optimize_inputs
 
 # Should be improved by some kind of WorkChainFactory
 # For now all workchains should be copied to aiida/workflows
@@ -25,6 +37,8 @@ ForceSetsData = DataFactory('phonopy.force_sets')
 BandStructureData = DataFactory('phonopy.band_structure')
 PhononDosData = DataFactory('phonopy.phonon_dos')
 NacData = DataFactory('phonopy.nac')
+PhononModelData = DataFactory('phonopy.phonon_model')
+DisplacedSupercellsData = DataFactory('phonopy.displaced_supercells')
 
 ParameterData = DataFactory('parameter')
 ArrayData = DataFactory('array')
@@ -89,24 +103,8 @@ def generate_phonopy_params(code, structure, ph_settings, force_sets=None, force
     return PhonopyCalculation.process(), inputs
 
 
-def wf_like_calculation(work_function):
-    """
-    This function defines decorator to emulate the output stored in self.ctx of remote calculations
-    in local workfunctions
-    :param work_function: @workfunction decorated function
-    :return: corresponding workcalculation function
-    """
-    def work_calculation(*args, **kwargs):
-        return work_function(*args, **kwargs).values()[0].get_inputs_dict().values()[0]
-    return work_calculation
-
-
 def phonopy_bulk_from_structure(structure):
-    from phonopy.structure.atoms import Atoms as PhonopyAtoms
-    bulk = PhonopyAtoms(symbols=[site.kind_name for site in structure.sites],
-                        positions=[site.position for site in structure.sites],
-                        cell=structure.cell)
-    return bulk
+    return get_phonopy_atoms(structure)
 
 
 @workfunction
@@ -117,58 +115,88 @@ def create_supercells_with_displacements_using_phonopy(structure, ph_settings):
 
     :param structure: StructureData object
     :param phonopy_input: ParametersData object containing a dictionary with the data needed for phonopy
-    :return: A set of StructureData Objects containing the supercells with displacements
+    :return: ForceSetsData object with the displacements info and DisplacedSupercellsData object containing
+             the supercells with displacements
     """
-    from phonopy import Phonopy
-
     # Generate phonopy phonon object
-    phonon = Phonopy(phonopy_bulk_from_structure(structure),
-                     supercell_matrix=ph_settings.dict.supercell,
-                     primitive_matrix=ph_settings.dict.primitive,
-                     symprec=ph_settings.dict.symmetry_precision)
+    phonon = get_phonopy(structure, ph_settings)
 
     phonon.generate_displacements(distance=ph_settings.dict.distance)
 
-    cells_with_disp = phonon.get_supercells_with_displacements()
-
-    # Transform cells to StructureData and set them ready to return
     data_sets = phonon.get_displacement_dataset()
     data_sets_object = ForceSetsData(data_sets=data_sets)
 
-    disp_cells = {'data_sets': data_sets_object}
-    for i, phonopy_supercell in enumerate(cells_with_disp):
-        supercell = StructureData(cell=phonopy_supercell.get_cell())
-        for symbol, position in zip(phonopy_supercell.get_chemical_symbols(),
-                                    phonopy_supercell.get_positions()):
-            supercell.append_atom(position=position, symbols=symbol)
-        disp_cells["structure_{}".format(i)] = supercell
+    # Store the perfect supercell and one displacement for each supercell
+    supercell = get_structure_from_phonopy_atoms(phonon.get_supercell())
 
-    return disp_cells
+    supercells = DisplacedSupercellsData(supercell=supercell)
+    supercells.set_displacements([[(first_atoms['number'], first_atoms['displacement'])]
+                                  for first_atoms in data_sets['first_atoms']])
+
+    return {'data_sets': data_sets_object, 'supercells': supercells}
 
 
 @workfunction
-def create_forces_set(**kwargs):
+def create_forces_set(data_sets, forces):
     """
     Build data_sets from forces of supercells with displacments
 
-    :param forces_X: ArrayData objects that contain the atomic forces for each supercell with displacement, respectively (X is integer)
-    :param data_sets: ForceSetsData object that contains the displacements info (This info should match with forces_X)
+    :param data_sets: ForceSetsData object that contains the displacements info (This info should match with forces)
+    :param forces: ArrayData object that contains the atomic forces of all supercells with displacements
+                   (see get_aggregated_forces)
     :return: ForceSetsData object that contains the atomic forces and displacements info (datasets dict in phonopy)
 
     """
-    data_sets = kwargs.pop('data_sets')
     force_sets = ForceSetsData(data_sets=data_sets.get_data_sets())
+    force_sets.set_forces(forces.get_array('forces'))
+
+    return {'force_sets': force_sets}
+
+
+@workfunction
+def get_forces_from_force_engine(es_settings, data_sets, supercells):
+    """
+    Calculate the forces of all supercells with displacements at once using an in-process force engine
+
+    :param es_settings: ParametersData object containing the force engine settings in 'force_engine' entry
+    :param data_sets: ForceSetsData object that contains the displacements info (phonopy or phono3py)
+    :param supercells: DisplacedSupercellsData object that contains the supercells with displacements
+    :return: ForceSetsData object that contains the atomic forces and displacements info
+    """
+    from aiida_phonopy.common.force_engines import get_force_engine
 
-    forces = []
-    for i in range(data_sets.get_number_of_displacements()):
-        forces.append(kwargs.pop('forces_{}'.format(i)).get_array('forces')[-1])
+    if 'ndisplacements_s' in data_sets.get_attrs():
+        force_sets = ForceSetsData(data_sets3=data_sets.get_data_sets3())
+    else:
+        force_sets = ForceSetsData(data_sets=data_sets.get_data_sets())
 
-    force_sets.set_forces(forces)
+    force_engine = get_force_engine(es_settings.dict.force_engine)
+    force_sets.set_forces(force_engine.get_forces(supercells.get_cell(),
+                                                  supercells.get_positions(),
+                                                  supercells.get_symbols()))
 
     return {'force_sets': force_sets}
 
 
-@wf_like_calculation
+def calculate_force_constants(unitcell, settings, force_sets):
+    """
+    Calculate the force constants using phonopy from plain data (run in a worker process, see local_executor.py)
+
+    :param unitcell: dictionary with the unit cell (see phonopy_session.get_unitcell_data)
+    :param settings: dictionary with the phonopy settings (see phonopy_session.get_phonopy_settings)
+    :param force_sets: datasets dictionary in phonopy format (with forces)
+    :return: numpy array with the force constants
+    """
+    # Generate phonopy phonon object
+    phonon = get_phonopy_from_data(unitcell, settings)
+
+    # Build data_sets from forces of supercells with displacments
+    phonon.set_displacement_dataset(force_sets)
+    phonon.produce_force_constants()
+
+    return phonon.get_force_constants()
+
+
 @workfunction
 def get_force_constants_from_phonopy(structure, ph_settings, force_sets):
     """
@@ -179,24 +207,13 @@ def get_force_constants_from_phonopy(structure, ph_settings, force_sets):
     :param force_sets: ForceSetsData object that contains the atomic forces and displacements info (datasets dict in phonopy)
     :return: ForceConstantsData object containing the 2nd order force constants calculated with phonopy
     """
-    from phonopy import Phonopy
 
-    # Generate phonopy phonon object
+    force_constants = run_local(calculate_force_constants,
+                                get_unitcell_data(structure),
+                                get_phonopy_settings(ph_settings),
+                                force_sets.get_force_sets())
 
-    phonon = Phonopy(phonopy_bulk_from_structure(structure),
-                     ph_settings.dict.supercell,
-                     primitive_matrix=ph_settings.dict.primitive,
-                     symprec=ph_settings.dict.symmetry_precision)
-
-    phonon.generate_displacements(distance=ph_settings.dict.distance)
-
-    # Build data_sets from forces of supercells with displacments
-    phonon.set_displacement_dataset(force_sets.get_force_sets())
-    phonon.produce_force_constants()
-
-    force_constants = ForceConstantsData(data=phonon.get_force_constants())
-
-    return {'force_constants': force_constants}
+    return {'force_constants': ForceConstantsData(data=force_constants)}
 
 @workfunction
 def get_nac_from_data(**kwargs):
@@ -211,29 +228,57 @@ def get_nac_from_data(**kwargs):
     return {'nac_data': nac_data}
 
 
-def get_path_using_seekpath(structure, band_resolution=30):
-    import seekpath
+@workfunction
+def get_phonon_model(structure, ph_settings, force_constants, **kwargs):
+    """
+    Create a phonon model (PhononModelData) to evaluate the phonon frequencies at any q-point without phonopy.
+    The non-analytical corrections of the model use the Wang method
+
+    :param structure: StructureData object
+    :param ph_settings: ParameterData object that contains phonopy settings
+    :param force_constants: ForceConstantsData object containing the 2nd order force constants
+    :param nac_data: (optional) NacData object with the non-analytical corrections
+    :return: PhononModelData object
+    """
+    from aiida_phonopy.common.dynamical_matrix import NAC_METHOD
+
+    phonon = get_phonopy(structure, ph_settings)
+    phonon.set_force_constants(force_constants.get_data())
+
+    if 'nac_data' in kwargs:
+        primitive = phonon.get_primitive()
+        nac_parameters = kwargs.pop('nac_data').get_born_parameters_phonopy(primitive_cell=primitive.get_cell())
+        nac_parameters['method'] = NAC_METHOD
+        phonon.set_nac_params(nac_parameters)
 
+    return {'phonon_model': PhononModelData(phonon=phonon)}
+
+
+def get_path_using_seekpath(structure, band_resolution=30, band_points=None):
+    """
+    Return the band structure path of a structure obtained with seekpath
+
+    :param structure: StructureData object (primitive cell)
+    :param band_resolution: number of intervals in each band (used if band_points is None)
+    :param band_points: total number of q-points distributed in proportion to the length of each band. The bands
+                        have a different number of q-points, which is not supported by remote phonopy calculations
+    :return: BandStructureData object
+    """
     phonopy_structure = phonopy_bulk_from_structure(structure)
     cell = phonopy_structure.get_cell()
     scaled_positions = phonopy_structure.get_scaled_positions()
     numbers = phonopy_structure.get_atomic_numbers()
 
-    structure = (cell, scaled_positions, numbers)
-    path_data = seekpath.get_path(structure)
+    path_data = get_seekpath_path(cell, scaled_positions, numbers)
 
     labels = path_data['point_coords']
 
-    band_ranges = []
-    for set in path_data['path']:
-        band_ranges.append([labels[set[0]], labels[set[1]]])
+    band_ranges = np.array([[labels[start], labels[end]] for start, end in path_data['path']], dtype=float)
 
-    bands =[]
-    for q_start, q_end in band_ranges:
-        band = []
-        for i in range(band_resolution+1):
-            band.append(np.array(q_start) + (np.array(q_end) - np.array(q_start)) / band_resolution * i)
-        bands.append(band)
+    bands = get_band_points(band_ranges,
+                            np.linalg.inv(phonopy_structure.get_cell()).T,
+                            band_resolution=band_resolution,
+                            band_points=band_points)
 
     band_structure = BandStructureData(bands=bands,
                                        labels=path_data['path'],
@@ -243,27 +288,125 @@ def get_path_using_seekpath(structure, band_resolution=30):
 @workfunction
 def get_primitive(structure, ph_settings):
 
-    from phonopy import Phonopy
+    phonon = get_phonopy(structure, ph_settings)
+
+    primitive_structure = get_structure_from_phonopy_atoms(phonon.get_primitive())
+
+    return {'primitive_structure': primitive_structure}
+
 
-    phonon = Phonopy(phonopy_bulk_from_structure(structure),
-                     supercell_matrix=ph_settings.dict.supercell,
-                     primitive_matrix=ph_settings.dict.primitive,
-                     symprec=ph_settings.dict.symmetry_precision)
+@workfunction
+def get_supercell(structure, ph_settings):
 
-    primitive_phonopy = phonon.get_primitive()
+    phonon = get_phonopy(structure, ph_settings)
 
-    primitive_cell = primitive_phonopy.get_cell()
-    symbols = primitive_phonopy.get_chemical_symbols()
-    positions = primitive_phonopy.get_positions()
+    supercell = get_structure_from_phonopy_atoms(phonon.get_supercell())
 
-    primitive_structure = StructureData(cell=primitive_cell)
-    for symbol, position in zip(symbols, positions):
-        primitive_structure.append_atom(position=position, symbols=symbol)
+    return {'supercell': supercell}
 
-    return {'primitive_structure': primitive_structure}
+
+def get_mesh_frequencies_in_blocks(unitcell, settings, mesh, force_constants, n_blocks, nac_parameters=None,
+                                   projected_dos=True, mesh_tolerance=None):
+    """
+    Calculate the phonon frequencies of the q-points mesh split in blocks of q-points that are calculated
+    in parallel in the worker processes (see common/mesh.py). This function must be run in the calling process.
+
+    :param n_blocks: number of blocks of q-points
+    :return: dictionary with the mesh data to be used in calculate_phonon_properties (mesh_frequencies)
+    """
+    if mesh_tolerance is not None:
+        def mesh_thermal_properties(current_mesh):
+            mesh_data = get_mesh_frequencies(unitcell, settings, current_mesh, force_constants, n_blocks,
+                                             nac_parameters=nac_parameters)
+            return get_mesh_thermal_properties(MeshFrequencies(None, **mesh_data))
+
+        mesh = get_converged_mesh(mesh_thermal_properties, mesh, mesh_tolerance)
+
+    # Eigenvectors at all q-points are needed for the partial DOS
+    return get_mesh_frequencies(unitcell, settings, mesh, force_constants, n_blocks,
+                                nac_parameters=nac_parameters,
+                                is_eigenvectors=projected_dos,
+                                is_mesh_symmetry=not projected_dos)
+
+
+def calculate_phonon_properties(unitcell, settings, mesh, force_constants, bands, nac_parameters=None,
+                                projected_dos=True, mesh_tolerance=None, mesh_frequencies=None):
+    """
+    Calculate DOS, thermal properties and band structure using phonopy from plain data
+    (run in a worker process, see local_executor.py)
+
+    :param unitcell: dictionary with the unit cell (see phonopy_session.get_unitcell_data)
+    :param settings: dictionary with the phonopy settings (see phonopy_session.get_phonopy_settings)
+    :param mesh: q-points mesh
+    :param force_constants: numpy array with the force constants
+    :param bands: list of q-points of each band (band structure path)
+    :param nac_parameters: dictionary with the non-analytical corrections in phonopy format
+    :param projected_dos: if False, the partial DOS is not calculated and the irreducible q-points mesh
+                          (without eigenvectors) is used for the total DOS and thermal properties
+    :param mesh_tolerance: if set, use the coarsest mesh (up to mesh) at which the thermal properties are
+                           converged within this relative tolerance (see get_converged_mesh)
+    :param mesh_frequencies: frequencies of the q-points mesh already calculated in blocks (see
+                             get_mesh_frequencies_in_blocks). If set, mesh and mesh_tolerance are not used
+    :return: dictionary with the results (per primitive cell)
+    """
+
+    phonon = get_phonopy_from_data(unitcell, settings)
+
+    phonon.set_force_constants(force_constants)
+
+    if nac_parameters is not None:
+        phonon.set_nac_params(nac_parameters)
+
+    if mesh_frequencies is not None:
+        mesh = mesh_frequencies['mesh']
+        mesh_object = MeshFrequencies(phonon.get_dynamical_matrix(), **mesh_frequencies)
+
+        # DOS
+        partial_dos = get_partial_dos(mesh_object) if projected_dos else None
+        total_dos = get_total_dos(mesh_object)
+
+        # THERMAL PROPERTIES (per primtive cell)
+        thermal_properties = get_mesh_thermal_properties(mesh_object)
+
+    else:
+        if mesh_tolerance is not None:
+            def mesh_thermal_properties(current_mesh):
+                phonon.set_mesh(current_mesh, is_eigenvectors=False, is_mesh_symmetry=True)
+                phonon.set_thermal_properties()
+                return phonon.get_thermal_properties()
+
+            mesh = get_converged_mesh(mesh_thermal_properties, mesh, mesh_tolerance)
+
+        # DOS
+        if projected_dos:
+            # Eigenvectors at all q-points are needed for the partial DOS
+            phonon.set_mesh(mesh, is_eigenvectors=True, is_mesh_symmetry=False)
+            phonon.set_partial_DOS(tetrahedron_method=True)
+            partial_dos = phonon.get_partial_DOS()
+        else:
+            phonon.set_mesh(mesh, is_eigenvectors=False, is_mesh_symmetry=True)
+            partial_dos = None
+
+        phonon.set_total_DOS(tetrahedron_method=True)
+        total_dos = phonon.get_total_DOS()
+
+        # THERMAL PROPERTIES (per primtive cell)
+        phonon.set_thermal_properties()
+        thermal_properties = phonon.get_thermal_properties()
+
+    # BAND STRUCTURE
+    phonon.set_band_structure(bands)
+
+    return {'mesh': mesh,
+            'total_dos': total_dos,
+            'partial_dos': partial_dos,
+            'thermal_properties': thermal_properties,
+            'band_structure': phonon.get_band_structure(),
+            'atom_labels': phonon.primitive.get_chemical_symbols(),
+            # Normalization factor primitive to unit cell
+            'normalization_factor': phonon.unitcell.get_number_of_atoms()/phonon.primitive.get_number_of_atoms()}
 
 
-@wf_like_calculation
 @workfunction
 def get_properties_from_phonopy(**kwargs):
     """
@@ -281,40 +424,56 @@ def get_properties_from_phonopy(**kwargs):
     force_constants = kwargs.pop('force_constants')
     bands = kwargs.pop('bands')
 
-    from phonopy import Phonopy
-
-    phonon = Phonopy(phonopy_bulk_from_structure(structure),
-                     supercell_matrix=ph_settings.dict.supercell,
-                     primitive_matrix=ph_settings.dict.primitive,
-                     symprec=ph_settings.dict.symmetry_precision)
-
-    phonon.set_force_constants(force_constants.get_data())
-
     if 'nac_data' in kwargs:
         print ('use born charges')
         nac_data = kwargs.pop('nac_data')
-        primitive = phonon.get_primitive()
+        primitive = get_phonopy(structure, ph_settings).get_primitive()
         nac_parameters = nac_data.get_born_parameters_phonopy(primitive_cell=primitive.get_cell())
-        phonon.set_nac_params(nac_parameters)
-
-    # Normalization factor primitive to unit cell
-    normalization_factor = phonon.unitcell.get_number_of_atoms()/phonon.primitive.get_number_of_atoms()
+    else:
+        nac_parameters = None
+
+    unitcell = get_unitcell_data(structure)
+    settings = get_phonopy_settings(ph_settings)
+    projected_dos = ph_settings.get_dict().get('projected_dos', True)
+    mesh_tolerance = ph_settings.get_dict().get('mesh_tolerance')
+
+    # Calculate the q-points of the mesh in parallel blocks
+    if 'mesh_blocks' in ph_settings.get_dict():
+        mesh_frequencies = get_mesh_frequencies_in_blocks(unitcell,
+                                                          settings,
+                                                          ph_settings.dict.mesh,
+                                                          force_constants.get_data(),
+                                                          ph_settings.dict.mesh_blocks,
+                                                          nac_parameters=nac_parameters,
+                                                          projected_dos=projected_dos,
+                                                          mesh_tolerance=mesh_tolerance)
+    else:
+        mesh_frequencies = None
+
+    properties = run_local(calculate_phonon_properties,
+                           unitcell,
+                           settings,
+                           ph_settings.dict.mesh,
+                           force_constants.get_data(),
+                           bands.get_bands(),
+                           nac_parameters=nac_parameters,
+                           projected_dos=projected_dos,
+                           mesh_tolerance=mesh_tolerance,
+                           mesh_frequencies=mesh_frequencies)
+
+    normalization_factor = properties['normalization_factor']
 
     # DOS
-    phonon.set_mesh(ph_settings.dict.mesh, is_eigenvectors=True, is_mesh_symmetry=False)
-    phonon.set_total_DOS(tetrahedron_method=True)
-    phonon.set_partial_DOS(tetrahedron_method=True)
-
-    total_dos = phonon.get_total_DOS()
-    partial_dos = phonon.get_partial_DOS()
+    total_dos = properties['total_dos']
+    partial_dos = properties['partial_dos']
     dos = PhononDosData(frequencies=total_dos[0],
                         dos=total_dos[1]*normalization_factor,
-                        partial_dos=np.array(partial_dos[1])*normalization_factor,
-                        atom_labels=np.array(phonon.primitive.get_chemical_symbols()))
+                        atom_labels=np.array(properties['atom_labels']))
+    if partial_dos is not None:
+        dos.set_partial_dos(np.array(partial_dos[1])*normalization_factor)
 
     # THERMAL PROPERTIES (per primtive cell)
-    phonon.set_thermal_properties()
-    t, free_energy, entropy, cv = phonon.get_thermal_properties()
+    t, free_energy, entropy, cv = properties['thermal_properties']
 
     # Stores thermal properties (per unit cell) data in DB as a workflow result
     thermal_properties = ArrayData()
@@ -325,14 +484,18 @@ def get_properties_from_phonopy(**kwargs):
 
     # BAND STRUCTURE
     # band_structure = get_path_using_seekpath2(phonon.get_primitive())
-    phonon.set_band_structure(bands.get_bands())
     band_structure = BandStructureData(bands=bands.get_bands(),
                                        labels=bands.get_labels(),
                                        unitcell=bands.get_unitcell())
 
-    band_structure.set_band_structure_phonopy(phonon.get_band_structure())
+    band_structure.set_band_structure_phonopy(properties['band_structure'])
+
+    results = {'thermal_properties': thermal_properties, 'dos': dos, 'band_structure': band_structure}
 
-    return {'thermal_properties': thermal_properties, 'dos': dos, 'band_structure': band_structure}
+    if 'mesh_tolerance' in ph_settings.get_dict():
+        results['converged_mesh'] = ParameterData(dict={'mesh': properties['mesh']})
+
+    return results
 
 
 class PhononPhonopy(WorkChain):
@@ -349,12 +512,22 @@ class PhononPhonopy(WorkChain):
                                                 [0.0, 0.0, 1.0]],
                                   'distance': 0.01,
                                   'mesh': [40, 40, 40],
+                                  # 'projected_dos': False  # use the irreducible q-points mesh (no partial DOS)
+                                  # 'mesh_tolerance': 1e-3  # refine a coarse mesh (up to 'mesh') until thermal properties converge
+                                  # 'mesh_blocks': 8  # calculate the mesh in 8 blocks of q-points in parallel (worker processes)
+                                  # 'band_points': 300  # q-points of the band structure path distributed by band length
+                                  # 'phonon_model': True  # also return the phonon model (PhononModelData) output
                                   # 'code': 'phonopy@boston'  # include this to run phonopy remotely otherwise run phonopy localy
 
     :param es_settings: ParametersData object that contains a dictionary with the setting needed to calculate the electronic structure.
                         The structure of this dictionary strongly depends on the software (VASP, QE, LAMMPS, ...)
+                        If it contains a 'force_engine' entry the forces are calculated in-process (see common/force_engines.py)
     :param optimize: Set true to perform a crystal structure optimization before the phonon calculation (default: True)
     :param pressure: Set the external pressure (stress tensor) at which the optimization is performed in KBar (default: 0)
+    :param use_restart: Set true to calculate first the perfect supercell and start the calculations of the supercells
+                        with displacements from its wave functions and charge density (default: False)
+    :param use_cache: Set true to reuse finished force calculations of identical supercells with identical
+                      es_settings (from this or previous workchains) instead of submitting them again (default: False)
     """
     @classmethod
     def define(cls, spec):
@@ -366,8 +539,11 @@ class PhononPhonopy(WorkChain):
         spec.input("optimize", valid_type=Bool, required=False, default=Bool(True))
         spec.input("pressure", valid_type=Float, required=False, default=Float(0.0))
         spec.input("use_nac", valid_type=Bool, required=False, default=Bool(False))
+        spec.input("use_restart", valid_type=Bool, required=False, default=Bool(False))
+        spec.input("use_cache", valid_type=Bool, required=False, default=Bool(False))
 
         spec.outline(_If(cls.use_optimize)(cls.optimize),
+                     _If(cls.use_restart)(cls.calculate_perfect_supercell),
                      cls.create_displacement_calculations,
                      cls.get_force_constants,
                      cls.calculate_phonon_properties,
@@ -379,11 +555,17 @@ class PhononPhonopy(WorkChain):
 
     def optimize(self):
         print ('start optimize')
-        future = submit(OptimizeStructure,
-                        structure=self.inputs.structure,
-                        es_settings=self.inputs.es_settings,
-                        pressure=self.inputs.pressure,
-                        )
+
+        optimize_inputs = get_optimize_inputs(self.inputs.structure, self.inputs.es_settings, self.inputs.pressure)
+
+        if self.inputs.use_cache:
+            cached_optimization = get_cached_optimization(get_optimize_hash(**optimize_inputs))
+            if cached_optimization is not None:
+                self.report('optimization reused pk = {}'.format(cached_optimization.pk))
+                self.ctx._content['optimized'] = cached_optimization
+                return
+
+        future = submit(OptimizeStructure, **optimize_inputs)
         if __testing__:
             self.ctx._content['optimize'] = load_node(9357)
             return
@@ -392,22 +574,54 @@ class PhononPhonopy(WorkChain):
 
         return ToContext(optimized=future)
 
+    def use_restart(self):
+        return self.inputs.use_restart and 'force_engine' not in self.inputs.es_settings.get_dict()
+
+    def get_final_structure(self):
+        if 'optimized' in self.ctx:
+            return self.ctx.optimized.out.optimized_structure
+        return self.inputs.structure
+
+    def calculate_perfect_supercell(self):
+        self.report('calculate perfect supercell')
+
+        supercell = get_supercell(self.get_final_structure(), self.inputs.ph_settings)['supercell']
+
+        JobCalculation, calculation_input = generate_inputs(supercell,
+                                                            self.inputs.es_settings,
+                                                            type='forces',
+                                                            write_restart=True)
+
+        calculation_input._label = 'perfect_supercell'
+        future = submit(JobCalculation, **calculation_input)
+        self.report('perfect_supercell pk = {}'.format(future.pid))
+
+        return ToContext(perfect_supercell=future)
+
     def create_displacement_calculations(self):
         self.report('create displacements')
 
+        self.ctx.final_structure = self.get_final_structure()
         if 'optimized' in self.ctx:
-            self.ctx.final_structure = self.ctx.optimized.out.optimized_structure
             self.out('optimized_data', self.ctx.optimized.out.optimized_structure_data)
-        else:
-            self.ctx.final_structure = self.inputs.structure
 
         self.ctx.primitive_structure = get_primitive(self.ctx.final_structure, self.inputs.ph_settings)['primitive_structure']
 
-        supercells = create_supercells_with_displacements_using_phonopy(self.ctx.final_structure,
-                                                                        self.inputs.ph_settings)
+        displacements = create_supercells_with_displacements_using_phonopy(self.ctx.final_structure,
+                                                                           self.inputs.ph_settings)
 
-        self.ctx.data_sets = supercells.pop('data_sets')
-        self.ctx.number_of_displacements = len(supercells)
+        self.ctx.data_sets = displacements['data_sets']
+        self.ctx.supercells = displacements['supercells']
+        self.ctx.number_of_displacements = self.ctx.supercells.get_number_of_supercells()
+
+        if 'force_engine' in self.inputs.es_settings.get_dict():
+            self.report('calculate forces using in-process force engine')
+            self.ctx.force_sets = get_forces_from_force_engine(es_settings=self.inputs.es_settings,
+                                                               data_sets=self.ctx.data_sets,
+                                                               supercells=self.ctx.supercells)['force_sets']
+            if bool(self.inputs.use_nac):
+                self.report('born charges cannot be calculated using a force engine (skipped)')
+            return
 
         calcs = {}
 
@@ -423,20 +637,38 @@ class PhononPhonopy(WorkChain):
             self.ctx._content['single_point'] = load_node(30084)
             return
 
+        if 'perfect_supercell' in self.ctx:
+            parent_folder = self.ctx.perfect_supercell.out.remote_folder
+        else:
+            parent_folder = None
+
         # Forces
-        for label, supercell in supercells.iteritems():
+        for i, supercell in enumerate(self.ctx.supercells.get_supercells()):
+            label = 'structure_{}'.format(i)
 
             JobCalculation, calculation_input = generate_inputs(supercell,
                                                                 # self.inputs.machine,
                                                                 self.inputs.es_settings,
                                                                 # pressure=self.input.pressure,
-                                                                type='forces')
+                                                                type='forces',
+                                                                parent_folder=parent_folder)
+
+            if self.inputs.use_cache:
+                calculation_hash = get_calculation_hash(calculation_input)
+                cached_calculation = get_cached_calculation(calculation_hash)
+                if cached_calculation is not None:
+                    self.report('{} reused pk = {}'.format(label, cached_calculation.pk))
+                    self.ctx._content[label] = cached_calculation
+                    continue
 
             calculation_input._label = label
             future = submit(JobCalculation, **calculation_input)
             # print label, future.pid
             self.report('{} pk = {}'.format(label, future.pid))
 
+            if self.inputs.use_cache:
+                set_calculation_hash(future.pid, calculation_hash)
+
             calcs[label] = future
 
         # Born charges
@@ -457,17 +689,12 @@ class PhononPhonopy(WorkChain):
         print ('calculate force constants')
         self.report('calculate force constants')
 
-        wf_inputs = {}
-        for i in range(self.ctx.number_of_displacements):
-            # This has to be changed to make uniform plugin interface
-            try:
-                wf_inputs['forces_{}'.format(i)] = self.ctx.get('structure_{}'.format(i)).out.output_trajectory
-            except:
-                wf_inputs['forces_{}'.format(i)] = self.ctx.get('structure_{}'.format(i)).out.output_array
-
-        wf_inputs['data_sets'] = self.ctx.data_sets
+        if 'force_sets' not in self.ctx:
+            calcs = [self.ctx.get('structure_{}'.format(i)) for i in range(self.ctx.number_of_displacements)]
+            forces = get_aggregated_forces(calcs)
 
-        self.ctx.force_sets = create_forces_set(**wf_inputs)['force_sets']
+            self.ctx.force_sets = create_forces_set(data_sets=self.ctx.data_sets,
+                                                    forces=forces)['force_sets']
 
         if 'code' in self.inputs.ph_settings.get_dict():
             print ('remote phonopy FC calculation')
@@ -482,11 +709,12 @@ class PhononPhonopy(WorkChain):
             return ToContext(phonopy_output=future)
         else:
             print ('local phonopy FC calculation')
-            self.ctx.phonopy_output = get_force_constants_from_phonopy(structure=self.ctx.final_structure,
-                                                                       ph_settings=self.inputs.ph_settings,
-                                                                       force_sets=self.ctx.force_sets)
+            future = async(get_force_constants_from_phonopy,
+                           structure=self.ctx.final_structure,
+                           ph_settings=self.inputs.ph_settings,
+                           force_sets=self.ctx.force_sets)
 
-        return
+            return ToContext(phonopy_output=future)
 
     def calculate_phonon_properties(self):
 
@@ -497,7 +725,12 @@ class PhononPhonopy(WorkChain):
         force_constants = self.ctx.phonopy_output.out.force_constants
         self.out('force_constants', force_constants)
 
-        bands = get_path_using_seekpath(self.ctx.primitive_structure, band_resolution=30)
+        # Remote phonopy requires the same number of q-points in each band
+        if 'band_points' in self.inputs.ph_settings.get_dict() and 'code' not in self.inputs.ph_settings.get_dict():
+            bands = get_path_using_seekpath(self.ctx.primitive_structure,
+                                            band_points=self.inputs.ph_settings.dict.band_points)
+        else:
+            bands = get_path_using_seekpath(self.ctx.primitive_structure, band_resolution=30)
 
         phonopy_inputs = {'structure': self.ctx.final_structure,
                           'ph_settings': self.inputs.ph_settings,
@@ -511,6 +744,12 @@ class PhononPhonopy(WorkChain):
             phonopy_inputs.update(nac_data)
             self.out('nac_data', nac_data['nac_data'])
 
+        if self.inputs.ph_settings.get_dict().get('phonon_model', False):
+            model_inputs = {name: phonopy_inputs[name] for name in ['structure', 'ph_settings', 'force_constants']}
+            if 'nac_data' in phonopy_inputs:
+                model_inputs['nac_data'] = phonopy_inputs['nac_data']
+            self.out('phonon_model', get_phonon_model(**model_inputs)['phonon_model'])
+
         if 'code' in self.inputs.ph_settings.get_dict():
             print ('remote phonopy FC calculation')
             code_label = self.inputs.ph_settings.get_dict()['code']
@@ -522,7 +761,9 @@ class PhononPhonopy(WorkChain):
             return ToContext(phonon_properties=future)
         else:
             print ('local phonopy calculation')
-            self.ctx.phonon_properties = get_properties_from_phonopy(**phonopy_inputs)
+            future = async(get_properties_from_phonopy, **phonopy_inputs)
+
+            return ToContext(phonon_properties=future)
 
     def collect_data(self):
 
@@ -531,6 +772,9 @@ class PhononPhonopy(WorkChain):
         self.out('band_structure', self.ctx.phonon_properties.out.band_structure)
         self.out('final_structure', self.ctx.final_structure)
 
+        if 'converged_mesh' in self.ctx.phonon_properties.get_outputs_dict():
+            self.out('converged_mesh', self.ctx.phonon_properties.out.converged_mesh)
+
         self.report('finish phonon')
 
         return
@@ -15,6 +15,14 @@ from aiida.work.workchain import _If, _While
 
 import numpy as np
 from aiida_phonopy.common.generate_inputs import generate_inputs
+from aiida_phonopy.common.parse_interface import get_aggregated_forces
+from aiida_phonopy.common.phonopy_session import get_unitcell_data, get_phonopy_settings
+from aiida_phonopy.common.local_executor import run_local
+from aiida_phonopy.common.chunks import get_number_of_chunks, get_chunk_indices
+from aiida_phonopy.common.structure import get_phonopy_atoms, get_structure_from_phonopy_atoms
+from aiida_phonopy.common.cache import get_calculation_hash, get_cached_calculation, set_calculation_hash, \
+    get_optimize_hash, get_cached_optimization
+from aiida_phonopy.workchains.optimize import get_optimize_inputs
 
 # Should be improved by some kind of WorkChainFactory
 # For now all workchains should be copied to aiida/workflows
@@ -25,6 +33,7 @@ ForceSetsData = DataFactory('phonopy.force_sets')
 BandStructureData = DataFactory('phonopy.band_structure')
 PhononDosData = DataFactory('phonopy.phonon_dos')
 NacData = DataFactory('phonopy.nac')
+DisplacedSupercellsData = DataFactory('phonopy.displaced_supercells')
 
 ParameterData = DataFactory('parameter')
 ArrayData = DataFactory('array')
@@ -43,14 +52,13 @@ def create_supercells_with_displacements_using_phono3py(structure, ph_settings):
 
     :param structure: StructureData object
     :param phonopy_input: ParametersData object containing a dictionary with the data needed for phonopy
-    :return: A set of StructureData Objects containing the supercells with displacements
+    :return: ForceSetsData object with the displacements info and DisplacedSupercellsData object containing
+             the supercells with displacements
     """
     from phono3py.phonon3 import Phono3py
 
-    from aiida_phonopy.workchains.phonon import phonopy_bulk_from_structure
-
     # Generate phonopy phonon object
-    phono3py = Phono3py(phonopy_bulk_from_structure(structure),
+    phono3py = Phono3py(get_phonopy_atoms(structure),
                         supercell_matrix=ph_settings.dict.supercell,
                         primitive_matrix=ph_settings.dict.primitive,
                         symprec=ph_settings.dict.symmetry_precision,
@@ -58,64 +66,85 @@ def create_supercells_with_displacements_using_phono3py(structure, ph_settings):
 
     phono3py.generate_displacements(distance=ph_settings.dict.distance)
 
-    cells_with_disp = phono3py.get_supercells_with_displacements()
-
-    # Transform cells to StructureData and set them ready to return
     data_sets = phono3py.get_displacement_dataset()
     data_sets_object = ForceSetsData(data_sets3=data_sets)
 
-    disp_cells = {'data_sets': data_sets_object}
-    for i, phonopy_supercell in enumerate(cells_with_disp):
-        supercell = StructureData(cell=phonopy_supercell.get_cell())
-        for symbol, position in zip(phonopy_supercell.get_chemical_symbols(),
-                                    phonopy_supercell.get_positions()):
-            supercell.append_atom(position=position, symbols=symbol)
-        disp_cells["structure_{}".format(i)] = supercell
+    # Store the perfect supercell and the displacements of each supercell following phono3py order:
+    # first the supercells with one displacement and then the ones with a pair of displacements
+    supercell = get_structure_from_phonopy_atoms(phono3py.get_supercell())
+
+    displacements = []
+    for first_atoms in data_sets['first_atoms']:
+        displacements.append([(first_atoms['number'], first_atoms['displacement'])])
+
+    for first_atoms in data_sets['first_atoms']:
+        for second_atoms in first_atoms['second_atoms']:
+            displacements.append([(first_atoms['number'], first_atoms['displacement']),
+                                  (second_atoms['number'], second_atoms['displacement'])])
+
+    supercells = DisplacedSupercellsData(supercell=supercell)
+    supercells.set_displacements(displacements)
 
-    return disp_cells
+    return {'data_sets': data_sets_object, 'supercells': supercells}
 
 
 @workfunction
-def create_forces_set(**kwargs):
+def create_forces_set(data_sets, forces):
     """
     Build data_sets from forces of supercells with displacments
 
-    :param forces_X: ArrayData objects that contain the atomic forces for each supercell with displacement, respectively (X is integer)
-    :param data_sets: ForceSetsData object that contains the displacements info (This info should match with forces_X)
+    :param data_sets: ForceSetsData object that contains the displacements info (This info should match with forces)
+    :param forces: ArrayData object that contains the atomic forces of all supercells with displacements
+                   (see get_aggregated_forces)
     :return: ForceSetsData object that contains the atomic forces and displacements info (datasets dict in phonopy)
 
     """
-    data_sets = kwargs.pop('data_sets')
     force_sets = ForceSetsData(data_sets3=data_sets.get_data_sets3())
-
-    forces = []
-    for i in range(data_sets.get_number_of_displacements()):
-        forces.append(kwargs.pop('forces_{}'.format(i)).get_array('forces')[-1])
-
-    force_sets.set_forces(forces)
+    force_sets.set_forces(forces.get_array('forces'))
 
     return {'force_sets': force_sets}
 
-@workfunction
-def get_force_constants3(data_sets, structure, ph_settings):
 
+def calculate_force_constants3(unitcell, settings, forces, data_sets):
+    """
+    Calculate the 2nd and 3rd order force constants using phono3py from plain data
+    (run in a worker process, see local_executor.py)
+
+    :param unitcell: dictionary with the unit cell (see phonopy_session.get_unitcell_data)
+    :param settings: dictionary with the phonopy settings (see phonopy_session.get_phonopy_settings)
+    :param forces: list of the atomic forces of each supercell with displacements
+    :param data_sets: displacement dataset in phono3py format
+    :return: numpy arrays with the 2nd and 3rd order force constants
+    """
     from phono3py.phonon3 import Phono3py
-    from aiida_phonopy.workchains.phonon import phonopy_bulk_from_structure
+    from phonopy.structure.atoms import Atoms as PhonopyAtoms
 
     # Generate phonopy phonon object
-    phono3py = Phono3py(phonopy_bulk_from_structure(structure),
-                        supercell_matrix=ph_settings.dict.supercell,
-                        primitive_matrix=ph_settings.dict.primitive,
-                        symprec=ph_settings.dict.symmetry_precision,
+    phono3py = Phono3py(PhonopyAtoms(symbols=unitcell['symbols'],
+                                     positions=unitcell['positions'],
+                                     cell=unitcell['cell']),
+                        supercell_matrix=settings['supercell'],
+                        primitive_matrix=settings['primitive'],
+                        symprec=settings['symmetry_precision'],
                         log_level=1)
 
-    phono3py.produce_fc3(data_sets.get_forces3(),
-                         displacement_dataset=data_sets.get_data_sets3(),
+    phono3py.produce_fc3(forces,
+                         displacement_dataset=data_sets,
                          is_translational_symmetry=True,
                          is_permutation_symmetry=True,
                          is_permutation_symmetry_fc2=True)
-    fc3 = phono3py.get_fc3()
-    fc2 = phono3py.get_fc2()
+
+    return phono3py.get_fc2(), phono3py.get_fc3()
+
+
+@workfunction
+def get_force_constants3(data_sets, structure, ph_settings):
+
+    fc2, fc3 = run_local(calculate_force_constants3,
+                         get_unitcell_data(structure),
+                         get_phonopy_settings(ph_settings),
+                         data_sets.get_forces3(),
+                         data_sets.get_data_sets3())
 
     force_constants_2 = ForceConstantsData(data=fc2)
     force_constants_3 = ForceConstantsData(data=fc3)
@@ -157,12 +186,16 @@ class PhononPhono3py(WorkChain):
         spec.input("use_nac", valid_type=Bool, required=False, default=Bool(False))  # false by default
         spec.input("calculate_fc", valid_type=Bool, required=False, default=Bool(False))  # false by default
         spec.input("chunks", valid_type=Int, required=False, default=Int(100))
+        spec.input("use_restart", valid_type=Bool, required=False, default=Bool(False))
+        spec.input("use_cache", valid_type=Bool, required=False, default=Bool(False))
 
         spec.outline(_If(cls.use_optimize)(cls.optimize),
+                     _If(cls.use_restart)(cls.calculate_perfect_supercell),
                      # cls.create_displacement_calculations,
+                     cls.create_displacements,
                      _While(cls.continue_submitting)(cls.create_displacement_calculations_chunk),
                      cls.collect_data,
-                     _If(cls.calculate_fc)(cls.calculate_force_constants))
+                     _If(cls.calculate_fc)(cls.calculate_force_constants, cls.collect_force_constants))
         # spec.outline(cls.calculate_force_constants)  # testing
 
     def use_optimize(self):
@@ -172,21 +205,25 @@ class PhononPhono3py(WorkChain):
     def calculate_fc(self):
         return self.inputs.calculate_fc
 
-    def continue_submitting(self):
+    def use_restart(self):
+        return self.inputs.use_restart and 'force_engine' not in self.inputs.es_settings.get_dict()
 
-        if 'i_disp' in self.ctx:
-            if self.ctx.i_disp < 1:
-                return False
-            self.ctx.i_disp -= 1
-        return True
+    def continue_submitting(self):
+        return self.ctx.i_disp > 0
 
     def optimize(self):
         print ('start optimize')
-        future = submit(OptimizeStructure,
-                        structure=self.inputs.structure,
-                        es_settings=self.inputs.es_settings,
-                        pressure=self.inputs.pressure,
-                        )
+
+        optimize_inputs = get_optimize_inputs(self.inputs.structure, self.inputs.es_settings, self.inputs.pressure)
+
+        if self.inputs.use_cache:
+            cached_optimization = get_cached_optimization(get_optimize_hash(**optimize_inputs))
+            if cached_optimization is not None:
+                self.report('optimization reused pk = {}'.format(cached_optimization.pk))
+                self.ctx._content['optimized'] = cached_optimization
+                return
+
+        future = submit(OptimizeStructure, **optimize_inputs)
         if __testing__:
             self.ctx._content['optimize'] = load_node(9357)
             return
@@ -195,6 +232,30 @@ class PhononPhono3py(WorkChain):
 
         return ToContext(optimized=future)
 
+    def calculate_perfect_supercell(self):
+
+        from aiida_phonopy.workchains.phonon import get_supercell
+
+        self.report('calculate perfect supercell')
+
+        if 'optimized' in self.ctx:
+            structure = self.ctx.optimized.out.optimized_structure
+        else:
+            structure = self.inputs.structure
+
+        supercell = get_supercell(structure, self.inputs.ph_settings)['supercell']
+
+        JobCalculation, calculation_input = generate_inputs(supercell,
+                                                            self.inputs.es_settings,
+                                                            type='forces',
+                                                            write_restart=True)
+
+        calculation_input._label = 'perfect_supercell'
+        future = submit(JobCalculation, **calculation_input)
+        print ('perfect_supercell pk = {}'.format(future.pid))
+
+        return ToContext(perfect_supercell=future)
+
     def create_displacement_calculations(self):
 
         from aiida_phonopy.workchains.phonon import get_primitive
@@ -211,11 +272,12 @@ class PhononPhono3py(WorkChain):
         self.ctx.primitive_structure = get_primitive(self.ctx.final_structure,
                                                      self.inputs.ph_settings)['primitive_structure']
 
-        supercells = create_supercells_with_displacements_using_phono3py(self.ctx.final_structure,
-                                                                         self.inputs.ph_settings)
+        displacements = create_supercells_with_displacements_using_phono3py(self.ctx.final_structure,
+                                                                            self.inputs.ph_settings)
 
-        self.ctx.data_sets = supercells.pop('data_sets')
-        self.ctx.number_of_displacements = len(supercells)
+        self.ctx.data_sets = displacements['data_sets']
+        self.ctx.supercells = displacements['supercells']
+        self.ctx.number_of_displacements = self.ctx.supercells.get_number_of_supercells()
 
         if __testing__:
             f = open('labels', 'r')
@@ -235,7 +297,8 @@ class PhononPhono3py(WorkChain):
             return
 
         calcs = {}
-        for label, supercell in supercells.iteritems():
+        for i, supercell in enumerate(self.ctx.supercells.get_supercells()):
+            label = 'structure_{}'.format(i)
 
             JobCalculation, calculation_input = generate_inputs(supercell,
                                                                 # self.inputs.machine,
@@ -264,10 +327,17 @@ class PhononPhono3py(WorkChain):
 
         return ToContext(**calcs)
 
-    def create_displacement_calculations_chunk(self):
+    def create_displacements(self):
+        """
+        Generate the supercells with displacements (only once). They are stored in the context and
+        the calculations are submitted in chunks by create_displacement_calculations_chunk
+        """
 
         from aiida_phonopy.workchains.phonon import get_primitive
 
+        print ('create displacements')
+        self.report('create displacements')
+
         if 'optimized' in self.ctx:
             self.ctx.final_structure = self.ctx.optimized.out.optimized_structure
             self.out('optimized_data', self.ctx.optimized.out.optimized_structure_data)
@@ -277,50 +347,82 @@ class PhononPhono3py(WorkChain):
         self.ctx.primitive_structure = get_primitive(self.ctx.final_structure,
                                                      self.inputs.ph_settings)['primitive_structure']
 
-        supercells = create_supercells_with_displacements_using_phono3py(self.ctx.final_structure,
-                                                                         self.inputs.ph_settings)
+        displacements = create_supercells_with_displacements_using_phono3py(self.ctx.final_structure,
+                                                                            self.inputs.ph_settings)
+
+        self.ctx.data_sets = displacements['data_sets']
+        self.ctx.supercells = displacements['supercells']
+        self.ctx.number_of_displacements = self.ctx.supercells.get_number_of_supercells()
+
+        if 'force_engine' in self.inputs.es_settings.get_dict():
+            from aiida_phonopy.workchains.phonon import get_forces_from_force_engine
+
+            self.report('calculate forces using in-process force engine')
+            self.ctx.force_sets = get_forces_from_force_engine(es_settings=self.inputs.es_settings,
+                                                               data_sets=self.ctx.data_sets,
+                                                               supercells=self.ctx.supercells)['force_sets']
+            self.ctx.i_disp = 0
+            return
 
-        self.ctx.data_sets = supercells.pop('data_sets')
-        self.ctx.number_of_displacements = len(supercells)
+        n_disp = self.ctx.number_of_displacements
+        print ('total displacements: {}'.format(n_disp))
+
+        # Number of chunks to submit (the last one may be smaller)
+        self.ctx.i_disp = get_number_of_chunks(n_disp, int(self.inputs.chunks))
+
+        # Born charges are submitted together with the first chunk
+        self.ctx.submit_born_charges = bool(self.inputs.use_nac)
+
+    def create_displacement_calculations_chunk(self):
 
         calcs = {}
 
-        n_disp = len(supercells)
-        if 'i_disp' in self.ctx:
-            list = range(self.ctx.i_disp * int(self.inputs.chunks),
-                         (self.ctx.i_disp + 1) * int(self.inputs.chunks))
+        # Born charges (for primitive cell)
+        if self.ctx.submit_born_charges:
+            self.report('calculate born charges')
+            JobCalculation, calculation_input = generate_inputs(self.ctx.primitive_structure,
+                                                                # self.inputs.machine,
+                                                                self.inputs.es_settings,
+                                                                # pressure=self.input.pressure,
+                                                                type='born_charges')
+            future = submit(JobCalculation, **calculation_input)
+            print ('single_point: {}'.format(future.pid))
+            calcs['single_point'] = future
+            self.ctx.submit_born_charges = False
+
+        self.ctx.i_disp -= 1
+        indices = get_chunk_indices(self.ctx.i_disp, int(self.inputs.chunks), self.ctx.number_of_displacements)
+
+        if 'perfect_supercell' in self.ctx:
+            parent_folder = self.ctx.perfect_supercell.out.remote_folder
         else:
-            self.ctx.i_disp = n_disp / int(self.inputs.chunks)
-            list = range(self.ctx.i_disp * int(self.inputs.chunks), n_disp)
-            print ('create displacements')
-            self.report('create displacements')
-            print ('total displacements: {}'.format(n_disp))
-
-            # Born charges (for primitive cell)
-            if bool(self.inputs.use_nac):
-                self.report('calculate born charges')
-                JobCalculation, calculation_input = generate_inputs(self.ctx.primitive_structure,
-                                                                    # self.inputs.machine,
-                                                                    self.inputs.es_settings,
-                                                                    # pressure=self.input.pressure,
-                                                                    type='born_charges')
-                future = submit(JobCalculation, **calculation_input)
-                print ('single_point: {}'.format(future.pid))
-                calcs['single_point'] = future
-
-        supercell_list = np.array(supercells.items())[list]
-
-        for label, supercell in supercell_list:
+            parent_folder = None
+
+        for i, supercell in zip(indices, self.ctx.supercells.get_supercells(indices)):
+            label = 'structure_{}'.format(i)
+
             JobCalculation, calculation_input = generate_inputs(supercell,
                                                                 # self.inputs.machine,
                                                                 self.inputs.es_settings,
                                                                 # pressure=self.input.pressure,
-                                                                type='forces')
+                                                                type='forces',
+                                                                parent_folder=parent_folder)
+
+            if self.inputs.use_cache:
+                calculation_hash = get_calculation_hash(calculation_input)
+                cached_calculation = get_cached_calculation(calculation_hash)
+                if cached_calculation is not None:
+                    print ('{} reused pk = {}'.format(label, cached_calculation.pk))
+                    self.ctx._content[label] = cached_calculation
+                    continue
 
             calculation_input._label = label
             future = submit(JobCalculation, **calculation_input)
             print ('{} pk = {}'.format(label, future.pid))
 
+            if self.inputs.use_cache:
+                set_calculation_hash(future.pid, calculation_hash)
+
             calcs[label] = future
 
         return ToContext(**calcs)
@@ -330,17 +432,12 @@ class PhononPhono3py(WorkChain):
         from aiida_phonopy.workchains.phonon import get_nac_from_data
         self.report('collect data and create force_sets')
 
-        wf_inputs = {}
-        for i in range(self.ctx.number_of_displacements):
-            # This has to be changed to make uniform plugin interface
-            try:
-                wf_inputs['forces_{}'.format(i)] = self.ctx.get('structure_{}'.format(i)).out.output_trajectory
-            except:
-                wf_inputs['forces_{}'.format(i)] = self.ctx.get('structure_{}'.format(i)).out.output_array
-
-        wf_inputs['data_sets'] = self.ctx.data_sets
+        if 'force_sets' not in self.ctx:
+            calcs = [self.ctx.get('structure_{}'.format(i)) for i in range(self.ctx.number_of_displacements)]
+            forces = get_aggregated_forces(calcs)
 
-        self.ctx.force_sets = create_forces_set(**wf_inputs)['force_sets']
+            self.ctx.force_sets = create_forces_set(data_sets=self.ctx.data_sets,
+                                                    forces=forces)['force_sets']
 
         if 'single_point' in self.ctx:
             nac_data = get_nac_from_data(born_charges=self.ctx.single_point.out.born_charges,
@@ -356,11 +453,16 @@ class PhononPhono3py(WorkChain):
 
     def calculate_force_constants(self):
 
-        force_constants = get_force_constants3(self.ctx.force_sets,
-                                               self.ctx.final_structure,
-                                               self.inputs.ph_settings)
+        future = async(get_force_constants3,
+                       data_sets=self.ctx.force_sets,
+                       structure=self.ctx.final_structure,
+                       ph_settings=self.inputs.ph_settings)
+
+        return ToContext(force_constants=future)
+
+    def collect_force_constants(self):
 
-        self.out('force_constants_2order', force_constants['force_constants_2order'])
-        self.out('force_constants_3order', force_constants['force_constants_3order'])
+        self.out('force_constants_2order', self.ctx.force_constants.out.force_constants_2order)
+        self.out('force_constants_3order', self.ctx.force_constants.out.force_constants_3order)
 
         return
@@ -4,12 +4,15 @@ if not is_dbenv_loaded():
 
 from aiida.work.workchain import WorkChain, ToContext
 from aiida.work.workfunction import workfunction
-from aiida.work.run import run, submit, async
+from aiida.work.run import run, submit, async, RunningInfo, RunningType
 
 from aiida.orm import load_node, DataFactory, WorkflowFactory
 from aiida.orm.data.base import Str, Float, Bool, Int
+from aiida.work.workchain import _If, _While
 
 import numpy as np
+from aiida_phonopy.common.cache import get_optimize_hash, get_cached_optimization
+from aiida_phonopy.workchains.optimize import get_optimize_inputs
 
 __testing__ = False
 
@@ -21,6 +24,7 @@ StructureData = DataFactory('structure')
 BandStructureData = DataFactory('phonopy.band_structure')
 GruneisenPhonopy = WorkflowFactory('phonopy.gruneisen')
 PhononPhonopy = WorkflowFactory('phonopy.phonon')
+OptimizeStructure = WorkflowFactory('phonopy.optimize')
 
 
 @workfunction
@@ -76,6 +80,11 @@ def phonopy_qha(**kwargs):
 class QHAPhonopy(WorkChain):
     """
     Workchain to calculate the mode Gruneisen parameters
+
+    :param use_continuation: Set true to optimize the volume expansions in order of stress, starting from the one
+                             closest to zero stress. Each optimization starts from the optimized structure (and
+                             wave functions) of its already converged neighbour, and the phonon calculation of each
+                             expansion is submitted as soon as its optimization finishes (default: False)
     """
     @classmethod
     def define(cls, spec):
@@ -86,8 +95,119 @@ class QHAPhonopy(WorkChain):
         # Optional arguments
         spec.input("num_expansions", valid_type=Int, required=False, default=Int(10))
         spec.input("use_nac", valid_type=Bool, required=False, default=Bool(True))
+        spec.input("use_cache", valid_type=Bool, required=False, default=Bool(False))
+        spec.input("use_continuation", valid_type=Bool, required=False, default=Bool(False))
+
+        spec.outline(cls.get_gruneisen_prediction,
+                     _If(cls.use_continuation)(_While(cls.continue_optimizing)(cls.optimize_expansions)),
+                     cls.create_unit_cell_expansions,
+                     cls.calculate_qha)
+
+    def use_continuation(self):
+        return self.inputs.use_continuation
+
+    def get_stress_samples(self):
+        prediction = self.ctx.gruneisen.out.prediction
+        stress_range = prediction.dict.stress_range
+        stress_delta = stress_range[-1] - stress_range[0]
+
+        stress_samples = np.linspace(stress_range[0] - stress_delta * 0.5,
+                                     stress_range[-1] + stress_delta * 0.5,
+                                     int(self.inputs.num_expansions))
+        return stress_samples
+
+    def continue_optimizing(self):
+
+        if 'continuation_step' not in self.ctx:
+            stress_samples = self.get_stress_samples()
+            self.ctx.continuation_step = 0
+            self.ctx.continuation_center = int(np.argmin(np.abs(stress_samples)))
+
+        center = self.ctx.continuation_center
+        max_step = max(center, int(self.inputs.num_expansions) - 1 - center)
+
+        return self.ctx.continuation_step <= max_step
+
+    def optimize_expansions(self):
+        """
+        Submit the optimizations of the next expansions at both sides of the center of the stress samples.
+        Each one starts from the optimized structure of the neighbour closer to the center. The phonon
+        calculations of the expansions optimized in the previous step are submitted at the same time.
+        """
+
+        stress_samples = self.get_stress_samples()
+        center = self.ctx.continuation_center
+        step = self.ctx.continuation_step
+
+        self.submit_continuation_phonons(self.ctx.get('continuation_expansions', []))
+
+        if step == 0:
+            expansions = [(center, None)]
+        else:
+            expansions = [(index, seed) for index, seed in [(center - step, center - step + 1),
+                                                            (center + step, center + step - 1)]
+                          if 0 <= index < len(stress_samples)]
+
+        calcs = {}
+        for index, seed in expansions:
+            label = 'optimize_{}'.format(index)
+
+            optimize_inputs = get_optimize_inputs(self.inputs.structure,
+                                                  self.inputs.es_settings,
+                                                  Float(stress_samples[index]))
+
+            if seed is not None:
+                seed_optimization = self.ctx.get('optimize_{}'.format(seed))
+                optimize_inputs['structure'] = seed_optimization.out.optimized_structure
+                if 'remote_folder' in seed_optimization.get_outputs_dict():
+                    optimize_inputs['parent_folder'] = seed_optimization.out.remote_folder
 
-        spec.outline(cls.get_gruneisen_prediction, cls.create_unit_cell_expansions, cls.calculate_qha)
+            if self.inputs.use_cache:
+                # The restart files do not change the optimized structure (not included in the hash)
+                cached_optimization = get_cached_optimization(get_optimize_hash(
+                    **{key: value for key, value in optimize_inputs.items() if key != 'parent_folder'}))
+                if cached_optimization is not None:
+                    self.report('{} reused pk = {}'.format(label, cached_optimization.pk))
+                    self.ctx._content[label] = cached_optimization
+                    continue
+
+            future = submit(OptimizeStructure, write_restart=Bool(True), **optimize_inputs)
+
+            calcs[label] = future
+            print ('optimize workchain: {} {}'.format(label, future.pid))
+
+        self.ctx.continuation_expansions = [index for index, _ in expansions]
+        self.ctx.continuation_step += 1
+
+        return ToContext(**calcs)
+
+    def submit_phonon(self, index, structure, optimize):
+
+        future = submit(PhononPhonopy,
+                        structure=structure,
+                        ph_settings=self.inputs.ph_settings,
+                        es_settings=self.inputs.es_settings,
+                        pressure=Float(self.get_stress_samples()[index]),
+                        optimize=Bool(optimize),
+                        use_nac=self.inputs.use_nac,
+                        use_cache=self.inputs.use_cache
+                        )
+
+        print ('phonon workchain: {} {}'.format('phonon_{}'.format(index), future.pid))
+        return future
+
+    def submit_continuation_phonons(self, expansions):
+        """
+        Submit the phonon calculations of optimized expansions of the continuation series. The workchain does not
+        wait for them here (only their pk is stored), so the optimization series continues meanwhile.
+
+        :param expansions: list of indices of the expansions
+        """
+        phonon_pks = dict(self.ctx.get('continuation_phonons', {}))
+        for index in expansions:
+            structure = self.ctx.get('optimize_{}'.format(index)).out.optimized_structure
+            phonon_pks['phonon_{}'.format(index)] = self.submit_phonon(index, structure, False).pid
+        self.ctx.continuation_phonons = phonon_pks
 
     def get_gruneisen_prediction(self):
         print('start qha (pk={})'.format(self.pid))
@@ -102,7 +222,8 @@ class QHAPhonopy(WorkChain):
                         ph_settings=self.inputs.ph_settings,
                         es_settings=self.inputs.es_settings,
                         pressure=Float(0.0),
-                        use_nac=self.inputs.use_nac
+                        use_nac=self.inputs.use_nac,
+                        use_cache=self.inputs.use_cache
                         )
 
         print ('gruneisen workchain: {}'.format(future.pid))
@@ -112,12 +233,7 @@ class QHAPhonopy(WorkChain):
 
         print('start Gruneisen (pk={})'.format(self.pid))
         prediction = self.ctx.gruneisen.out.prediction
-        stress_range = prediction.dict.stress_range
-        stress_delta = stress_range[-1] - stress_range[0]
-
-        stress_samples = np.linspace(stress_range[0] - stress_delta * 0.5,
-                                     stress_range[-1] + stress_delta * 0.5,
-                                     self.inputs.num_expansions)
+        stress_samples = self.get_stress_samples()
 
         print prediction.dict.stress_range
         print prediction.dict.volume_range
@@ -136,20 +252,16 @@ class QHAPhonopy(WorkChain):
             self.ctx._content['phonon_9'] = load_node(19245)
             return
 
-        calcs = {}
-        for i, stress in enumerate(stress_samples):
+        if self.inputs.use_continuation:
+            # Only the phonon calculations of the last optimized expansions are left to submit, the others were
+            # submitted during the optimization series. Wait for all of them
+            self.submit_continuation_phonons(self.ctx.continuation_expansions)
+            return ToContext(**{label: RunningInfo(RunningType.PROCESS, pk)
+                                for label, pk in self.ctx.continuation_phonons.items()})
 
-            future = submit(PhononPhonopy,
-                            structure=self.inputs.structure,
-                            ph_settings=self.inputs.ph_settings,
-                            es_settings=self.inputs.es_settings,
-                            pressure=Float(stress),
-                            optimize=Bool(True),
-                            use_nac=self.inputs.use_nac
-                            )
-
-            calcs['phonon_{}'.format(i)] = future
-            print ('phonon workchain: {} {}'.format('phonon_{}'.format(i), future.pid))
+        calcs = {}
+        for i in range(len(stress_samples)):
+            calcs['phonon_{}'.format(i)] = self.submit_phonon(i, self.inputs.structure, True)
 
         return ToContext(**calcs)
 
@@ -158,7 +270,10 @@ class QHAPhonopy(WorkChain):
         input_qha = {}
         for i in range(int(self.inputs.num_expansions)):
             input_qha['structure_{}'.format(i)] = self.ctx.get('phonon_{}'.format(i)).out.final_structure
-            input_qha['output_data_{}'.format(i)] = self.ctx.get('phonon_{}'.format(i)).out.optimized_data
+            if self.inputs.use_continuation:
+                input_qha['output_data_{}'.format(i)] = self.ctx.get('optimize_{}'.format(i)).out.optimized_structure_data
+            else:
+                input_qha['output_data_{}'.format(i)] = self.ctx.get('phonon_{}'.format(i)).out.optimized_data
             input_qha['thermal_properties_{}'.format(i)] = self.ctx.get('phonon_{}'.format(i)).out.thermal_properties
 
         qha_results = phonopy_qha(**input_qha)
@@ -0,0 +1,66 @@
+import numpy as np
+
+from aiida_phonopy.common.bands import get_band_points, get_band_array, split_band_array
+
+BAND_RANGES = np.array([[[0, 0, 0], [0.5, 0, 0.5]],
+                        [[0.5, 0, 0.5], [0.5, 0.25, 0.75]],
+                        [[0.5, 0.25, 0.75], [0, 0, 0]]])
+
+RECIPROCAL_CELL = np.linalg.inv(np.array([[0, 0.5, 0.5], [0.5, 0, 0.5], [0.5, 0.5, 0]]) * 5.43).T
+
+
+def test_default_band_points():
+    bands = get_band_points(BAND_RANGES, RECIPROCAL_CELL, band_resolution=10)
+
+    # Same as the loop over the q-points of each band
+    for band, (q_start, q_end) in zip(bands, BAND_RANGES):
+        reference = [q_start + (q_end - q_start) * i / 10.0 for i in range(11)]
+        assert np.allclose(band, reference)
+
+
+def test_band_points_proportional_to_length():
+    bands = get_band_points(BAND_RANGES, RECIPROCAL_CELL, band_points=100)
+
+    lengths = [np.linalg.norm(np.dot(q_end - q_start, RECIPROCAL_CELL)) for q_start, q_end in BAND_RANGES]
+    sizes = [len(band) for band in bands]
+
+    assert len(set(sizes)) > 1
+    assert abs(sum(sizes) - 100) <= len(bands)
+    assert np.argsort(sizes).tolist() == np.argsort(lengths).tolist()
+
+    for band, (q_start, q_end) in zip(bands, BAND_RANGES):
+        assert np.allclose(band[0], q_start)
+        assert np.allclose(band[-1], q_end)
+        assert np.allclose(np.diff(band, axis=0), (q_end - q_start) / (len(band) - 1.0))
+
+    # At least 2 q-points in each band
+    assert all(len(band) == 2 for band in get_band_points(BAND_RANGES, RECIPROCAL_CELL, band_points=1))
+
+
+def test_ragged_band_array_round_trip():
+    bands = get_band_points(BAND_RANGES, RECIPROCAL_CELL, band_points=50)
+    frequencies = [np.random.RandomState(i).rand(len(band), 6) for i, band in enumerate(bands)]
+
+    for data in [bands, frequencies]:
+        array, sizes = get_band_array(data)
+
+        assert array.shape[0] == sum(len(band) for band in data)
+        assert sizes.tolist() == [len(band) for band in data]
+
+        restored = split_band_array(array, sizes)
+        assert len(restored) == len(data)
+        for band, reference in zip(restored, data):
+            assert np.array_equal(band, reference)
+
+        assert np.array_equal(split_band_array(array, sizes, band=1), data[1])
+
+
+def test_regular_band_array():
+    bands = get_band_points(BAND_RANGES, RECIPROCAL_CELL, band_resolution=20)
+
+    array, sizes = get_band_array(bands)
+
+    assert sizes is None
+    assert array.shape == (3, 21, 3)
+    assert np.array_equal(split_band_array(array, sizes), np.array(bands))
+    assert np.array_equal(split_band_array(array, sizes, band=2), bands[2])
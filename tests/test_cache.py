@@ -0,0 +1,104 @@
+from aiida_phonopy.common.cache import get_hash, get_structure_representation, get_calculation_hash, \
+    get_optimize_hash, OPTIMIZE_DEFAULTS
+
+
+class Structure(object):
+    # Minimal object with the StructureData interface used by get_structure_representation
+    def __init__(self, cell, positions, symbols):
+        self.cell = cell
+        self._attributes = {'sites': [{'position': tuple(position), 'kind_name': symbol}
+                                      for position, symbol in zip(positions, symbols)]}
+
+    def get_attr(self, name, default=None):
+        return self._attributes.get(name, default)
+
+
+class Parameters(object):
+    # Minimal object with the ParameterData interface
+    def __init__(self, dictionary):
+        self._dictionary = dictionary
+
+    def get_dict(self):
+        return dict(self._dictionary)
+
+
+class Node(object):
+    def __init__(self, uuid):
+        self.uuid = uuid
+
+
+class Kpoints(object):
+    def get_kpoints_mesh(self):
+        return [[4, 4, 4], [0.0, 0.0, 0.0]]
+
+
+class CalculationInput(dict):
+    # Calculation inputs template (attributes and get() as in the process builder of generate_inputs)
+    def __getattr__(self, name):
+        return self[name]
+
+
+def get_structure(shift=0.0):
+    return Structure([[3.0, 0, 0], [0, 3.0, 0], [0, 0, 3.0]],
+                     [[0, 0, 0], [1.5 + shift, 1.5, 1.5]],
+                     ['Na', 'Cl'])
+
+
+def get_calculation_input(structure, parameters, resources=None):
+    return CalculationInput(code=Node('code-uuid'),
+                            structure=structure,
+                            parameters=Parameters(parameters),
+                            kpoints=Kpoints(),
+                            pseudo={'Na': Node('na-uuid'), 'Cl': Node('cl-uuid')},
+                            _options={'resources': resources})
+
+
+def get_optimize_inputs(**kwargs):
+    inputs = {'structure': get_structure(),
+              'es_settings': Parameters({'code': 'vasp@cluster', 'parameters': {'ENCUT': 500}}),
+              'pressure': 0.0}
+    inputs.update(OPTIMIZE_DEFAULTS)
+    inputs.update(kwargs)
+    return inputs
+
+
+def test_hash_does_not_depend_on_key_order():
+    assert get_hash({'a': 1, 'b': [1, 2]}) == get_hash({'b': [1, 2], 'a': 1})
+    assert get_hash({'a': 1}) != get_hash({'a': 2})
+
+
+def test_structure_representation_rounding():
+    representation = get_structure_representation(get_structure())
+
+    # Differences below the number of decimals and negative zeros do not change the representation
+    assert get_structure_representation(get_structure(shift=1e-9)) == representation
+    assert get_structure_representation(Structure([[3.0, -0.0, 0], [0, 3.0, -0.0], [-0.0, 0, 3.0]],
+                                                  [[-0.0, 0, 0], [1.5, 1.5, 1.5]],
+                                                  ['Na', 'Cl'])) == representation
+    assert get_structure_representation(get_structure(shift=1e-4)) != representation
+
+
+def test_calculation_hash():
+    calculation_hash = get_calculation_hash(get_calculation_input(get_structure(), {'ecutwfc': 40}))
+
+    # Computational resources do not change the result
+    assert get_calculation_hash(get_calculation_input(get_structure(), {'ecutwfc': 40},
+                                                      resources={'num_machines': 2})) == calculation_hash
+
+    assert get_calculation_hash(get_calculation_input(get_structure(), {'ecutwfc': 50})) != calculation_hash
+    assert get_calculation_hash(get_calculation_input(get_structure(shift=0.01), {'ecutwfc': 40})) != calculation_hash
+
+
+def test_optimize_hash():
+    optimize_hash = get_optimize_hash(**get_optimize_inputs())
+
+    # Computational resources do not change the result
+    es_settings = Parameters({'code': 'vasp@cluster', 'parameters': {'ENCUT': 500}, 'machine': {'num_machines': 4}})
+    assert get_optimize_hash(**get_optimize_inputs(es_settings=es_settings)) == optimize_hash
+
+    for name, value in [('pressure', 10.0),
+                        ('tolerance_forces', 1e-3),
+                        ('tolerance_stress', 1.0),
+                        ('max_iterations', 10),
+                        ('standarize_cell', False)]:
+        assert get_optimize_hash(**get_optimize_inputs(**{name: value})) != optimize_hash
@@ -0,0 +1,31 @@
+import pytest
+
+from aiida_phonopy.common.chunks import get_number_of_chunks, get_chunk_indices
+
+
+def get_submitted_indices(n_items, chunk_size):
+    # Same sequence as PhononPhono3py: the remaining number of chunks is decreased before each submission
+    submitted = []
+    remaining = get_number_of_chunks(n_items, chunk_size)
+    while remaining > 0:
+        remaining -= 1
+        submitted.append(get_chunk_indices(remaining, chunk_size, n_items))
+    return submitted
+
+
+@pytest.mark.parametrize('n_items, chunk_size', [(0, 10), (1, 10), (9, 10), (10, 10), (11, 10),
+                                                 (250, 100), (300, 100), (7, 1)])
+def test_chunks_cover_all_items_once(n_items, chunk_size):
+    chunks = get_submitted_indices(n_items, chunk_size)
+
+    assert len(chunks) == get_number_of_chunks(n_items, chunk_size)
+    assert sorted(index for chunk in chunks for index in chunk) == list(range(n_items))
+    assert all(0 < len(chunk) <= chunk_size for chunk in chunks)
+
+    # Only the last chunk (submitted first) can be smaller
+    assert all(len(chunk) == chunk_size for chunk in chunks[1:])
+
+
+def test_last_chunk():
+    assert get_chunk_indices(2, 100, 250) == list(range(200, 250))
+    assert get_chunk_indices(0, 100, 250) == list(range(0, 100))
@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+
+from aiida_phonopy.common.structure import get_displacement_arrays, get_displaced_positions
+
+
+def get_bundle(positions, displacements):
+    atom_indices, supercell_indices, vectors = get_displacement_arrays(displacements)
+    return positions, atom_indices, supercell_indices, vectors, len(displacements)
+
+
+def test_round_trip_phonopy():
+    pytest.importorskip('phonopy')
+    from phonopy import Phonopy
+    from phonopy.structure.atoms import PhonopyAtoms
+
+    unitcell = PhonopyAtoms(symbols=['Ga', 'Ga', 'N', 'N'],
+                            cell=[[3.19, 0, 0], [-1.595, 2.7626, 0], [0, 0, 5.19]],
+                            scaled_positions=[[1. / 3, 2. / 3, 0], [2. / 3, 1. / 3, 0.5],
+                                              [1. / 3, 2. / 3, 0.377], [2. / 3, 1. / 3, 0.877]])
+    phonon = Phonopy(unitcell, [[2, 0, 0], [0, 2, 0], [0, 0, 2]])
+    phonon.generate_displacements(distance=0.01)
+
+    # Same as create_supercells_with_displacements_using_phonopy
+    data_sets = phonon.get_displacement_dataset()
+    bundle = get_bundle(phonon.get_supercell().get_positions(),
+                        [[(first_atoms['number'], first_atoms['displacement'])]
+                         for first_atoms in data_sets['first_atoms']])
+
+    reference = np.array([supercell.get_positions() for supercell in phonon.get_supercells_with_displacements()])
+
+    assert np.allclose(get_displaced_positions(*bundle), reference)
+
+    # Subsets of supercells in any order
+    for indices in [[1], [3, 0], list(range(len(reference)))[::-1]]:
+        assert np.allclose(get_displaced_positions(*bundle, indices=indices), reference[indices])
+
+
+def test_round_trip_pairs_of_displacements():
+    positions = np.random.RandomState(0).rand(6, 3) * 5
+    displacements = [[(0, [0.01, 0, 0])],
+                     [(2, [0, 0.01, 0])],
+                     [(0, [0.01, 0, 0]), (3, [0, 0, -0.02])],
+                     [(2, [0, 0.01, 0]), (2, [0.03, 0, 0])],  # the same atom displaced twice
+                     []]
+
+    reference = np.repeat(positions[None], len(displacements), axis=0)
+    for i, supercell_displacements in enumerate(displacements):
+        for atom_index, displacement in supercell_displacements:
+            reference[i, atom_index] += displacement
+
+    bundle = get_bundle(positions, displacements)
+    assert len(bundle[1]) == 6
+
+    assert np.allclose(get_displaced_positions(*bundle), reference)
+    assert np.allclose(get_displaced_positions(*bundle, indices=[4, 3, 2]), reference[[4, 3, 2]])
+
+    # The perfect supercell is not modified
+    assert np.allclose(bundle[0], np.random.RandomState(0).rand(6, 3) * 5)
@@ -0,0 +1,134 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('phonopy')
+
+from phonopy import Phonopy
+from phonopy.structure.atoms import PhonopyAtoms
+
+from aiida_phonopy.common.dynamical_matrix import (get_model_arrays, get_dynamical_matrices, get_frequencies,
+                                                   get_model_frequencies, get_nac_method, NAC_METHOD)
+
+SUPERCELL_MATRICES = [np.diag([2, 2, 2]).tolist(),
+                      [[1, 3, 0], [0, 1, 0], [0, 0, 2]],
+                      [[-1, 1, 1], [1, -1, 1], [1, 1, -1]]]
+
+
+def get_silicon():
+    return PhonopyAtoms(symbols=['Si'] * 2,
+                        cell=np.array([[0, 0.5, 0.5], [0.5, 0, 0.5], [0.5, 0.5, 0]]) * 5.43,
+                        scaled_positions=[[0, 0, 0], [0.25, 0.25, 0.25]])
+
+
+def get_gallium_nitride():
+    return PhonopyAtoms(symbols=['Ga', 'Ga', 'N', 'N'],
+                        cell=[[3.19, 0, 0], [-1.595, 2.7626, 0], [0, 0, 5.19]],
+                        scaled_positions=[[1. / 3, 2. / 3, 0], [2. / 3, 1. / 3, 0.5],
+                                          [1. / 3, 2. / 3, 0.377], [2. / 3, 1. / 3, 0.877]])
+
+
+def get_phonon(unitcell, supercell_matrix, dense_svecs=False, seed=0):
+    try:
+        phonon = Phonopy(unitcell, supercell_matrix, store_dense_svecs=dense_svecs)
+    except TypeError:
+        if dense_svecs:
+            pytest.skip('dense shortest vectors not supported by this phonopy version')
+        phonon = Phonopy(unitcell, supercell_matrix)
+
+    # Random (symmetric in the atom pair exchange) force constants
+    natoms = len(phonon.get_supercell().get_masses())
+    force_constants = np.random.RandomState(seed).randn(natoms, natoms, 3, 3)
+    phonon.set_force_constants(force_constants + force_constants.transpose(1, 0, 3, 2))
+
+    return phonon
+
+
+def get_kernel_frequencies(phonon, qpoints, nac_parameters=None):
+    arrays = get_model_arrays(phonon)
+    dynamical_matrices = get_dynamical_matrices(qpoints,
+                                                arrays['force_constants'],
+                                                arrays['masses'],
+                                                arrays['smallest_vectors'],
+                                                arrays['multiplicity'],
+                                                arrays['s2p_map'],
+                                                primitive_cell=arrays['primitive_cell'],
+                                                nac_parameters=nac_parameters)
+    return get_frequencies(dynamical_matrices, arrays['frequency_factor'])
+
+
+@pytest.mark.parametrize('dense_svecs', [False, True])
+@pytest.mark.parametrize('supercell_matrix', SUPERCELL_MATRICES)
+def test_frequencies_silicon(supercell_matrix, dense_svecs):
+    phonon = get_phonon(get_silicon(), supercell_matrix, dense_svecs=dense_svecs)
+    qpoints = np.random.RandomState(1).rand(8, 3)
+
+    reference = np.array([phonon.get_frequencies(q) for q in qpoints])
+    assert np.allclose(get_kernel_frequencies(phonon, qpoints), reference, atol=1e-8)
+
+
+@pytest.mark.parametrize('supercell_matrix', [[[1, 4, 0], [0, 1, 0], [0, 0, 1]],
+                                              [[3, 0, 0], [0, 3, 0], [0, 0, 2]]])
+def test_frequencies_non_diagonal_hexagonal(supercell_matrix):
+    phonon = get_phonon(get_gallium_nitride(), supercell_matrix)
+    qpoints = np.random.RandomState(2).rand(8, 3)
+
+    reference = np.array([phonon.get_frequencies(q) for q in qpoints])
+    assert np.allclose(get_kernel_frequencies(phonon, qpoints), reference, atol=1e-8)
+
+
+def test_nac_frequencies_near_gamma():
+    from phonopy.units import Hartree, Bohr
+
+    phonon = get_phonon(get_gallium_nitride(), [[3, 0, 0], [0, 3, 0], [0, 0, 2]])
+    born = [np.diag([2.7, 2.7, 2.8])] * 2 + [np.diag([-2.7, -2.7, -2.8])] * 2
+    nac_parameters = {'born': np.array(born),
+                      'dielectric': np.diag([5.2, 5.2, 5.4]),
+                      'factor': Hartree * Bohr,
+                      'method': NAC_METHOD}
+    phonon.set_nac_params(nac_parameters)
+    assert get_nac_method(phonon) == NAC_METHOD
+
+    # Small q-points along different directions (the non-analytical term depends on the direction)
+    qpoints = np.array([[0.01, 0, 0], [0, 0, 0.01], [0.005, 0.003, 0.01], [-0.002, 0.004, 0.001], [0.2, 0.1, 0.3]])
+
+    reference = np.array([phonon.get_frequencies(q) for q in qpoints])
+    assert np.allclose(get_kernel_frequencies(phonon, qpoints, nac_parameters), reference, atol=1e-8)
+
+    # The correction changes the frequencies near Gamma
+    assert not np.allclose(get_kernel_frequencies(phonon, qpoints[:1]), reference[:1], atol=1e-3)
+
+
+class CountingModel(dict):
+    """Phonon model arrays that count the reads (as the repository reads of PhononModelData)"""
+
+    def __init__(self, *args, **kwargs):
+        super(CountingModel, self).__init__(*args, **kwargs)
+        self.reads = {}
+
+    def __getitem__(self, name):
+        self.reads[name] = self.reads.get(name, 0) + 1
+        return super(CountingModel, self).__getitem__(name)
+
+
+@pytest.mark.parametrize('eigenvectors', [False, True])
+def test_model_frequencies_read_arrays_once(eigenvectors):
+    phonon = get_phonon(get_gallium_nitride(), [[3, 0, 0], [0, 3, 0], [0, 0, 2]])
+    qpoints = np.random.RandomState(3).rand(40, 3)
+    model = CountingModel(get_model_arrays(phonon))
+
+    # Small batches: the q-points are evaluated in many batches
+    results = get_model_frequencies(qpoints, model, eigenvectors=eigenvectors, max_memory=0.05)
+    frequencies = results[0] if eigenvectors else results
+
+    assert model.reads == dict((name, 1) for name in model)
+    reference = np.array([phonon.get_frequencies(q) for q in qpoints])
+    assert np.allclose(frequencies, reference, atol=1e-8)
+    if eigenvectors:
+        assert results[1].shape == (40, 12, 12)
+
+
+def test_model_frequencies_no_qpoints():
+    phonon = get_phonon(get_silicon(), np.diag([2, 2, 2]).tolist())
+    frequencies, vectors = get_model_frequencies([], get_model_arrays(phonon), eigenvectors=True)
+    assert frequencies.shape == (0, 6)
+    assert vectors.shape == (0, 6, 6)
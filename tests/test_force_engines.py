@@ -0,0 +1,85 @@
+import itertools
+
+import numpy as np
+import pytest
+
+from aiida_phonopy.common.force_engines import LennardJones, Morse, get_force_engine
+
+ENGINES = [(LennardJones, {'epsilon': {'Ar': 0.0104, 'Kr': 0.014}, 'sigma': {'Ar': 3.40, 'Kr': 3.65}},
+            lambda r, epsilon, sigma: 4 * epsilon * ((sigma / r) ** 12 - (sigma / r) ** 6)),
+           (Morse, {'D': {'Ar': 0.01, 'Kr': 0.02}, 'a': 1.2, 'r0': {'Ar': 3.8, 'Kr': 4.0}},
+            lambda r, D, a, r0: D * ((1 - np.exp(-a * (r - r0))) ** 2 - 1))]
+
+
+def get_mixed_parameters(parameters, symbol_i, symbol_j):
+    mixed = {}
+    for name, value in parameters.items():
+        if isinstance(value, dict):
+            if name in ['epsilon', 'D']:
+                mixed[name] = np.sqrt(value[symbol_i] * value[symbol_j])
+            else:
+                mixed[name] = (value[symbol_i] + value[symbol_j]) / 2.0
+        else:
+            mixed[name] = value
+    return mixed
+
+
+def get_reference_energy(parameters, potential, cell, positions, symbols, cutoff):
+    # Explicit sum over pairs of atoms and lattice images
+    energy = 0.0
+    n_images = 3
+    for i, j in itertools.product(range(len(positions)), repeat=2):
+        pair_parameters = get_mixed_parameters(parameters, symbols[i], symbols[j])
+        for image in itertools.product(range(-n_images, n_images + 1), repeat=3):
+            r = np.linalg.norm(positions[j] + np.dot(image, cell) - positions[i])
+            if 1e-8 < r < cutoff:
+                energy += 0.5 * potential(r, **pair_parameters)
+    return energy
+
+
+def get_structure(seed=0):
+    cell = np.diag([5.6, 5.4, 5.8])
+    fcc = np.array([[0, 0, 0], [0.5, 0.5, 0], [0.5, 0, 0.5], [0, 0.5, 0.5]])
+    positions = np.dot(fcc, cell) + np.random.RandomState(seed).randn(4, 3) * 0.05
+    return cell, positions, ['Ar', 'Kr', 'Ar', 'Kr']
+
+
+@pytest.mark.parametrize('engine_class, parameters, potential', ENGINES)
+def test_forces_are_energy_gradient(engine_class, parameters, potential):
+    cutoff = 7.0
+    cell, positions, symbols = get_structure()
+    engine = engine_class(cutoff=cutoff, **parameters)
+
+    forces = engine.get_forces(cell, positions[None], symbols)[0]
+
+    delta = 1e-5
+    reference = np.zeros_like(positions)
+    for atom, direction in itertools.product(range(len(positions)), range(3)):
+        displaced = [positions.copy(), positions.copy()]
+        displaced[0][atom, direction] += delta
+        displaced[1][atom, direction] -= delta
+        energies = [get_reference_energy(parameters, potential, cell, position, symbols, cutoff)
+                    for position in displaced]
+        reference[atom, direction] = -(energies[0] - energies[1]) / (2 * delta)
+
+    assert np.allclose(forces, reference, atol=1e-7)
+    assert np.allclose(np.sum(forces, axis=0), 0, atol=1e-10)
+
+
+def test_batches_give_same_forces():
+    cell, positions, symbols = get_structure()
+    positions = np.array([get_structure(seed)[1] for seed in range(5)])
+    settings = {'name': 'lennard_jones', 'parameters': {'epsilon': 0.0104, 'sigma': 3.40, 'cutoff': 8.5}}
+
+    forces = get_force_engine(settings).get_forces(cell, positions, symbols)
+
+    settings['parameters']['max_memory'] = 1e-6  # one supercell per batch
+    assert np.allclose(get_force_engine(settings).get_forces(cell, positions, symbols), forces)
+
+    for i in range(len(positions)):
+        assert np.allclose(get_force_engine(settings).get_forces(cell, positions[i:i + 1], symbols)[0], forces[i])
+
+
+def test_missing_parameters():
+    with pytest.raises(ValueError):
+        LennardJones(epsilon=0.01)
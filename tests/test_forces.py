@@ -0,0 +1,106 @@
+import os
+
+import numpy as np
+import pytest
+
+from aiida_phonopy.common.forces import aggregate_forces, get_forces_array, get_forces_group_name
+
+
+class ForcesNode(object):
+    """Stored array node with the 'forces' array (of a single step or a trajectory) in the repository"""
+
+    def __init__(self, directory, uuid, forces):
+        self.uuid = uuid
+        self._path = os.path.join(str(directory), uuid)
+        os.makedirs(self._path)
+        np.save(os.path.join(self._path, 'forces.npy'), forces)
+
+    def get_abs_path(self, filename):
+        return os.path.join(self._path, filename)
+
+    def get_shape(self, name):
+        return np.load(self.get_abs_path('{}.npy'.format(name)), mmap_mode='r').shape
+
+    def get_array(self, name):
+        return np.load(self.get_abs_path('{}.npy'.format(name)))
+
+
+class ArrayData(object):
+    instances = []
+
+    def __init__(self):
+        self.uuid = 'aggregated-{}'.format(len(ArrayData.instances))
+        self.arrays = {}
+        self.attributes = {}
+        self.is_stored = False
+        ArrayData.instances.append(self)
+
+    def set_array(self, name, array):
+        self.arrays[name] = array
+
+    def _set_attr(self, name, value):
+        self.attributes[name] = value
+
+    def store(self):
+        self.is_stored = True
+        return self
+
+
+class Group(object):
+    groups = {}
+
+    def __init__(self, name):
+        self.name = name
+        self.nodes = []
+
+    @classmethod
+    def get_or_create(cls, name):
+        if name in cls.groups:
+            return cls.groups[name], False
+        cls.groups[name] = cls(name)
+        return cls.groups[name], True
+
+    def add_nodes(self, nodes):
+        self.nodes.extend(nodes)
+
+
+def get_reference(n_calculations, n_atoms=8):
+    return np.random.RandomState(0).randn(n_calculations, n_atoms, 3)
+
+
+def get_forces_nodes(directory, reference):
+    # Alternate single step (output_forces) and trajectory (output_trajectory) nodes
+    forces_nodes = []
+    for i, forces in enumerate(reference):
+        if i % 2:
+            forces = np.array([np.zeros_like(forces), forces])
+        forces_nodes.append(ForcesNode(directory, 'forces-{}'.format(i), forces))
+    return forces_nodes
+
+
+def test_forces_array(tmpdir):
+    reference = get_reference(5)
+    assert np.allclose(get_forces_array(get_forces_nodes(tmpdir, reference)), reference)
+
+    with pytest.raises(Exception):
+        get_forces_array([])
+
+
+def test_aggregated_forces_provenance(tmpdir):
+    ArrayData.instances = []
+    Group.groups = {}
+
+    reference = get_reference(24)
+    forces_nodes = get_forces_nodes(tmpdir, reference)
+
+    forces = aggregate_forces(forces_nodes, ArrayData, Group)
+
+    assert forces.is_stored
+    assert list(forces.arrays) == ['forces']
+    assert np.allclose(forces.arrays['forces'], reference)
+    assert forces.attributes['forces_uuids'] == [forces_node.uuid for forces_node in forces_nodes]
+
+    # A single aggregated node, the 24 forces nodes are kept in one group instead of 24 input links
+    assert len(ArrayData.instances) == 1
+    assert list(Group.groups) == [get_forces_group_name(forces)]
+    assert Group.groups[get_forces_group_name(forces)].nodes == forces_nodes
@@ -0,0 +1,53 @@
+import os
+import sys
+
+import pytest
+
+from aiida_phonopy.common import local_executor
+
+
+# Module state changed by the calling process (as the database and event loop state of the daemon)
+STATE = 'imported'
+
+
+def get_process_id(value):
+    return value, os.getpid()
+
+
+def get_state():
+    return STATE
+
+
+@pytest.fixture
+def single_worker(monkeypatch):
+    if local_executor.get_context() is None:
+        pytest.skip('worker processes are not started without the spawn method')
+    monkeypatch.setenv(local_executor.WORKERS_ENV, '1')
+    monkeypatch.setattr(local_executor, '_pool', None)
+    yield
+    local_executor.get_pool().terminate()
+
+
+def test_run_in_calling_process(monkeypatch):
+    monkeypatch.setenv(local_executor.WORKERS_ENV, '0')
+
+    assert local_executor.run_local(get_process_id, 1) == (1, os.getpid())
+    assert local_executor.map_local(get_process_id, [(1,), (2,)]) == [(1, os.getpid()), (2, os.getpid())]
+
+
+def test_persistent_worker(single_worker):
+    value, first_pid = local_executor.run_local(get_process_id, 1)
+    assert value == 1
+    assert first_pid != os.getpid()
+
+    # The same worker runs the following tasks (the worker process is not restarted)
+    results = local_executor.map_local(get_process_id, [(i,) for i in range(5)])
+    assert [value for value, _ in results] == list(range(5))
+    assert set(pid for _, pid in results) == {first_pid}
+
+
+def test_spawned_worker(single_worker, monkeypatch):
+    # A worker forked from the calling process would inherit the changed state
+    monkeypatch.setattr(sys.modules[__name__], 'STATE', 'daemon')
+    assert local_executor.run_local(get_state) == 'imported'
+    assert get_state() == 'daemon'
@@ -0,0 +1,157 @@
+import numpy as np
+import pytest
+
+from aiida_phonopy.common import local_executor
+from aiida_phonopy.common.force_engines import get_force_engine
+
+pytest.importorskip('phonopy')
+
+from aiida_phonopy.common.mesh import MeshFrequencies, get_mesh_frequencies, get_mesh_thermal_properties, \
+    get_total_dos, get_partial_dos, get_mesh_sequence, get_converged_mesh
+from aiida_phonopy.common.phonopy_session import get_phonopy_from_data
+
+# Rock salt structure (conventional cell) with the fcc primitive cell
+CELL = np.eye(3) * 7.8
+UNITCELL = {'cell': CELL.tolist(),
+            'positions': np.dot([[0, 0, 0], [0.5, 0.5, 0], [0.5, 0, 0.5], [0, 0.5, 0.5],
+                                 [0.5, 0, 0], [0, 0.5, 0], [0, 0, 0.5], [0.5, 0.5, 0.5]], CELL).tolist(),
+            'symbols': ['Ar'] * 4 + ['Kr'] * 4}
+SETTINGS = {'supercell': [[2, 0, 0], [0, 2, 0], [0, 0, 2]],
+            'primitive': [[0, 0.5, 0.5], [0.5, 0, 0.5], [0.5, 0.5, 0]],
+            'symmetry_precision': 1e-5}
+MESH = [6, 6, 6]
+
+
+@pytest.fixture(scope='module')
+def phonon():
+    phonon = get_phonopy_from_data(UNITCELL, SETTINGS)
+    phonon.generate_displacements(distance=0.01)
+
+    supercells = phonon.get_supercells_with_displacements()
+    engine = get_force_engine({'name': 'lennard_jones',
+                               'parameters': {'epsilon': {'Ar': 0.0104, 'Kr': 0.014},
+                                              'sigma': {'Ar': 3.40, 'Kr': 3.65},
+                                              'cutoff': 7.5}})
+    phonon.set_forces(engine.get_forces(supercells[0].get_cell(),
+                                        np.array([supercell.get_positions() for supercell in supercells]),
+                                        supercells[0].get_chemical_symbols()))
+    phonon.produce_force_constants()
+    return phonon
+
+
+@pytest.fixture(params=['0', '2'])
+def workers(request, monkeypatch):
+    monkeypatch.setenv(local_executor.WORKERS_ENV, request.param)
+    monkeypatch.setattr(local_executor, '_pool', None)
+    yield
+    if local_executor._pool is not None:
+        local_executor._pool.terminate()
+
+
+def get_blocked_mesh(phonon, projected_dos):
+    # Same as calculate_phonon_properties with mesh_frequencies (see get_mesh_frequencies_in_blocks)
+    mesh_data = get_mesh_frequencies(UNITCELL, SETTINGS, MESH, phonon.get_force_constants(), 3,
+                                     is_eigenvectors=projected_dos,
+                                     is_mesh_symmetry=not projected_dos)
+    return MeshFrequencies(phonon.get_dynamical_matrix(), **mesh_data)
+
+
+@pytest.mark.parametrize('projected_dos', [False, True])
+def test_total_dos_matches_serial_mesh(workers, phonon, projected_dos):
+    mesh_object = get_blocked_mesh(phonon, projected_dos)
+
+    phonon.set_mesh(MESH, is_eigenvectors=projected_dos, is_mesh_symmetry=not projected_dos)
+    phonon.set_total_DOS(tetrahedron_method=True)
+    reference_frequencies, reference_dos = phonon.get_total_DOS()
+
+    frequencies, total_dos = get_total_dos(mesh_object)
+    assert np.allclose(frequencies, reference_frequencies)
+    assert np.allclose(total_dos, reference_dos, atol=1e-8)
+    assert np.max(total_dos) > 0
+
+
+def test_partial_dos_matches_serial_mesh(workers, phonon):
+    mesh_object = get_blocked_mesh(phonon, True)
+
+    phonon.set_mesh(MESH, is_eigenvectors=True, is_mesh_symmetry=False)
+    phonon.set_partial_DOS(tetrahedron_method=True)
+    reference_frequencies, reference_dos = phonon.get_partial_DOS()
+
+    frequencies, partial_dos = get_partial_dos(mesh_object)
+    assert np.allclose(frequencies, reference_frequencies)
+    assert partial_dos.shape == (2, len(frequencies))
+    assert np.allclose(partial_dos, reference_dos, atol=1e-8)
+
+    # The partial DOS of the atoms add up to the total DOS
+    assert np.allclose(np.sum(partial_dos, axis=0), get_total_dos(mesh_object)[1], atol=1e-8)
+
+
+def test_irreducible_mesh_matches_full_mesh(workers, phonon):
+    # Without projected DOS only the irreducible q-points (with weights) are calculated, without eigenvectors
+    mesh_object = get_blocked_mesh(phonon, False)
+    assert mesh_object.get_eigenvectors() is None
+    assert len(mesh_object.get_qpoints()) < np.prod(MESH)
+    assert np.sum(mesh_object.get_weights()) == np.prod(MESH)
+
+    phonon.set_mesh(MESH, is_eigenvectors=False, is_mesh_symmetry=False)
+    assert len(phonon.get_mesh()[0]) == np.prod(MESH)
+
+    phonon.set_thermal_properties()
+    reference = phonon.get_thermal_properties()
+    thermal_properties = get_mesh_thermal_properties(mesh_object)
+    for values, reference_values in zip(thermal_properties, reference):
+        assert np.allclose(values, reference_values, rtol=1e-8, atol=1e-8)
+
+    phonon.set_total_DOS(tetrahedron_method=True)
+    reference_frequencies, reference_dos = phonon.get_total_DOS()
+    frequencies, total_dos = get_total_dos(mesh_object)
+    assert np.allclose(frequencies, reference_frequencies)
+    assert np.allclose(total_dos, reference_dos, atol=1e-8)
+
+
+@pytest.mark.parametrize('mesh', [[40, 40, 40], [8, 8, 3], [1, 1, 1]])
+def test_mesh_sequence(mesh):
+    meshes = get_mesh_sequence(mesh)
+
+    assert meshes[0] == [max(1, (n + 3) // 4) for n in mesh]
+    assert meshes[-1] == mesh
+    for coarse, dense in zip(meshes[:-1], meshes[1:]):
+        assert all(n_coarse <= n_dense for n_coarse, n_dense in zip(coarse, dense))
+        assert coarse != dense
+
+
+def test_converged_mesh_stops_at_tolerance():
+    evaluated = []
+
+    def thermal_properties(mesh):
+        # Properties that converge as 1 / n^2 with the number of q-points in each direction
+        evaluated.append(mesh)
+        temperatures = np.arange(0, 100, 10.)
+        error = 1.0 / mesh[0] ** 2
+        return temperatures, temperatures + error, temperatures * 2 - error, np.ones_like(temperatures) + error
+
+    meshes = get_mesh_sequence([40, 40, 40])
+    assert meshes == [[10, 10, 10], [15, 15, 15], [23, 23, 23], [35, 35, 35], [40, 40, 40]]
+
+    # The heat capacity (maximum value 1) changes 2.6e-3 from 15 to 23 and 1.1e-3 from 23 to 35
+    assert get_converged_mesh(thermal_properties, [40, 40, 40], 1.5e-3) == [35, 35, 35]
+    assert evaluated == meshes[:4]
+
+    # The densest mesh is used if the properties are not converged
+    assert get_converged_mesh(thermal_properties, [40, 40, 40], 1e-12) == [40, 40, 40]
+
+
+def test_converged_mesh_thermal_properties(phonon):
+    def thermal_properties(mesh):
+        phonon.set_mesh(mesh, is_eigenvectors=False, is_mesh_symmetry=True)
+        phonon.set_thermal_properties()
+        return phonon.get_thermal_properties()
+
+    mesh = get_converged_mesh(thermal_properties, [24, 24, 24], 5e-3)
+    assert mesh == [14, 14, 14]
+
+    # The selected mesh is close to the densest mesh
+    properties = np.array(thermal_properties(mesh)[1:])
+    reference = np.array(thermal_properties([24, 24, 24])[1:])
+    change = np.max(np.abs(properties - reference), axis=1) / np.max(np.abs(reference), axis=1)
+    assert np.all(change < 1e-2)
@@ -0,0 +1,185 @@
+import copy
+
+import numpy as np
+import pytest
+
+from aiida_phonopy.common import local_executor
+from aiida_phonopy.common.force_engines import get_force_engine
+
+phonopy = pytest.importorskip('phonopy')
+
+from aiida_phonopy.common.qha import get_commensurate, get_force_constants, get_thermal_properties, \
+    set_dynamical_matrices
+
+# Rock salt structure (conventional cell) with the fcc primitive cell
+CELL = np.eye(3) * 7.8
+UNITCELL = {'cell': CELL.tolist(),
+            'positions': np.dot([[0, 0, 0], [0.5, 0.5, 0], [0.5, 0, 0.5], [0, 0.5, 0.5],
+                                 [0.5, 0, 0], [0, 0.5, 0], [0, 0, 0.5], [0.5, 0.5, 0.5]], CELL).tolist(),
+            'symbols': ['Ar'] * 4 + ['Kr'] * 4}
+SETTINGS = {'supercell': [[2, 0, 0], [0, 2, 0], [0, 0, 2]],
+            'primitive': [[0, 0.5, 0.5], [0.5, 0, 0.5], [0.5, 0.5, 0]],
+            'symmetry_precision': 1e-5}
+MESH = [4, 4, 4]
+
+
+def get_baseline_phonon(force_constants=None):
+    from phonopy import Phonopy
+    from phonopy.structure.atoms import PhonopyAtoms
+
+    phonon = Phonopy(PhonopyAtoms(symbols=UNITCELL['symbols'], positions=UNITCELL['positions'], cell=CELL),
+                     supercell_matrix=SETTINGS['supercell'],
+                     primitive_matrix=SETTINGS['primitive'],
+                     symprec=SETTINGS['symmetry_precision'])
+    if force_constants is not None:
+        phonon.set_force_constants(force_constants)
+    return phonon
+
+
+def get_baseline_force_constants(phonon_origin, gruneisen, commensurate, volumes):
+    # Per-volume loop used before the renormalization was vectorized
+    from phonopy.harmonic.dynmat_to_fc import DynmatToForceConstants
+    from phonopy.units import VaspToTHz
+
+    phonon = copy.deepcopy(phonon_origin)
+
+    phonon.set_qpoints_phonon(commensurate, is_eigenvectors=True)
+    frequencies, eigenvectors = phonon.get_qpoints_phonon()
+
+    dynmat2fc = DynmatToForceConstants(phonon.get_primitive(), phonon.get_supercell())
+    volume_ref = phonon.get_unitcell().get_volume()
+
+    force_constants_list = []
+    for volume in volumes:
+        renormalized_frequencies = []
+        for freq, g in zip(frequencies, gruneisen):
+            renormalized_frequencies.append(freq + (freq * (np.exp(-g * np.log(volume / volume_ref)) - 1)))
+        renormalized_frequencies = np.array(renormalized_frequencies)
+
+        renormalized_frequencies[0][0:3] = [0.0, 0.0, 0.0]
+
+        set_dynamical_matrices(dynmat2fc, renormalized_frequencies / VaspToTHz, eigenvectors)
+        dynmat2fc.run()
+        force_constants_list.append(np.array(dynmat2fc.get_force_constants()))
+
+    return force_constants_list
+
+
+def get_baseline_thermal_properties(force_constants_list):
+    # Per-volume loop used before the Phonopy object and mesh were shared (here on the full mesh)
+    free_energy_list = []
+    entropy_list = []
+    cv_list = []
+    temperature = None
+    for fc in force_constants_list:
+        phonon = get_baseline_phonon(fc)
+        normalization_factor = phonon.unitcell.get_number_of_atoms() / phonon.primitive.get_number_of_atoms()
+        phonon.set_mesh(MESH, is_eigenvectors=False, is_mesh_symmetry=False)
+        phonon.set_thermal_properties(t_step=10, t_max=1000, t_min=0)
+        temperature, free_energy, entropy, cv = phonon.get_thermal_properties()
+        free_energy_list.append(np.array(free_energy) * normalization_factor)
+        entropy_list.append(np.array(entropy) * normalization_factor)
+        cv_list.append(np.array(cv) * normalization_factor)
+    return np.array(free_energy_list), np.array(entropy_list).T, np.array(cv_list).T, temperature
+
+
+def get_force_constants_origin():
+    phonon = get_baseline_phonon()
+    phonon.generate_displacements(distance=0.01)
+
+    supercells = phonon.get_supercells_with_displacements()
+    engine = get_force_engine({'name': 'lennard_jones',
+                               'parameters': {'epsilon': {'Ar': 0.0104, 'Kr': 0.014},
+                                              'sigma': {'Ar': 3.40, 'Kr': 3.65},
+                                              'cutoff': 7.5}})
+    forces = engine.get_forces(supercells[0].get_cell(),
+                               np.array([supercell.get_positions() for supercell in supercells]),
+                               supercells[0].get_chemical_symbols())
+
+    phonon.set_forces(forces)
+    phonon.produce_force_constants()
+    return phonon.get_force_constants()
+
+
+@pytest.fixture(params=['0', '2'])
+def workers(request, monkeypatch):
+    monkeypatch.setenv(local_executor.WORKERS_ENV, request.param)
+    monkeypatch.setattr(local_executor, '_pool', None)
+    yield
+    if local_executor._pool is not None:
+        local_executor._pool.terminate()
+
+
+@pytest.fixture(scope='module')
+def renormalization():
+    force_constants = get_force_constants_origin()
+    _, commensurate = get_commensurate(UNITCELL, SETTINGS)
+
+    # Mode Gruneisen parameters with the symmetry of the crystal (function of the frequency)
+    phonon = get_baseline_phonon(force_constants)
+    phonon.set_qpoints_phonon(commensurate, is_eigenvectors=False)
+    gruneisen = 1.2 + 0.3 * np.abs(phonon.get_qpoints_phonon()[0])
+    volume = np.linalg.det(CELL)
+    volumes = volume * np.array([0.97, 0.99, 1.02, 1.04])
+
+    return force_constants, gruneisen, commensurate, volumes
+
+
+def test_force_constants_match_per_volume_loop(workers, renormalization):
+    force_constants, gruneisen, commensurate, volumes = renormalization
+
+    force_constants_list = get_force_constants(UNITCELL, SETTINGS, force_constants, gruneisen, commensurate, volumes)
+    reference = get_baseline_force_constants(get_baseline_phonon(force_constants), gruneisen, commensurate, volumes)
+
+    assert len(force_constants_list) == len(volumes)
+    for fc, fc_reference in zip(force_constants_list, reference):
+        assert np.allclose(fc, fc_reference, atol=1e-10)
+
+
+
+@pytest.mark.parametrize('parallel', [False, True])
+def test_thermal_properties_match_full_mesh(workers, renormalization, parallel):
+    force_constants, gruneisen, commensurate, volumes = renormalization
+    force_constants_list = get_baseline_force_constants(get_baseline_phonon(force_constants),
+                                                        gruneisen, commensurate, volumes)
+
+    free_energy, entropy, cv, temperature = get_thermal_properties(UNITCELL, SETTINGS, MESH, force_constants_list,
+                                                                   parallel=parallel)
+    reference = get_baseline_thermal_properties(force_constants_list)
+
+    assert free_energy.shape == (len(volumes), len(temperature))
+    assert entropy.shape == cv.shape == (len(temperature), len(volumes))
+
+    assert np.allclose(temperature, reference[3])
+    for values, reference_values in zip([free_energy, entropy, cv], reference[:3]):
+        assert np.allclose(values, reference_values, rtol=1e-8, atol=1e-8)
+
+
+@pytest.mark.parametrize('n_workers,parallel,n_blocks', [('0', True, 1), ('2', False, 1),
+                                                         ('2', True, 2), ('8', True, 4)])
+def test_parallel_volumes_split(monkeypatch, renormalization, n_workers, parallel, n_blocks):
+    from aiida_phonopy.common import qha
+
+    monkeypatch.setenv(local_executor.WORKERS_ENV, n_workers)
+
+    # Run the blocks in the calling process and record them
+    blocks = []
+
+    def map_in_process(function, arguments_list):
+        blocks.extend(len(arguments[-1]) for arguments in arguments_list)
+        return [function(*arguments) for arguments in arguments_list]
+
+    monkeypatch.setattr(qha, 'map_local', map_in_process)
+
+    force_constants, _, _, volumes = renormalization
+    force_constants_list = [force_constants * scale for scale in [1.0, 1.1, 0.9, 1.05]]
+
+    free_energy, entropy, cv, temperature = get_thermal_properties(UNITCELL, SETTINGS, MESH, force_constants_list,
+                                                                   parallel=parallel)
+    assert len(blocks) == n_blocks
+    assert sum(blocks) == len(force_constants_list)
+
+    # The volumes are returned in the input order
+    reference = get_baseline_thermal_properties(force_constants_list)
+    for values, reference_values in zip([free_energy, entropy, cv], reference[:3]):
+        assert np.allclose(values, reference_values, rtol=1e-8, atol=1e-8)
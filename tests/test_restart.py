@@ -0,0 +1,70 @@
+from aiida_phonopy.common.restart import get_vasp_restart_parameters, get_qe_restart_parameters
+from aiida_phonopy.common.structure import is_same_cell
+
+
+class Structure(object):
+    # Minimal object with the StructureData interface used by is_same_cell
+    def __init__(self, cell, n_atoms):
+        self.cell = cell
+        self._attributes = {'sites': [{'position': (0.0, 0.0, 0.0), 'kind_name': 'Si'}] * n_atoms}
+
+    def get_attr(self, name, default=None):
+        return self._attributes.get(name, default)
+
+
+def test_is_same_cell():
+    cell = [[5.43, 0, 0], [0, 5.43, 0], [0, 0, 5.43]]
+
+    assert is_same_cell(Structure(cell, 8), Structure(cell, 8))
+    assert is_same_cell(Structure([[5.430001, 0, 0], [0, 5.43, 0], [0, 0, 5.43]], 8), Structure(cell, 8))
+
+    # Variable-cell relaxation
+    assert not is_same_cell(Structure([[5.45, 0, 0], [0, 5.45, 0], [0, 0, 5.45]], 8), Structure(cell, 8))
+    # Standardization to a different number of atoms
+    assert not is_same_cell(Structure(cell, 2), Structure(cell, 8))
+
+
+def test_warm_start_with_changed_cell_reads_density():
+    # Cycles of a variable-cell optimization: the cell changes, so only the charge density is read
+    assert get_vasp_restart_parameters('optimize', restart=True, write_restart=True,
+                                       restart_wavefunctions=False) == {'LWAVE': '.TRUE.',
+                                                                        'LCHARG': '.TRUE.',
+                                                                        'ISTART': 0,
+                                                                        'ICHARG': 1}
+
+    assert get_qe_restart_parameters('optimize', restart=True, write_restart=True,
+                                     restart_wavefunctions=False) == {'CONTROL': {'disk_io': 'low'},
+                                                                      'ELECTRONS': {'startingpot': 'file'}}
+
+
+def test_warm_start_with_same_cell_reads_wavefunctions():
+    parameters = get_vasp_restart_parameters('optimize', restart=True, write_restart=True)
+    assert parameters['ISTART'] == 1
+    assert 'ICHARG' not in parameters
+    assert 'ISYM' not in parameters
+
+    # pw.x relaxations always start from the potential only
+    assert get_qe_restart_parameters('optimize', restart=True) == {'ELECTRONS': {'startingpot': 'file'}}
+
+
+def test_displaced_supercells_restart_without_symmetry():
+    # Perfect supercell (writes the files) and supercells with displacements (read them) use the same k-points
+    perfect = get_vasp_restart_parameters('forces', write_restart=True)
+    displaced = get_vasp_restart_parameters('forces', restart=True)
+
+    assert perfect['ISYM'] == displaced['ISYM'] == 0
+    assert perfect['LWAVE'] == perfect['LCHARG'] == '.TRUE.'
+    assert displaced['ISTART'] == displaced['ICHARG'] == 1
+
+    perfect = get_qe_restart_parameters('forces', write_restart=True)
+    displaced = get_qe_restart_parameters('forces', restart=True)
+
+    assert perfect['SYSTEM'] == displaced['SYSTEM'] == {'nosym': True}
+    assert perfect['CONTROL'] == {'disk_io': 'low'}
+    assert displaced['ELECTRONS'] == {'startingpot': 'file', 'startingwfc': 'file'}
+
+
+def test_no_restart():
+    for type in ['optimize', 'forces', 'born_charges']:
+        assert get_vasp_restart_parameters(type) == {}
+        assert get_qe_restart_parameters(type) == {}
@@ -0,0 +1,149 @@
+from collections import OrderedDict
+
+import numpy as np
+import pytest
+
+from aiida_phonopy.common import symmetry
+
+
+SILICON_CELL = np.array([[0, 0.5, 0.5], [0.5, 0, 0.5], [0.5, 0.5, 0]]) * 5.43
+SILICON_POSITIONS = [[0, 0, 0], [0.25, 0.25, 0.25]]
+SILICON_NUMBERS = [14, 14]
+
+
+@pytest.fixture
+def memory_cache(monkeypatch):
+    # Keep the cache in memory only (no database)
+    monkeypatch.setattr(symmetry, '_symmetry_cache', OrderedDict())
+    monkeypatch.setattr(symmetry, 'get_cached_symmetry', symmetry._symmetry_cache.get)
+    monkeypatch.setattr(symmetry, 'set_cached_symmetry', symmetry._add_to_memory)
+    return symmetry._symmetry_cache
+
+
+def test_hash_uses_effective_symprec():
+    symmetry_hash = symmetry.get_symmetry_hash('standardize', SILICON_CELL, SILICON_POSITIONS, SILICON_NUMBERS, 1e-5)
+
+    # Same shape and same tolerance relative to the cell size
+    assert symmetry.get_symmetry_hash('standardize', SILICON_CELL * 1.1, SILICON_POSITIONS, SILICON_NUMBERS,
+                                      1.1e-5) == symmetry_hash
+
+    # Same symprec at a different volume is a different (effective) tolerance
+    assert symmetry.get_symmetry_hash('standardize', SILICON_CELL * 1.1, SILICON_POSITIONS, SILICON_NUMBERS,
+                                      1e-5) != symmetry_hash
+
+    assert symmetry.get_symmetry_hash('seekpath', SILICON_CELL, SILICON_POSITIONS, SILICON_NUMBERS,
+                                      1e-5) != symmetry_hash
+
+
+def test_memory_cache_is_bounded(monkeypatch):
+    monkeypatch.setattr(symmetry, '_symmetry_cache', OrderedDict())
+    monkeypatch.setattr(symmetry, 'MAX_SYMMETRY_ENTRIES', 2)
+
+    symmetry._add_to_memory('a', {'value': 1})
+    symmetry._add_to_memory('b', {'value': 2})
+
+    # A cache hit makes the entry the most recently used
+    assert symmetry.get_cached_symmetry('a') == {'value': 1}
+
+    symmetry._add_to_memory('c', {'value': 3})
+    assert list(symmetry._symmetry_cache.keys()) == ['a', 'c']
+
+
+@pytest.mark.parametrize('scale', [1.0, 1.03])
+def test_standardized_cell_matches_spglib(memory_cache, scale):
+    spglib = pytest.importorskip('spglib')
+
+    cell = SILICON_CELL * scale
+    symprec = 1e-5 * scale
+
+    for _ in range(2):
+        lattice, positions, numbers = symmetry.get_standardized_cell(cell, SILICON_POSITIONS, SILICON_NUMBERS,
+                                                                     symprec=symprec)
+
+    reference = spglib.standardize_cell((cell, SILICON_POSITIONS, SILICON_NUMBERS), symprec=symprec,
+                                        to_primitive=False, no_idealize=False)
+
+    assert len(memory_cache) == 1
+    assert np.allclose(lattice, reference[0])
+    assert np.allclose(positions, reference[1])
+    assert np.array_equal(numbers, reference[2])
+
+
+def test_seekpath_path_matches_seekpath(memory_cache):
+    seekpath = pytest.importorskip('seekpath')
+
+    path = symmetry.get_seekpath_path(SILICON_CELL, SILICON_POSITIONS, SILICON_NUMBERS)
+    reference = seekpath.get_path((SILICON_CELL, SILICON_POSITIONS, SILICON_NUMBERS), symprec=1e-5)
+
+    assert path['path'] == [list(segment) for segment in reference['path']]
+    for label, coordinates in reference['point_coords'].items():
+        assert np.allclose(path['point_coords'][label], coordinates)
+
+
+def test_standardized_cell_reused_across_volumes(memory_cache):
+    spglib = pytest.importorskip('spglib')
+
+    # The cache key is the cell normalized to unit volume and the symprec relative to the cell size
+    symmetry.get_standardized_cell(SILICON_CELL, SILICON_POSITIONS, SILICON_NUMBERS, symprec=1e-5)
+    assert len(memory_cache) == 1
+
+    cell = SILICON_CELL * 1.05
+    lattice, positions, numbers = symmetry.get_standardized_cell(cell, SILICON_POSITIONS, SILICON_NUMBERS,
+                                                                 symprec=1.05e-5)
+    assert len(memory_cache) == 1
+
+    reference = spglib.standardize_cell((cell, SILICON_POSITIONS, SILICON_NUMBERS), symprec=1.05e-5,
+                                        to_primitive=False, no_idealize=False)
+    assert np.allclose(lattice, reference[0])
+    assert np.allclose(positions, reference[1])
+    assert np.array_equal(numbers, reference[2])
+
+    # A different effective tolerance is a new entry
+    symmetry.get_standardized_cell(cell, SILICON_POSITIONS, SILICON_NUMBERS, symprec=1e-5)
+    assert len(memory_cache) == 2
+
+
+def test_is_standardized_cell(memory_cache):
+    spglib = pytest.importorskip('spglib')
+
+    standardized = spglib.standardize_cell((SILICON_CELL, SILICON_POSITIONS, SILICON_NUMBERS), symprec=1e-5,
+                                           to_primitive=False, no_idealize=False)
+    lattice, positions, numbers = [np.array(value) for value in standardized]
+    assert symmetry.is_standardized_cell(lattice, positions, numbers)
+
+    # Standardizing again may shift the origin and reorder the atoms, it is the same crystal
+    restandardized = spglib.standardize_cell(standardized, symprec=1e-5, to_primitive=False, no_idealize=False)
+    assert symmetry.is_standardized_cell(restandardized[0], restandardized[1], restandardized[2])
+    assert symmetry.is_standardized_cell(lattice, positions[::-1], numbers)
+
+    # Positions shifted by a lattice vector and small displacements within the tolerance
+    noise = np.random.RandomState(0).randn(*positions.shape) * 1e-7
+    assert symmetry.is_standardized_cell(lattice, positions + [1, 0, -1] + noise, numbers)
+
+    # The primitive cell, a displaced atom and a rotated lattice are not standardized
+    assert not symmetry.is_standardized_cell(SILICON_CELL, SILICON_POSITIONS, SILICON_NUMBERS)
+
+    displaced = positions.copy()
+    displaced[3] += [0.01, 0, 0]
+    assert not symmetry.is_standardized_cell(lattice, displaced, numbers)
+
+    rotation = np.array([[0, 1, 0], [-1, 0, 0], [0, 0, 1]]) * 1.0
+    rotated_lattice = np.dot(lattice, rotation.T) * [1, 1, 1.01]
+    assert not symmetry.is_standardized_cell(rotated_lattice, positions, numbers)
+
+
+def test_is_standardized_cell_binary(memory_cache):
+    pytest.importorskip('spglib')
+
+    # Rock salt conventional cell: exchanging the elements of the sites is a different order, same crystal
+    lattice = np.eye(3) * 5.6
+    positions = np.array([[0, 0, 0], [0.5, 0.5, 0], [0.5, 0, 0.5], [0, 0.5, 0.5],
+                          [0.5, 0, 0], [0, 0.5, 0], [0, 0, 0.5], [0.5, 0.5, 0.5]])
+    numbers = np.array([11] * 4 + [17] * 4)
+
+    assert symmetry.is_standardized_cell(lattice, positions, numbers)
+    assert symmetry.is_standardized_cell(lattice, positions, numbers[::-1])
+
+    # The primitive cell is not standardized
+    primitive_lattice = np.array([[0, 0.5, 0.5], [0.5, 0, 0.5], [0.5, 0.5, 0]]) * 5.6
+    assert not symmetry.is_standardized_cell(primitive_lattice, [[0, 0, 0], [0.5, 0.5, 0.5]], [11, 17])